@@ -1,5 +1,4 @@
 from django.contrib import admin
-from content.tasks import convert_to_hls
 from profiles.models import Profile
 from sub_profiles.models import SubProfile
 from content.models import Video
@@ -7,7 +6,6 @@ from django.utils.html import format_html
 from django.db import transaction
 from django.utils.translation import gettext_lazy as _
 from django.contrib import messages
-from django_rq.queues import get_queue
 from django_rq.models import Queue
 from django_rq.admin import QueueAdmin
 
@@ -64,14 +62,6 @@ class ContentAdmin(admin.ModelAdmin):
     
     thumbnail_preview.short_description = 'Thumbnail Vorschau'
 
-    def save_model(self, request, obj, form, change):
-        is_new = not obj.pk  
-        super().save_model(request, obj, form, change)
-        
-        if is_new and obj.video_file:
-            queue = get_queue('default')
-            queue.enqueue(convert_to_hls, obj.video_file.path, obj.id, job_timeout=360, result_ttl=0) 
-    
 
 admin.site.register(ProfileProxy, ProfileAdmin)
 admin.site.register(SubProfileProxy, SubProfileAdmin)
@@ -42,6 +42,7 @@ else:
     print(f"Superuser '{username}' already exists.")
 EOF
 
-python manage.py rqworker default &
+# The scheduler runs the transcode retries (Retry intervals) and the jobs enqueued with enqueue_in
+python manage.py rqworker default --with-scheduler &
 
 exec gunicorn videoflix.wsgi:application --bind 0.0.0.0:8000
@@ -0,0 +1,90 @@
+import base64
+from datetime import date
+from django.db.models import Q
+from rest_framework.exceptions import NotFound, ValidationError
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+class KeysetPagination(BasePagination):
+    """
+    Cursor pagination over (created_at, id), newest first. The cursor is the key of the last
+    video of a page, so every page is a single index range scan, however deep the client scrolls.
+    """
+    page_size = 20
+    max_page_size = 100
+    ordering = ('-created_at', '-id')
+
+    @staticmethod
+    def encode_cursor(video):
+        # Pages of .values() rows are dicts
+        created_at, video_id = (video['created_at'], video['id']) if isinstance(video, dict) else (video.created_at, video.id)
+        key = f'{created_at.isoformat()}_{video_id}'
+        return base64.urlsafe_b64encode(key.encode()).decode()
+
+    @staticmethod
+    def decode_cursor(cursor):
+        try:
+            created_at, video_id = base64.urlsafe_b64decode(cursor.encode()).decode().split('_')
+            return date.fromisoformat(created_at), int(video_id)
+        except (TypeError, ValueError, UnicodeDecodeError):
+            raise NotFound('Invalid cursor')
+
+    def get_limit(self, request):
+        try:
+            limit = int(request.query_params.get('limit', self.page_size))
+        except ValueError:
+            raise ValidationError({'limit': 'A number is required.'})
+        return max(1, min(limit, self.max_page_size))
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        limit = self.get_limit(request)
+        queryset = queryset.order_by(*self.ordering)
+
+        cursor = request.query_params.get('cursor')
+        if cursor:
+            created_at, video_id = self.decode_cursor(cursor)
+            queryset = queryset.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=video_id))
+
+        page = list(queryset[:limit + 1])
+        self.next_cursor = self.encode_cursor(page[limit - 1]) if len(page) > limit else None
+        return page[:limit]
+
+    def get_next_link(self):
+        if self.next_cursor is None:
+            return None
+        return replace_query_param(self.request.build_absolute_uri(), 'cursor', self.next_cursor)
+
+    def get_paginated_response(self, data):
+        return Response({'next': self.get_next_link(), 'results': data})
+
+
+class SearchPagination(KeysetPagination):
+    """
+    Limit/offset pagination for ranked search results, which have no stable key to continue
+    from. Like the catalog it doesn't count the matches, one more row than the page tells
+    whether there is a next one.
+    """
+    max_offset = 1000
+
+    def get_offset(self, request):
+        try:
+            offset = int(request.query_params.get('offset', 0))
+        except ValueError:
+            raise ValidationError({'offset': 'A number is required.'})
+        return max(0, min(offset, self.max_offset))
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        limit = self.get_limit(request)
+        offset = self.get_offset(request)
+        page = list(queryset[offset:offset + limit + 1])
+        self.next_offset = offset + limit if len(page) > limit and offset + limit <= self.max_offset else None
+        return page[:limit]
+
+    def get_next_link(self):
+        if self.next_offset is None:
+            return None
+        return replace_query_param(self.request.build_absolute_uri(), 'offset', self.next_offset)
@@ -1,8 +1,115 @@
+import os
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import models
+from django.utils.text import get_valid_filename
 from rest_framework import serializers
-from content.models import Video
+from content.models import UploadSession, Video
 
 
 class ContentSerializer(serializers.ModelSerializer):
     class Meta:
         model = Video
-        fields = '__all__'
\ No newline at end of file
+        exclude = ['search_vector']
+        # Counted through the views and reaction endpoints, see content.counters
+        read_only_fields = ['views', 'likes', 'dislikes']
+
+    def update(self, instance, validated_data):
+        """
+        Saves without the counter columns, so the values loaded with the instance don't overwrite
+        increments flushed in the meantime.
+        """
+        for attr, value in validated_data.items():
+            setattr(instance, attr, value)
+        instance.save(update_fields=[
+            field.name for field in Video._meta.concrete_fields
+            if not field.primary_key and not field.generated and field.name not in self.Meta.read_only_fields
+        ])
+        return instance
+
+
+class VideoValuesSerializer:
+    """
+    Compact and sparse list representations of videos. The rows are read with .values() and
+    converted field by field, without model instances or per-row serializer fields. The values
+    are the same as ContentSerializer gives for those fields.
+    """
+    COMPACT_FIELDS = ('id', 'title', 'thumbnail', 'category', 'created_at', 'duration', 'views', 'hls_playlist')
+    # Needed by the keyset pagination, even if not requested
+    KEY_FIELDS = ('id', 'created_at')
+
+    def __init__(self, fields):
+        self.fields = fields
+        self.converters = {}
+        for name in fields:
+            field = Video._meta.get_field(name)
+            if isinstance(field, models.FileField):
+                self.converters[name] = self.file_url
+            elif isinstance(field, models.DateTimeField):
+                self.converters[name] = serializers.DateTimeField().to_representation
+            elif isinstance(field, models.DateField):
+                self.converters[name] = serializers.DateField().to_representation
+
+    @classmethod
+    def from_params(cls, params):
+        """
+        Returns the serializer for ?fields=a,b or ?compact=true, None for the full representation.
+        Raises ValidationError for unknown fields.
+        """
+        if params.get('fields'):
+            fields = tuple(dict.fromkeys(name.strip() for name in params['fields'].split(',') if name.strip()))
+            known = {field.name for field in Video._meta.concrete_fields} - {'search_vector'}
+            unknown = [name for name in fields if name not in known]
+            if unknown or not fields:
+                raise serializers.ValidationError({'fields': f'Unknown fields: {", ".join(unknown)}'})
+            return cls(fields)
+        if params.get('compact', '').lower() in ('1', 'true', 'yes'):
+            return cls(cls.COMPACT_FIELDS)
+        return None
+
+    @staticmethod
+    def file_url(name):
+        return default_storage.url(name) if name else None
+
+    def queryset(self, videos, *extra):
+        return videos.values(*dict.fromkeys(self.fields + self.KEY_FIELDS + extra))
+
+    def to_representation(self, row):
+        converters = self.converters
+        return {
+            name: converters[name](row[name]) if name in converters and row[name] is not None else row[name]
+            for name in self.fields
+        }
+
+    def serialize(self, rows):
+        return [self.to_representation(row) for row in rows]
+
+
+class UploadSessionSerializer(serializers.ModelSerializer):
+    """
+    Starts a resumable upload. The video fields are kept as metadata until the upload is complete.
+    """
+    title = serializers.CharField(max_length=100, write_only=True)
+    description = serializers.CharField(write_only=True)
+    category = serializers.ChoiceField(choices=Video.CATEGORY_CHOICES, default='music', write_only=True)
+
+    class Meta:
+        model = UploadSession
+        fields = ['id', 'filename', 'length', 'offset', 'video', 'title', 'description', 'category']
+        read_only_fields = ['id', 'offset', 'video']
+
+    def validate_filename(self, value):
+        return get_valid_filename(os.path.basename(value))
+
+    def validate_length(self, value):
+        if value <= 0:
+            raise serializers.ValidationError('The upload must not be empty.')
+        if value > settings.UPLOAD_MAX_LENGTH:
+            raise serializers.ValidationError(f'The upload must not be larger than {settings.UPLOAD_MAX_LENGTH} bytes.')
+        return value
+
+    def create(self, validated_data):
+        validated_data['metadata'] = {
+            field: validated_data.pop(field) for field in ('title', 'description', 'category')
+        }
+        return super().create(validated_data)
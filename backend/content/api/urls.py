@@ -1,10 +1,36 @@
 from django.urls import path
 from .views import ContentView
 from .views import ContentViewPK
+from .views import HomeView
+from .views import TrendingView
+from .views import ContinueWatchingView
+from .views import WatchHeartbeatView
+from .views import SearchView
+from .views import AutocompleteView
+from .views import VideoReactionView
+from .views import VideoViewCountView
+from .views import TranscodeProgressView
+from .views import SegmentCacheStatsView
+from .views import CatalogExportView
+from .views import UploadSessionView
+from .views import UploadSessionDetailView
 
 
 urlpatterns = [
     path('videos/', ContentView.as_view(), name='video_list'),
     path('videos/<int:pk>/', ContentViewPK.as_view(), name='video_detail'),
+    path('home/', HomeView.as_view(), name='home'),
+    path('trending/', TrendingView.as_view(), name='trending'),
+    path('search/', SearchView.as_view(), name='search'),
+    path('search/autocomplete/', AutocompleteView.as_view(), name='search_autocomplete'),
+    path('videos/<int:pk>/views/', VideoViewCountView.as_view(), name='video_views'),
+    path('videos/<int:pk>/reaction/', VideoReactionView.as_view(), name='video_reaction'),
+    path('videos/<int:pk>/progress/', WatchHeartbeatView.as_view(), name='video_progress'),
+    path('continue-watching/', ContinueWatchingView.as_view(), name='continue_watching'),
+    path('videos/<int:pk>/transcode/', TranscodeProgressView.as_view(), name='video_transcode_progress'),
+    path('segment-cache/', SegmentCacheStatsView.as_view(), name='segment_cache_stats'),
+    path('export/', CatalogExportView.as_view(), name='catalog_export'),
+    path('uploads/', UploadSessionView.as_view(), name='upload_list'),
+    path('uploads/<uuid:pk>/', UploadSessionDetailView.as_view(), name='upload_detail'),
     # path('videos/delete/<int:video_id>/', VideoDeleteView.as_view(), name='video_delete'),
 ]
\ No newline at end of file
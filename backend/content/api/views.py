@@ -1,6 +1,9 @@
 from rest_framework import status
+from django.db import transaction
+from django.http import StreamingHttpResponse
 from django.shortcuts import get_object_or_404
 from django.views.decorators.csrf import csrf_protect
+from django.views.decorators.http import condition
 from django.utils.decorators import method_decorator
 from rest_framework.authtoken.views import APIView
 from rest_framework.permissions import AllowAny
@@ -8,23 +11,110 @@ from rest_framework.permissions import IsAuthenticatedOrReadOnly
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.permissions import IsAdminUser
 from rest_framework.response import Response
-from content.models import Video
-from .seriallizers import ContentSerializer
+from django.urls import reverse
+from content.counters import REACTIONS, add_view, get_reaction, set_reaction
+from content.catalog_io import CONTENT_TYPES, FORMATS, export_lines
+from content.catalog_cache import CATALOG_TAG, cached_data, catalog_etag, last_modified, video_tag
+from content.models import NEW_DAYS, POPULAR_VIEWS, TranscodeJob, UploadSession, Video
+from content.progress import read_progress
+from content.recommendations import RECOMMENDATIONS_TAG, related_videos
+from content.search import autocomplete_titles, search_videos
+from content.segment_cache import segment_cache
+from content.trending import TRENDING_TAG, trending_ids
+from content.watch_progress import continue_watching, owns_subprofile, record_heartbeat
+from content.uploads import append_chunk, claim_writer, complete_upload, create_staging_file, delete_staging_file, schedule_cleanup
+from .pagination import KeysetPagination, SearchPagination
+from .seriallizers import ContentSerializer, UploadSessionSerializer, VideoValuesSerializer
 from django.conf import settings
 from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from datetime import date, timedelta
+from rest_framework.exceptions import NotFound, ValidationError
+from redis.exceptions import RedisError
 
 CACHE_TTL = getattr(settings, 'CACHE_TTL', DEFAULT_TIMEOUT)
 
+TRUE_VALUES = ('1', 'true', 'yes')
+
+
+def filter_videos(videos, params):
+    """
+    Applies the category, is_new and is_popular catalog filters.
+    """
+    if params.get('category'):
+        videos = videos.filter(category=params['category'])
+    if params.get('is_new', '').lower() in TRUE_VALUES:
+        videos = videos.new()
+    if params.get('is_popular', '').lower() in TRUE_VALUES:
+        videos = videos.popular()
+    return videos
+
+
+# The conditional GET validators come from the tag versions in Redis, so a 304 is answered
+# without loading or serializing any video.
+def list_cache_name(request):
+    return f'list:{request.get_host()}:{request.get_full_path()}'
+
+def list_etag(request, *args, **kwargs):
+    return catalog_etag(list_cache_name(request), [CATALOG_TAG])
+
+def list_last_modified(request, *args, **kwargs):
+    return last_modified(CATALOG_TAG)
+
+def home_cache_name(request):
+    return f'home:{request.get_full_path()}'
+
+def home_etag(request, *args, **kwargs):
+    return catalog_etag(home_cache_name(request), [CATALOG_TAG])
+
+def detail_tags(pk):
+    return [video_tag(pk), RECOMMENDATIONS_TAG]
+
+def detail_etag(request, pk, *args, **kwargs):
+    return catalog_etag(f'detail:{pk}', detail_tags(pk))
+
+def detail_last_modified(request, pk, *args, **kwargs):
+    modified = [
+        last_modified(video_tag(pk), lambda: Video.objects.filter(pk=pk).values_list('updated_at', flat=True).first()),
+        last_modified(RECOMMENDATIONS_TAG),
+    ]
+    return max(filter(None, modified), default=None)
+
+
 @method_decorator(csrf_protect, name='dispatch')
 class ContentView(APIView):
     permission_classes = [IsAuthenticated]
     serializer_class = ContentSerializer         
     queryset = Video.objects.all()
 
+    @method_decorator(condition(etag_func=list_etag, last_modified_func=list_last_modified))
     def get(self, request, format=None):
-        videos = Video.objects.all()
-        serializer = ContentSerializer(videos, many=True)
-        return Response(serializer.data)
+        """
+        Lists the catalog, filtered by category, is_new and is_popular. With limit or cursor the
+        list is paginated newest first, {"next": ..., "results": [...]}, otherwise it's returned whole.
+        ?fields=id,title,... or ?compact=true return only those fields, see VideoValuesSerializer.
+        The serialized responses are cached, see content.catalog_cache, and answered with 304
+        if the If-None-Match or If-Modified-Since header is still current.
+        """
+        return Response(cached_data(
+            list_cache_name(request), [CATALOG_TAG],
+            lambda: self.list_data(request)
+        ))
+
+    def list_data(self, request):
+        videos = filter_videos(Video.objects.all(), request.query_params)
+        values_serializer = VideoValuesSerializer.from_params(request.query_params)
+        if values_serializer:
+            videos = values_serializer.queryset(videos)
+            serialize = values_serializer.serialize
+        else:
+            serialize = lambda page: ContentSerializer(page, many=True).data
+
+        if 'limit' not in request.query_params and 'cursor' not in request.query_params:
+            return serialize(videos)
+
+        paginator = KeysetPagination()
+        page = paginator.paginate_queryset(videos, request, view=self)
+        return paginator.get_paginated_response(serialize(page)).data
         
     def post(self, request, *args, **kwargs):
         serializer = ContentSerializer(data=request.data)
@@ -39,10 +129,17 @@ class ContentViewPK(APIView):
     permission_classes = [AllowAny]
     serializer_class = ContentSerializer
 
+    @method_decorator(condition(etag_func=detail_etag, last_modified_func=detail_last_modified))
     def get(self, request, pk, format=None):
-        video = get_object_or_404(Video, pk=pk)
-        serializer = ContentSerializer(video)
-        return Response(serializer.data)
+        """
+        The video with its precomputed related videos, see content.recommendations.
+        """
+        return Response(cached_data(f'detail:{pk}', detail_tags(pk), lambda: self.detail_data(pk)))
+
+    def detail_data(self, pk):
+        data = ContentSerializer(get_object_or_404(Video, pk=pk)).data
+        data['related'] = related_videos(pk, VideoValuesSerializer(VideoValuesSerializer.COMPACT_FIELDS))
+        return data
         
     def put(self, request, pk, format=None):
         video = get_object_or_404(Video, pk=pk)
@@ -59,9 +156,360 @@ class ContentViewPK(APIView):
         return Response({"message": "Video deleted successfully"}, status=status.HTTP_204_NO_CONTENT)
     
 
+class HomeView(APIView):
+    """
+    The rows of the home screen: the newest videos of every category, the new and the popular
+    videos, at most ?limit= (settings.HOME_ROW_SIZE) each. The rows hold the compact fields,
+    or the ones asked for with ?fields=. They come from a single query, see VideoQuerySet.home_rows,
+    and are cached like the catalog.
+    """
+    permission_classes = [IsAuthenticated]
+
+    @method_decorator(condition(etag_func=home_etag, last_modified_func=list_last_modified))
+    def get(self, request, format=None):
+        return Response(cached_data(home_cache_name(request), [CATALOG_TAG], lambda: self.home_data(request)))
+
+    def home_data(self, request):
+        try:
+            limit = int(request.query_params.get('limit', getattr(settings, 'HOME_ROW_SIZE', 10)))
+        except ValueError:
+            raise ValidationError({'limit': 'A number is required.'})
+        limit = max(1, min(limit, 50))
+        values_serializer = (VideoValuesSerializer.from_params(request.query_params)
+                             or VideoValuesSerializer(VideoValuesSerializer.COMPACT_FIELDS))
+        rows = list(values_serializer.queryset(
+            Video.objects.home_rows(limit), 'category', 'views', 'category_rank', 'new_rank', 'popular_rank'
+        ))
+
+        new_since = date.today() - timedelta(days=NEW_DAYS)
+        labels = dict(Video.CATEGORY_CHOICES)
+        categories = {category: [] for category in labels}
+        for row in sorted(rows, key=lambda row: row['category_rank']):
+            if row['category_rank'] <= limit:
+                categories[row['category']].append(values_serializer.to_representation(row))
+        new = [row for row in sorted(rows, key=lambda row: row['new_rank'])
+               if row['new_rank'] <= limit and row['created_at'] >= new_since]
+        popular = [row for row in sorted(rows, key=lambda row: row['popular_rank'])
+                   if row['popular_rank'] <= limit and row['views'] >= POPULAR_VIEWS]
+        return {
+            'categories': [
+                {'category': category, 'label': labels[category], 'videos': videos}
+                for category, videos in categories.items() if videos
+            ],
+            'new': values_serializer.serialize(new),
+            'popular': values_serializer.serialize(popular),
+        }
+
+
+def search_text(request):
+    text = request.query_params.get('q', '').strip()
+    if not text:
+        raise ValidationError({'q': 'A search text is required.'})
+    return text[:200]
+
+
+class SearchView(APIView):
+    """
+    Full text search over titles and descriptions, ?q= in web search syntax. The matches come
+    ranked, in the compact representation (or ?fields=), paginated with limit and offset as
+    {"next": ..., "results": [...]}. Results are cached for settings.SEARCH_CACHE_TTL seconds.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, format=None):
+        text = search_text(request)
+        return Response(cached_data(
+            f'search:{request.get_host()}:{request.get_full_path()}', [CATALOG_TAG],
+            lambda: self.search_data(request, text), ttl=getattr(settings, 'SEARCH_CACHE_TTL', 60)
+        ))
+
+    def search_data(self, request, text):
+        values_serializer = (VideoValuesSerializer.from_params(request.query_params)
+                             or VideoValuesSerializer(VideoValuesSerializer.COMPACT_FIELDS))
+        videos = values_serializer.queryset(search_videos(text, filter_videos(Video.objects.all(), request.query_params)))
+        paginator = SearchPagination()
+        page = paginator.paginate_queryset(videos, request, view=self)
+        return paginator.get_paginated_response(values_serializer.serialize(page)).data
+
+
+class AutocompleteView(APIView):
+    """
+    Up to ?limit= (10) titles for search as you type, matching prefixes and typos of ?q=.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, format=None):
+        text = search_text(request)
+        try:
+            limit = max(1, min(int(request.query_params.get('limit', 10)), 20))
+        except ValueError:
+            raise ValidationError({'limit': 'A number is required.'})
+        return Response(cached_data(
+            f'autocomplete:{limit}:{text.lower()}', [CATALOG_TAG],
+            lambda: list(autocomplete_titles(text, limit)), ttl=getattr(settings, 'SEARCH_CACHE_TTL', 60)
+        ))
+
+
+class TrendingView(APIView):
+    """
+    The ?limit= (20) videos with the highest time-decayed view scores, in the compact
+    representation or ?fields=. The ranking is a range read of a Redis sorted set,
+    see content.trending.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, format=None):
+        try:
+            limit = max(1, min(int(request.query_params.get('limit', 20)), 100))
+        except ValueError:
+            raise ValidationError({'limit': 'A number is required.'})
+        return Response(cached_data(
+            f'trending:{request.get_full_path()}', [TRENDING_TAG, CATALOG_TAG],
+            lambda: self.trending_data(request, limit)
+        ))
+
+    def trending_data(self, request, limit):
+        values_serializer = (VideoValuesSerializer.from_params(request.query_params)
+                             or VideoValuesSerializer(VideoValuesSerializer.COMPACT_FIELDS))
+        video_ids = trending_ids(limit)
+        rows = {row['id']: row for row in values_serializer.queryset(Video.objects.filter(pk__in=video_ids))}
+        # Deleted videos keep their score until the next update
+        return values_serializer.serialize(rows[video_id] for video_id in video_ids if video_id in rows)
+
+
+class VideoViewCountView(APIView):
+    """
+    Counts a view of a video. The count is collected in Redis and written to the database
+    in bulk, see content.counters.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request, pk, format=None):
+        if not Video.objects.filter(pk=pk).exists():
+            return Response({'error': 'Video not found.'}, status=status.HTTP_404_NOT_FOUND)
+        add_view(pk)
+        return Response(status=status.HTTP_202_ACCEPTED)
+
+
+class VideoReactionView(APIView):
+    """
+    The like or dislike of the current user for a video. PUT {"reaction": "like"} sets it,
+    DELETE removes it. Each user counts once, see content.counters.set_reaction.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, pk, format=None):
+        return Response({'reaction': get_reaction(pk, request.user.id)})
+
+    def put(self, request, pk, format=None):
+        reaction = request.data.get('reaction')
+        if reaction not in REACTIONS:
+            return Response({'reaction': f'Must be one of {", ".join(REACTIONS)}.'}, status=status.HTTP_400_BAD_REQUEST)
+        if not Video.objects.filter(pk=pk).exists():
+            return Response({'error': 'Video not found.'}, status=status.HTTP_404_NOT_FOUND)
+        set_reaction(pk, request.user.id, reaction)
+        return Response({'reaction': reaction}, status=status.HTTP_202_ACCEPTED)
+
+    def delete(self, request, pk, format=None):
+        set_reaction(pk, request.user.id, None)
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+
+def subprofile_id(request, data):
+    """
+    The sub profile id of the request, checked to belong to the user.
+    """
+    try:
+        subprofile_id = int(data.get('subprofile'))
+    except (TypeError, ValueError):
+        raise ValidationError({'subprofile': 'A sub profile id is required.'})
+    if not owns_subprofile(request.user, subprofile_id):
+        raise NotFound('Sub profile not found.')
+    return subprofile_id
+
+
+class WatchHeartbeatView(APIView):
+    """
+    Playback heartbeat, {"subprofile": id, "position": seconds, "duration": seconds}. The position
+    is buffered in Redis and written to the database in bulk, see content.watch_progress.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request, pk, format=None):
+        subprofile = subprofile_id(request, request.data)
+        try:
+            position = float(request.data['position'])
+            duration = float(request.data['duration']) if request.data.get('duration') is not None else None
+        except (KeyError, TypeError, ValueError):
+            return Response({'position': 'Position and duration must be numbers.'}, status=status.HTTP_400_BAD_REQUEST)
+        if position < 0 or (duration is not None and duration <= 0):
+            return Response({'position': 'Position and duration must not be negative.'}, status=status.HTTP_400_BAD_REQUEST)
+        record_heartbeat(subprofile, pk, position, duration)
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+
+class ContinueWatchingView(APIView):
+    """
+    The continue watching row of ?subprofile=: the latest started and unfinished videos, newest
+    first, in the compact representation with the position and duration to resume from.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, format=None):
+        subprofile = subprofile_id(request, request.query_params)
+        try:
+            limit = max(1, min(int(request.query_params.get('limit', 20)), 100))
+        except ValueError:
+            raise ValidationError({'limit': 'A number is required.'})
+        progress = continue_watching(subprofile, limit)
+        values_serializer = VideoValuesSerializer(VideoValuesSerializer.COMPACT_FIELDS)
+        rows = {row['id']: row for row in values_serializer.queryset(Video.objects.filter(pk__in=[video_id for video_id, entry in progress]))}
+        return Response([
+            dict(values_serializer.to_representation(rows[video_id]), position=entry['position'], duration=entry['duration'])
+            for video_id, entry in progress if video_id in rows
+        ])
+
+
+class TranscodeProgressView(APIView):
+    """
+    Live transcode progress of a video. It is read from Redis only, without authentication
+    or database queries, so clients can poll it cheaply. Without Redis the status of the
+    TranscodeJob is returned.
+    """
+    authentication_classes = []
+    permission_classes = [AllowAny]
+
+    def get(self, request, pk, format=None):
+        try:
+            return Response(read_progress(pk))
+        except RedisError as e:
+            print(f'Transcode progress unavailable: {e}')
+        # Without Redis only the persisted status is known
+        job = TranscodeJob.objects.filter(video_id=pk).order_by('-updated_at').first()
+        return Response({
+            'status': job.status if job else 'unknown',
+            'updated_at': job.updated_at.timestamp() if job else None,
+            'renditions': {},
+        })
+
+
+class SegmentCacheStatsView(APIView):
+    """
+    Hit and miss counters of the segment cache of the answering web process.
+    """
+    permission_classes = [IsAdminUser]
+
+    def get(self, request, format=None):
+        return Response(segment_cache.stats())
+
+
+class CatalogExportView(APIView):
+    """
+    Streams the catalog as NDJSON (default) or CSV, ?type=csv. The rows are read in chunks
+    while the response is sent, so the export never holds the catalog in memory.
+    """
+    permission_classes = [IsAdminUser]
+
+    def get(self, request, format=None):
+        export_type = request.query_params.get('type', 'ndjson')
+        if export_type not in FORMATS:
+            raise ValidationError({'type': f'Must be one of {", ".join(FORMATS)}.'})
+        response = StreamingHttpResponse(export_lines(export_type), content_type=CONTENT_TYPES[export_type])
+        response['Content-Disposition'] = f'attachment; filename="catalog.{export_type}"'
+        return response
+
+
+def upload_headers(session):
+    return {'Upload-Offset': str(session.offset), 'Upload-Length': str(session.length)}
+
+
+class UploadSessionView(APIView):
+    """
+    Starts a resumable upload. The chunks are sent to the returned Location with PATCH.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request, format=None):
+        serializer = UploadSessionSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        session = serializer.save(user=request.user)
+        create_staging_file(session)
+        schedule_cleanup()
+        headers = upload_headers(session)
+        headers['Location'] = request.build_absolute_uri(reverse('upload_detail', kwargs={'pk': session.pk}))
+        return Response(serializer.data, status=status.HTTP_201_CREATED, headers=headers)
+
+
+class UploadSessionDetailView(APIView):
+    """
+    tus-style resumable upload. HEAD/GET report the offset to resume from, PATCH appends the
+    request body at the Upload-Offset header, which has to match the stored offset. The chunk
+    is streamed to the staging file, so neither the request nor the file is held in memory.
+    The Video is created and its conversion enqueued once the last byte has arrived, an empty
+    PATCH retries that if it failed. Unfinished uploads expire after settings.UPLOAD_SESSION_TTL seconds without a chunk.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, pk, format=None):
+        session = get_object_or_404(UploadSession.live(), pk=pk, user=request.user)
+        return Response(UploadSessionSerializer(session).data, headers=upload_headers(session))
+
+    def patch(self, request, pk, format=None):
+        if request.content_type != 'application/offset+octet-stream':
+            return Response({'error': 'Chunks must be sent as application/offset+octet-stream.'},
+                            status=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+        try:
+            offset = int(request.headers['Upload-Offset'])
+            chunk_length = int(request.META.get('CONTENT_LENGTH') or 0)
+        except (KeyError, ValueError):
+            return Response({'error': 'Upload-Offset header is missing or invalid.'}, status=status.HTTP_400_BAD_REQUEST)
+
+        # The row lock is only held to check the offset and claim the upload; the chunk is received
+        # without it, concurrent requests for the same upload are refused until it is stored.
+        with transaction.atomic():
+            session = get_object_or_404(UploadSession.live().select_for_update(), pk=pk, user=request.user)
+            if session.video_id:
+                return Response({'error': 'Upload is already complete.'}, status=status.HTTP_409_CONFLICT,
+                                headers=upload_headers(session))
+            if offset != session.offset:
+                return Response({'error': 'Upload-Offset does not match the received bytes.'},
+                                status=status.HTTP_409_CONFLICT, headers=upload_headers(session))
+            if offset + chunk_length > session.length:
+                return Response({'error': 'Chunk exceeds the upload length.'}, status=status.HTTP_400_BAD_REQUEST,
+                                headers=upload_headers(session))
+            # An empty PATCH of a finished upload retries a completion that failed.
+            if not chunk_length and not session.is_complete():
+                return Response(status=status.HTTP_204_NO_CONTENT, headers=upload_headers(session))
+            writer = claim_writer(session)
+            if writer is None:
+                return Response({'error': 'Another chunk is being received.'}, status=status.HTTP_409_CONFLICT,
+                                headers=upload_headers(session))
+
+        digest = None
+        if chunk_length:
+            digest = append_chunk(session, writer, request.stream, chunk_length)
+            if digest is None:
+                session.refresh_from_db()
+                return Response({'error': 'Another chunk is being received.'}, status=status.HTTP_409_CONFLICT,
+                                headers=upload_headers(session))
+            if not session.is_complete():
+                return Response(status=status.HTTP_204_NO_CONTENT, headers=upload_headers(session))
+        complete_upload(session, writer, digest)
+
+        return Response(UploadSessionSerializer(session).data, status=status.HTTP_201_CREATED,
+                        headers=upload_headers(session))
+
+    def delete(self, request, pk, format=None):
+        session = get_object_or_404(UploadSession, pk=pk, user=request.user)
+        if not session.video_id:
+            delete_staging_file(session)
+        session.delete()
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+
 # class VideoDeleteView(APIView):
 #     def delete(self, request, video_id, format=None):
 #         video = get_object_or_404(Video, id=video_id)
 #         video.delete()  # Löscht das Video und löst das post_delete-Signal aus
 #         return Response({"message": "Video deleted successfully"}, status=status.HTTP_204_NO_CONTENT)
-        
\ No newline at end of file
@@ -1,4 +1,5 @@
 from django.apps import AppConfig
+from django.db.models.signals import pre_migrate
 
 
 class ContentConfig(AppConfig):
@@ -7,4 +8,5 @@ class ContentConfig(AppConfig):
 
     def ready(self):
         import content.signals
+        pre_migrate.connect(content.signals.create_extensions, sender=self)
         print("ContentConfig ready method executed")
@@ -0,0 +1,128 @@
+import hashlib
+import time
+from datetime import datetime, timezone
+from django.conf import settings
+from django.core.cache import cache
+from django_redis.exceptions import ConnectionInterrupted
+from redis.exceptions import RedisError
+
+CACHE_ERRORS = (RedisError, ConnectionInterrupted)
+
+TAG_KEY = 'catalog:tag:{tag}'
+MODIFIED_KEY = 'catalog:modified:{tag}'
+CATALOG_TAG = 'catalog'
+
+
+def video_tag(video_id):
+    return f'video:{video_id}'
+
+def initial_version():
+    # Versions start from the clock, so they don't repeat ETags handed out before the cache was flushed.
+    return int(time.time() * 1000)
+
+def tag_versions(tags):
+    keys = [TAG_KEY.format(tag=tag) for tag in tags]
+    versions = cache.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            cache.add(key, initial_version(), timeout=None)
+            versions[key] = cache.get(key)
+    return [versions[key] for key in keys]
+
+def versioned_key(name, tags):
+    return hashlib.md5(f'{name}:{tag_versions(tags)}'.encode()).hexdigest()
+
+def catalog_etag(name, tags):
+    """
+    ETag of the response cached under name, it changes with every bump of one of its tags.
+    None if the cache is unavailable, the response is then sent without validators.
+    """
+    try:
+        return f'"{versioned_key(name, tags)}"'
+    except CACHE_ERRORS as e:
+        print(f'Catalog cache unavailable: {e}')
+        return None
+
+def last_modified(tag, default=None):
+    """
+    Time of the last bump of tag. Unknown times are taken from default() or the current time,
+    which is never earlier than a Last-Modified handed out before.
+    """
+    key = MODIFIED_KEY.format(tag=tag)
+    try:
+        timestamp = cache.get(key)
+        if timestamp is None:
+            modified = default() if default else None
+            cache.add(key, modified.timestamp() if modified else time.time(), timeout=None)
+            timestamp = cache.get(key)
+    except CACHE_ERRORS as e:
+        print(f'Catalog cache unavailable: {e}')
+        return None
+    return datetime.fromtimestamp(timestamp, tz=timezone.utc) if timestamp is not None else None
+
+def bump(*tags):
+    """
+    Invalidates every cached response tagged with one of the tags by moving the tag to a new version.
+    """
+    try:
+        for tag in tags:
+            key = TAG_KEY.format(tag=tag)
+            cache.add(key, initial_version(), timeout=None)
+            cache.incr(key)
+            cache.set(MODIFIED_KEY.format(tag=tag), time.time(), timeout=None)
+    except CACHE_ERRORS as e:
+        print(f'Could not invalidate catalog cache {tags}: {e}')
+
+def bump_video(video_id):
+    bump(CATALOG_TAG, video_tag(video_id))
+
+def cached_data(name, tags, compute, ttl=None):
+    """
+    Returns the response data cached under name and the versions of its tags, or computes it.
+    Entries are fresh for ttl (settings.CACHE_TTL) seconds and served stale for settings.CATALOG_CACHE_STALE_TTL
+    seconds more. Only the request that gets the lock recomputes an expired entry, the others keep
+    serving the stale one (or wait for the first one on a miss), so an expiry doesn't hit the database
+    with every concurrent request.
+    """
+    ttl = getattr(settings, 'CACHE_TTL', 60 * 15) if ttl is None else ttl
+    stale_ttl = getattr(settings, 'CATALOG_CACHE_STALE_TTL', 60 * 5)
+    lock_timeout = getattr(settings, 'CATALOG_CACHE_LOCK_TIMEOUT', 10)
+    try:
+        key = 'catalog:' + versioned_key(name, tags)
+        entry = cache.get(key)
+        if entry and entry['fresh_until'] > time.time():
+            return entry['data']
+
+        lock_key = f'{key}:lock'
+        if not cache.add(lock_key, 1, timeout=lock_timeout):
+            if entry:
+                return entry['data']
+            entry = wait_for_entry(key, getattr(settings, 'CATALOG_CACHE_WAIT', 2))
+            if entry:
+                return entry['data']
+            return compute()
+    except CACHE_ERRORS as e:
+        print(f'Catalog cache unavailable: {e}')
+        return compute()
+
+    try:
+        data = compute()
+        try:
+            cache.set(key, {'data': data, 'fresh_until': time.time() + ttl}, timeout=ttl + stale_ttl)
+        except CACHE_ERRORS as e:
+            print(f'Could not cache {name}: {e}')
+        return data
+    finally:
+        try:
+            cache.delete(lock_key)
+        except CACHE_ERRORS:
+            pass
+
+def wait_for_entry(key, timeout, interval=0.05):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        time.sleep(interval)
+        entry = cache.get(key)
+        if entry:
+            return entry
+    return None
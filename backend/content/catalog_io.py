@@ -0,0 +1,126 @@
+import csv
+import json
+from itertools import islice
+from django.core.exceptions import ValidationError
+from django.core.management.color import no_style
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection, transaction
+from content.catalog_cache import CATALOG_TAG, bump, video_tag
+from content.models import Video
+from content.recommendations import mark_changed
+
+FORMATS = ('ndjson', 'csv')
+CONTENT_TYPES = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv'}
+CHUNK_SIZE = 2000
+
+
+def export_fields():
+    """
+    The stored fields of Video, files as their storage names. The generated search vector is left out.
+    """
+    return [field.name for field in Video._meta.concrete_fields if not field.generated]
+
+
+class Echo:
+    """
+    File-like object that returns what is written to it, so csv.writer can produce lines for a stream.
+    """
+
+    def write(self, value):
+        return value
+
+
+def export_lines(format='ndjson', videos=None, chunk_size=CHUNK_SIZE):
+    """
+    Yields the catalog as NDJSON or CSV lines. Rows are read with a server side cursor,
+    chunk_size at a time, so memory use doesn't grow with the catalog.
+    """
+    fields = export_fields()
+    videos = (Video.objects.all() if videos is None else videos).order_by('id').values_list(*fields)
+    if format == 'csv':
+        writer = csv.writer(Echo())
+        yield writer.writerow(fields)
+        for row in videos.iterator(chunk_size=chunk_size):
+            yield writer.writerow(row)
+    else:
+        encoder = DjangoJSONEncoder()
+        for row in videos.iterator(chunk_size=chunk_size):
+            yield encoder.encode(dict(zip(fields, row))) + '\n'
+
+
+def read_records(lines, format='ndjson'):
+    """
+    Parses NDJSON or CSV lines into dicts, one at a time.
+    """
+    if format == 'csv':
+        yield from csv.DictReader(lines)
+    else:
+        for number, line in enumerate(lines, start=1):
+            if line.strip():
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError as e:
+                    raise ValueError(f'Line {number}: {e}')
+                if not isinstance(record, dict):
+                    raise ValueError(f'Line {number}: not an object')
+                yield record
+
+
+def build_video(record, fields, number):
+    values = {}
+    for name, value in record.items():
+        field = fields.get(name)
+        if field is None:
+            continue
+        if value == '' and (field.null or field.primary_key):
+            value = None
+        try:
+            values[name] = field.to_python(value)
+        except ValidationError as e:
+            raise ValueError(f'Record {number}: {name}: {"; ".join(e.messages)}')
+    return Video(**values)
+
+
+def import_records(records, batch_size=CHUNK_SIZE):
+    """
+    Creates the videos of the records with one bulk_create per batch_size records. Records with
+    the id of an existing video update it, so an export can be imported again. The records are
+    read one batch at a time, so memory use doesn't grow with the file. Returns the number of
+    imported videos. An invalid record raises ValueError, the batches before it stay imported.
+
+    bulk_create sends no signals, no conversions are enqueued; the caches and the related
+    videos are refreshed per batch.
+    """
+    fields = {name: Video._meta.get_field(name) for name in export_fields()}
+    update_fields = [name for name in fields if name != 'id']
+    records = iter(records)
+    imported = 0
+    while True:
+        batch = [build_video(record, fields, imported + offset + 1) for offset, record in enumerate(islice(records, batch_size))]
+        if not batch:
+            break
+        with transaction.atomic():
+            with_id = [video for video in batch if video.id is not None]
+            without_id = [video for video in batch if video.id is None]
+            if with_id:
+                Video.objects.bulk_create(with_id, update_conflicts=True, unique_fields=['id'], update_fields=update_fields)
+            if without_id:
+                Video.objects.bulk_create(without_id)
+            if with_id:
+                reset_id_sequence()
+        video_ids = [video.id for video in batch if video.id is not None]
+        bump(CATALOG_TAG, *[video_tag(video_id) for video_id in video_ids])
+        mark_changed(*video_ids)
+        imported += len(batch)
+    return imported
+
+
+def reset_id_sequence():
+    """
+    Moves the id sequence past imported ids, so later inserts don't collide with them.
+    """
+    statements = connection.ops.sequence_reset_sql(no_style(), [Video])
+    if statements:
+        with connection.cursor() as cursor:
+            for statement in statements:
+                cursor.execute(statement)
@@ -0,0 +1,191 @@
+import redis
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Case, F, IntegerField, Value, When
+from django_redis import get_redis_connection
+from content.catalog_cache import CATALOG_TAG, bump, video_tag
+from content.models import Video, VideoReaction
+from content.scheduling import job_started, schedule_once
+from content.trending import count_view, schedule_update
+
+COUNTER_FIELDS = ('views', 'likes', 'dislikes')
+REACTIONS = {'like': 'likes', 'dislike': 'dislikes'}
+
+DELTA_KEY = 'videoflix:counters:{video_id}'
+DIRTY_KEY = 'videoflix:counters:dirty'
+FLUSH_SCHEDULED_KEY = 'videoflix:counters:flush-scheduled'
+
+
+def delta_key(video_id):
+    return DELTA_KEY.format(video_id=video_id)
+
+
+def add_view(video_id):
+    """
+    Counts a view in Redis, flush_counters writes it to the database later. Without Redis the
+    view is written directly. The view is counted for the trending scores as well.
+    """
+    try:
+        pipeline = get_redis_connection('default').pipeline()
+        pipeline.hincrby(delta_key(video_id), 'views', 1)
+        pipeline.sadd(DIRTY_KEY, video_id)
+        count_view(pipeline, video_id)
+        pipeline.execute()
+    except redis.RedisError as e:
+        print(f'Error counting view of video {video_id} in Redis: {e}')
+        Video.objects.filter(pk=video_id).update(views=F('views') + 1)
+        return
+    schedule_flush()
+    schedule_update()
+
+
+def add_deltas(video_id, deltas):
+    """
+    Adds counter deltas of a video to Redis, flush_counters writes them to the database later.
+    Without Redis they are written directly.
+    """
+    try:
+        pipeline = get_redis_connection('default').pipeline()
+        for field, value in deltas.items():
+            pipeline.hincrby(delta_key(video_id), field, value)
+        pipeline.sadd(DIRTY_KEY, video_id)
+        pipeline.execute()
+    except redis.RedisError as e:
+        print(f'Error counting reaction to video {video_id} in Redis: {e}')
+        Video.objects.filter(pk=video_id).update(**{field: F(field) + value for field, value in deltas.items()})
+        return
+    schedule_flush()
+
+
+def update_reaction(video_id, user_id, reaction):
+    current = VideoReaction.objects.select_for_update().filter(video_id=video_id, user_id=user_id).first()
+    old = current.reaction if current else None
+    if old == reaction:
+        return False
+    if current is None:
+        VideoReaction.objects.create(video_id=video_id, user_id=user_id, reaction=reaction)
+    elif reaction:
+        current.reaction = reaction
+        current.save(update_fields=['reaction', 'updated_at'])
+    else:
+        current.delete()
+
+    deltas = {}
+    if reaction:
+        deltas[REACTIONS[reaction]] = 1
+    if old:
+        deltas[REACTIONS[old]] = -1
+    add_deltas(video_id, deltas)
+    return True
+
+
+def set_reaction(video_id, user_id, reaction):
+    """
+    Sets the reaction ('like', 'dislike' or None to remove it) of a user to a video. Every user
+    has at most one reaction per video, a VideoReaction row, so repeating a like doesn't count
+    it again and switching from like to dislike moves the count. The row is locked while the
+    counters change. Returns False if nothing changed.
+    """
+    try:
+        with transaction.atomic():
+            return update_reaction(video_id, user_id, reaction)
+    except IntegrityError:
+        # A concurrent request created the row first, now it can be locked.
+        with transaction.atomic():
+            return update_reaction(video_id, user_id, reaction)
+
+
+def get_reaction(video_id, user_id):
+    return VideoReaction.objects.filter(video_id=video_id, user_id=user_id).values_list('reaction', flat=True).first()
+
+
+def pending_counts(video_id):
+    """
+    The counts not yet written to the database.
+    """
+    deltas = get_redis_connection('default').hgetall(delta_key(video_id))
+    counts = {field: 0 for field in COUNTER_FIELDS}
+    counts.update({field.decode(): int(value) for field, value in deltas.items()})
+    return counts
+
+
+def schedule_flush():
+    """
+    Enqueues flush_counters settings.COUNTER_FLUSH_INTERVAL seconds from now, unless it already is.
+    """
+    schedule_once(FLUSH_SCHEDULED_KEY, getattr(settings, 'COUNTER_FLUSH_INTERVAL', 60), flush_counters)
+
+
+def take_deltas(connection, batch_size):
+    """
+    Removes up to batch_size dirty videos and their deltas from Redis, None if there are none.
+    Reading and deleting a delta hash happen in one MULTI, so no increment is lost in between.
+    """
+    video_ids = [int(video_id) for video_id in connection.spop(DIRTY_KEY, batch_size) or []]
+    if not video_ids:
+        return None
+    pipeline = connection.pipeline()
+    for video_id in video_ids:
+        pipeline.hgetall(delta_key(video_id))
+        pipeline.delete(delta_key(video_id))
+    results = pipeline.execute()
+    deltas = {}
+    for video_id, values in zip(video_ids, results[::2]):
+        values = {field.decode(): int(value) for field, value in values.items()}
+        if any(values.values()):
+            deltas[video_id] = values
+    return deltas
+
+
+def restore_deltas(connection, deltas):
+    pipeline = connection.pipeline()
+    for video_id, values in deltas.items():
+        for field, value in values.items():
+            pipeline.hincrby(delta_key(video_id), field, value)
+        pipeline.sadd(DIRTY_KEY, video_id)
+    pipeline.execute()
+
+
+def apply_deltas(deltas):
+    """
+    Adds the deltas to the counters of all videos in one UPDATE, with F() expressions, so
+    concurrent writes to the rows aren't overwritten.
+    """
+    updates = {}
+    for field in COUNTER_FIELDS:
+        whens = [When(pk=video_id, then=Value(values[field])) for video_id, values in deltas.items() if values.get(field)]
+        if whens:
+            updates[field] = F(field) + Case(*whens, default=Value(0), output_field=IntegerField())
+    if updates:
+        Video.objects.filter(pk__in=list(deltas)).update(**updates)
+
+
+def flush_counters():
+    """
+    Writes the counter deltas collected in Redis to the database, in batches of
+    settings.COUNTER_FLUSH_BATCH_SIZE videos. Deltas of a failed batch are put back.
+    Increments arriving during or after the flush schedule the next one. The details of the flushed
+    videos and, once per flush, the catalog are invalidated, so lists and the popular row of the home
+    screen get new ETags at most every settings.COUNTER_FLUSH_INTERVAL seconds.
+    """
+    job_started(FLUSH_SCHEDULED_KEY)
+    connection = get_redis_connection('default')
+    batch_size = getattr(settings, 'COUNTER_FLUSH_BATCH_SIZE', 500)
+    flushed = 0
+    while True:
+        deltas = take_deltas(connection, batch_size)
+        if deltas is None:
+            break
+        try:
+            with transaction.atomic():
+                apply_deltas(deltas)
+        except Exception:
+            restore_deltas(connection, deltas)
+            schedule_flush()
+            raise
+        bump(*[video_tag(video_id) for video_id in deltas])
+        flushed += len(deltas)
+    if flushed:
+        bump(CATALOG_TAG)
+    print(f'Flushed counters of {flushed} videos')
+    return flushed
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand, CommandError
+from content.catalog_io import CHUNK_SIZE, FORMATS, export_lines
+
+
+class Command(BaseCommand):
+    help = 'Writes the video catalog as NDJSON or CSV to a file or stdout, streamed in chunks.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', choices=FORMATS, default='ndjson')
+        parser.add_argument('--output', help='File to write to, stdout if left out.')
+        parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+
+    def handle(self, *args, **options):
+        lines = export_lines(options['format'], chunk_size=options['chunk_size'])
+        if not options['output']:
+            for line in lines:
+                self.stdout.write(line, ending='')
+            return
+        try:
+            with open(options['output'], 'w', newline='', encoding='utf-8') as f:
+                f.writelines(lines)
+        except OSError as e:
+            raise CommandError(f'Cannot write {options["output"]}: {e}')
+        self.stderr.write(f'Exported the catalog to {options["output"]}')
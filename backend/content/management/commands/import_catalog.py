@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand, CommandError
+from content.catalog_io import CHUNK_SIZE, FORMATS, import_records, read_records
+
+
+class Command(BaseCommand):
+    help = 'Imports videos from an NDJSON or CSV export, with one bulk_create per batch.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument('--format', choices=FORMATS, help='Taken from the file extension if left out.')
+        parser.add_argument('--batch-size', type=int, default=CHUNK_SIZE)
+
+    def handle(self, *args, **options):
+        path = options['path']
+        format = options['format'] or ('csv' if path.endswith('.csv') else 'ndjson')
+        try:
+            with open(path, newline='', encoding='utf-8') as f:
+                imported = import_records(read_records(f, format), batch_size=options['batch_size'])
+        except OSError as e:
+            raise CommandError(f'Cannot read {path}: {e}')
+        except ValueError as e:
+            raise CommandError(f'Invalid record in {path}: {e}')
+        self.stdout.write(f'Imported {imported} videos')
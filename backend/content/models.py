@@ -1,7 +1,104 @@
 from unicodedata import category
-from django.db import models
+from django.conf import settings
+from django.db import models, transaction
+from django.db.models import F, Q, Window
+from django.db.models.functions import RowNumber
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVector, SearchVectorField
+from django.utils import timezone
 from datetime import date, timedelta
 import os
+import uuid
+from content.segment_cache import evict_output
+
+
+class HlsOutput(models.Model):
+    """
+    A converted HLS output directory. Uploads with the same source digest share one output,
+    ref_count is the number of videos using it.
+    """
+    source_digest = models.CharField(max_length=64, unique=True)
+    hls_playlist = models.CharField(max_length=255)
+    ref_count = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return self.hls_playlist
+
+    @classmethod
+    def acquire(cls, source_digest):
+        """
+        Adds an owner to the output of this digest. Returns None if there is no output yet.
+        """
+        with transaction.atomic():
+            output = cls.objects.select_for_update().filter(source_digest=source_digest).first()
+            if output:
+                output.ref_count += 1
+                output.save(update_fields=['ref_count'])
+            return output
+
+    @classmethod
+    def register(cls, source_digest, hls_playlist):
+        """
+        Records a freshly converted output with its first owner. If another upload of the same
+        content finished first, its output is acquired and returned instead.
+        """
+        output, created = cls.objects.get_or_create(
+            source_digest=source_digest,
+            defaults={'hls_playlist': hls_playlist, 'ref_count': 1}
+        )
+        return output if created else cls.acquire(source_digest)
+
+    @classmethod
+    def release(cls, hls_playlist):
+        """
+        Removes an owner. Returns True if nobody uses the output anymore and its files can be deleted.
+        Keyed on the playlist, the one thing every owner of the output shares. An output without a row
+        was never registered, e.g. converted before deduplication, and has a single owner.
+        """
+        with transaction.atomic():
+            output = cls.objects.select_for_update().filter(hls_playlist=hls_playlist).first()
+            if output is None:
+                return True
+            if output.ref_count <= 1:
+                output.delete()
+                return True
+            output.ref_count -= 1
+            output.save(update_fields=['ref_count'])
+            return False
+
+
+NEW_DAYS = 30
+POPULAR_VIEWS = 10
+
+
+class VideoQuerySet(models.QuerySet):
+
+    def new(self):
+        """
+        Videos created within the last NEW_DAYS days, see Video.is_new.
+        """
+        return self.filter(created_at__gte=date.today() - timedelta(days=NEW_DAYS))
+
+    def popular(self):
+        """
+        Videos with at least POPULAR_VIEWS views, see Video.is_popular.
+        """
+        return self.filter(views__gte=POPULAR_VIEWS)
+
+    def home_rows(self, limit):
+        """
+        The newest limit videos of every category plus the newest and the most viewed limit videos
+        overall, in one query. Each video is annotated with its rank in the three orderings,
+        the rows still have to be checked against the new and popular thresholds.
+        """
+        newest = [F('created_at').desc(), F('id').desc()]
+        return self.annotate(
+            category_rank=Window(RowNumber(), partition_by=[F('category')], order_by=newest),
+            new_rank=Window(RowNumber(), order_by=newest),
+            popular_rank=Window(RowNumber(), order_by=[F('views').desc(), F('id').desc()]),
+        ).filter(Q(category_rank__lte=limit) | Q(new_rank__lte=limit) | Q(popular_rank__lte=limit))
+
 
 class Video(models.Model):
     CATEGORY_CHOICES = [
@@ -22,6 +119,7 @@ class Video(models.Model):
     title = models.CharField(max_length=100)
     description = models.TextField()
     created_at = models.DateField(default=date.today)
+    updated_at = models.DateTimeField(auto_now=True)
     likes = models.IntegerField(default=0)
     dislikes = models.IntegerField(default=0)
     views = models.IntegerField(default=0)
@@ -29,25 +127,79 @@ class Video(models.Model):
     thumbnail = models.ImageField(upload_to='thumbnails/', null=True, blank=True)
     category = models.CharField(max_length=100, choices=CATEGORY_CHOICES, default='music')
     hls_playlist = models.CharField(max_length=255, blank=True, null=True)
+    sprites_vtt = models.CharField(max_length=255, blank=True, null=True)
+    source_width = models.PositiveIntegerField(blank=True, null=True)
+    source_height = models.PositiveIntegerField(blank=True, null=True)
+    source_fps = models.FloatField(blank=True, null=True)
+    duration = models.FloatField(blank=True, null=True)
+    video_codec = models.CharField(max_length=50, blank=True, default='')
+    audio_codec = models.CharField(max_length=50, blank=True, default='')
+    has_audio = models.BooleanField(blank=True, null=True)
+    source_digest = models.CharField(max_length=64, blank=True, null=True, db_index=True)
+    # Kept up to date by Postgres, see content.search
+    search_vector = models.GeneratedField(
+        expression=(
+            SearchVector('title', weight='A', config=settings.SEARCH_CONFIG)
+            + SearchVector('description', weight='B', config=settings.SEARCH_CONFIG)
+        ),
+        output_field=SearchVectorField(),
+        db_persist=True,
+    )
+
+    objects = VideoQuerySet.as_manager()
+
+    class Meta:
+        # The catalog is paginated on (created_at, id), see content.api.pagination,
+        # the home screen also ranks by views, see VideoQuerySet.home_rows
+        indexes = [
+            models.Index(fields=['-created_at', '-id'], name='video_created_idx'),
+            models.Index(fields=['category', '-created_at', '-id'], name='video_category_created_idx'),
+            models.Index(fields=['-created_at', '-id'], condition=models.Q(views__gte=POPULAR_VIEWS), name='video_popular_created_idx'),
+            models.Index(fields=['-views', '-id'], name='video_views_idx'),
+            GinIndex(fields=['search_vector'], name='video_search_idx'),
+            # Needs the pg_trgm extension, created before migrate by signals.create_extensions
+            GinIndex(fields=['title'], opclasses=['gin_trgm_ops'], name='video_title_trgm_idx'),
+        ]
 
     def __str__(self):
         return self.title
 
     def is_new(self):
-        return date.today() - self.created_at <= timedelta(days=30)
+        return date.today() - self.created_at <= timedelta(days=NEW_DAYS)
     
     def is_popular(self):
-        return self.views >= 10
+        return self.views >= POPULAR_VIEWS
+    
+    def save(self, *args, **kwargs):
+        if self.video_file and not self.video_file._committed and not self.hls_playlist:
+            # Set by the hashing upload handlers while the file was received. Once the video has
+            # an output, the digest stays the one that output is registered under.
+            self.source_digest = getattr(self.video_file.file, 'source_digest', self.source_digest)
+        super().save(*args, **kwargs)
+
+    def hls_directory(self):
+        """
+        Returns the directory on disk that holds the HLS files of this video.
+        """
+        if not self.hls_playlist:
+            return None
+        relative_path = self.hls_playlist.lstrip('/')
+        media_prefix = settings.MEDIA_URL.strip('/') + '/'
+        if relative_path.startswith(media_prefix):
+            relative_path = relative_path[len(media_prefix):]
+        return os.path.join(settings.MEDIA_ROOT, os.path.dirname(relative_path))
     
     def delete(self, *args, **kwargs):
         video_path = self.video_file.path if self.video_file and hasattr(self.video_file, 'path') else None
         thumbnail_path = self.thumbnail.path if self.thumbnail and hasattr(self.thumbnail, 'path') else None
         
-        hls_dir = None
-        if self.hls_playlist and os.path.exists(self.hls_playlist):
-            hls_dir = os.path.dirname(self.hls_playlist)
-        
-        result = super().delete(*args, **kwargs)
+        with transaction.atomic():
+            hls_dir = self.hls_directory()
+            if hls_dir and not HlsOutput.release(self.hls_playlist):
+                print(f"HLS directory still used by other videos: {hls_dir}")
+                hls_dir = None
+
+            result = super().delete(*args, **kwargs)
         
         if video_path and os.path.isfile(video_path):
             os.remove(video_path)
@@ -60,6 +212,165 @@ class Video(models.Model):
         if hls_dir and os.path.isdir(hls_dir):
             import shutil
             shutil.rmtree(hls_dir)
+            evict_output(hls_dir)
             print(f"HLS directory deleted: {hls_dir}")
             
-        return result
\ No newline at end of file
+        return result
+
+
+class RelatedVideo(models.Model):
+    """
+    One of the precomputed "more like this" neighbours of a video, see content.recommendations.
+    """
+    video = models.ForeignKey(Video, on_delete=models.CASCADE, related_name='related_videos')
+    related = models.ForeignKey(Video, on_delete=models.CASCADE, related_name='related_to')
+    rank = models.PositiveSmallIntegerField()
+    score = models.FloatField()
+
+    class Meta:
+        # The detail view reads the neighbours of a video in rank order from this index
+        constraints = [
+            models.UniqueConstraint(fields=['video', 'rank'], name='related_video_rank_unique'),
+        ]
+
+    def __str__(self):
+        return f'{self.video_id} -> {self.related_id} ({self.score:.3f})'
+
+
+class WatchProgress(models.Model):
+    """
+    Playback position of a video per sub profile. Heartbeats are buffered in Redis and
+    written here in bulk, see content.watch_progress.
+    """
+    subprofile = models.ForeignKey('sub_profiles.SubProfile', on_delete=models.CASCADE, related_name='watch_progress')
+    video = models.ForeignKey(Video, on_delete=models.CASCADE, related_name='watch_progress')
+    position = models.FloatField()
+    duration = models.FloatField(blank=True, null=True)
+    updated_at = models.DateTimeField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['subprofile', 'video'], name='watch_progress_unique'),
+        ]
+        # The continue watching row reads the latest positions of a sub profile
+        indexes = [
+            models.Index(fields=['subprofile', '-updated_at'], name='watch_progress_recent_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.subprofile_id} watched {self.video_id} up to {self.position:.0f}s'
+
+
+class VideoReaction(models.Model):
+    """
+    The like or dislike of a user for a video. A user has at most one reaction per video, so it
+    is counted once. The counters on Video are updated write-behind, see content.counters.
+    """
+    REACTION_CHOICES = [
+        ('like', 'Like'),
+        ('dislike', 'Dislike'),
+    ]
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='video_reactions')
+    video = models.ForeignKey(Video, on_delete=models.CASCADE, related_name='reactions')
+    reaction = models.CharField(max_length=7, choices=REACTION_CHOICES)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'video'], name='video_reaction_unique'),
+        ]
+
+    def __str__(self):
+        return f'{self.user_id} {self.reaction}s {self.video_id}'
+
+
+class TranscodeJob(models.Model):
+    """
+    Persisted record of a transcode job. The job id is derived from the video and its source digest,
+    so enqueueing the same conversion twice finds this record instead of starting a second encode.
+    """
+    STATUS_CHOICES = [
+        ('queued', 'Queued'),
+        ('running', 'Running'),
+        ('finished', 'Finished'),
+        ('failed', 'Failed'),
+    ]
+    ACTIVE_STATUSES = ('queued', 'running')
+
+    job_id = models.CharField(max_length=100, unique=True)
+    video = models.ForeignKey(Video, on_delete=models.CASCADE, related_name='transcode_jobs')
+    source_digest = models.CharField(max_length=64, blank=True, default='')
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='queued')
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f'{self.job_id} ({self.status})'
+
+    def is_active(self):
+        return self.status in self.ACTIVE_STATUSES
+
+    @staticmethod
+    def job_id_for(video):
+        digest = (video.source_digest or 'nodigest')[:16]
+        return f'transcode-{video.id}-{digest}'
+
+    @classmethod
+    def in_flight(cls, video_id):
+        """
+        Returns the queued or running job of a video, or None.
+        """
+        return cls.objects.filter(video_id=video_id, status__in=cls.ACTIVE_STATUSES).first()
+
+    @classmethod
+    def update_status(cls, video_id, status):
+        """
+        Moves the active jobs of a video to a new status.
+        """
+        return cls.objects.filter(video_id=video_id, status__in=cls.ACTIVE_STATUSES).update(
+            status=status, updated_at=timezone.now()
+        )
+
+
+
+class UploadSession(models.Model):
+    """
+    A resumable upload. Chunks are appended to a staging file, offset is the number of bytes
+    received so far and block_digests the finished blocks of their SourceDigest. The Video is
+    created once all length bytes have arrived. writer is the token of the request receiving a
+    chunk or creating the Video, until writer_expires_at. Unfinished uploads expire after settings.UPLOAD_SESSION_TTL
+    seconds without a chunk.
+    """
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='upload_sessions')
+    filename = models.CharField(max_length=255)
+    length = models.PositiveBigIntegerField()
+    offset = models.PositiveBigIntegerField(default=0)
+    block_digests = models.TextField(blank=True, default='')
+    metadata = models.JSONField(default=dict, blank=True)
+    video = models.ForeignKey(Video, on_delete=models.SET_NULL, blank=True, null=True, related_name='+')
+    writer = models.UUIDField(blank=True, null=True, editable=False)
+    writer_expires_at = models.DateTimeField(blank=True, null=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f'{self.filename} ({self.offset}/{self.length})'
+
+    @staticmethod
+    def expiry_cutoff():
+        return timezone.now() - timedelta(seconds=getattr(settings, 'UPLOAD_SESSION_TTL', 60 * 60 * 24))
+
+    @classmethod
+    def live(cls):
+        """
+        Finished uploads and the unfinished ones that haven't expired yet.
+        """
+        return cls.objects.filter(Q(video__isnull=False) | Q(updated_at__gte=cls.expiry_cutoff()))
+
+    @classmethod
+    def expired(cls):
+        return cls.objects.filter(video__isnull=True, updated_at__lt=cls.expiry_cutoff())
+
+    def is_complete(self):
+        return self.offset == self.length
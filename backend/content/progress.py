@@ -0,0 +1,100 @@
+import json
+import time
+import redis
+from django.conf import settings
+from django_redis import get_redis_connection
+
+PROGRESS_KEY = 'videoflix:transcode:{video_id}'
+PROGRESS_TTL = 60 * 60 * 24
+
+
+def progress_key(video_id):
+    return PROGRESS_KEY.format(video_id=video_id)
+
+
+def write_progress(video_id, mapping):
+    """
+    Stores fields in the progress hash of a video. Progress is only informative,
+    so Redis errors are logged and never fail the transcode.
+    """
+    try:
+        connection = get_redis_connection('default')
+        pipeline = connection.pipeline()
+        pipeline.hset(progress_key(video_id), mapping=mapping)
+        pipeline.expire(progress_key(video_id), PROGRESS_TTL)
+        pipeline.execute()
+    except redis.RedisError as e:
+        print(f'Error writing transcode progress: {e}')
+
+
+def set_status(video_id, status):
+    write_progress(video_id, {'status': status, 'updated_at': time.time()})
+
+
+def read_progress(video_id):
+    """
+    Returns the status and per-rendition progress of a video, read from Redis only.
+    """
+    data = get_redis_connection('default').hgetall(progress_key(video_id))
+    data = {key.decode(): value.decode() for key, value in data.items()}
+    return {
+        'status': data.pop('status', 'unknown'),
+        'updated_at': float(data.pop('updated_at', 0)) or None,
+        'renditions': {name: json.loads(value) for name, value in data.items()},
+    }
+
+
+def parse_number(value):
+    try:
+        return float(str(value).rstrip('x'))
+    except (TypeError, ValueError):
+        return None
+
+
+class ProgressReporter:
+    """
+    Parses the key=value blocks ffmpeg writes with -progress and stores percent, fps,
+    speed and ETA for each of its renditions. Redis is written at most every
+    settings.HLS_PROGRESS_INTERVAL seconds, plus once when ffmpeg is done.
+    """
+
+    def __init__(self, video_id, renditions, duration=None):
+        self.video_id = video_id
+        self.renditions = list(renditions)
+        self.duration = duration
+        self.interval = getattr(settings, 'HLS_PROGRESS_INTERVAL', 1.0)
+        self.values = {}
+        self.last_write = 0.0
+
+    def feed(self, line):
+        key, _, value = line.strip().partition('=')
+        self.values[key] = value
+        if key == 'progress':
+            self.report(finished=value == 'end')
+
+    def report(self, finished=False):
+        now = time.monotonic()
+        if not finished and now - self.last_write < self.interval:
+            return
+        self.last_write = now
+
+        # ffmpeg writes microseconds to both keys, out_time_ms is a misnomer.
+        out_time = parse_number(self.values.get('out_time_us', self.values.get('out_time_ms')))
+        out_time = out_time / 1000000 if out_time else 0.0
+        speed = parse_number(self.values.get('speed'))
+        percent = eta = None
+        if finished:
+            percent, eta = 100.0, 0
+        elif self.duration:
+            percent = round(min(out_time / self.duration * 100, 100.0), 1)
+            if speed:
+                eta = round(max(self.duration - out_time, 0) / speed)
+
+        state = json.dumps({
+            'percent': percent,
+            'fps': parse_number(self.values.get('fps')),
+            'speed': speed,
+            'eta': eta,
+            'finished': finished,
+        })
+        write_progress(self.video_id, {rendition: state for rendition in self.renditions})
@@ -0,0 +1,226 @@
+import re
+from collections import Counter
+import numpy as np
+import redis
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Min
+from django_redis import get_redis_connection
+from scipy import sparse
+from content.catalog_cache import bump, video_tag
+from content.models import RelatedVideo, Video
+from content.scheduling import job_started, schedule_once
+
+RECOMMENDATIONS_TAG = 'recommendations'
+
+DIRTY_KEY = 'videoflix:recommendations:dirty'
+REFRESH_SCHEDULED_KEY = 'videoflix:recommendations:refresh-scheduled'
+
+TOKEN_RE = re.compile(r'[^\W\d_]{2,}')
+STOP_WORDS = frozenset(
+    'a an and are as at be by for from has have in is it its of on or that the this to was were will with '
+    'der die das und ist ein eine mit von zu im den des auf für'.split()
+)
+# A word in the title counts as much as TITLE_WEIGHT words of the description
+TITLE_WEIGHT = 2
+# Added to the similarity of videos of the same category
+CATEGORY_BONUS = 0.1
+# Words in more than this share of a large catalog say little and would make the
+# similarity products nearly dense, they are left out
+MAX_DOCUMENT_FREQUENCY = 0.1
+MIN_DOCUMENT_FREQUENCY_CUTOFF = 1000
+
+
+def term_counts(title, description):
+    counts = Counter()
+    for text, weight in ((title, TITLE_WEIGHT), (description, 1)):
+        for token in TOKEN_RE.findall((text or '').lower()):
+            if token not in STOP_WORDS:
+                counts[token] += weight
+    return counts
+
+
+class TfidfIndex:
+    """
+    L2-normalized TF-IDF vectors of the titles and descriptions of the catalog as a sparse matrix,
+    one row per video, so the cosine similarities of a batch of videos to all others are one sparse
+    matrix product. Videos of the same category get CATEGORY_BONUS on top.
+    """
+
+    def __init__(self, rows):
+        vocabulary = {}
+        category_codes = {}
+        ids, categories, indptr, indices, counts = [], [], [0], [], []
+        for video_id, title, description, category in rows:
+            for term, count in term_counts(title, description).items():
+                indices.append(vocabulary.setdefault(term, len(vocabulary)))
+                counts.append(count)
+            indptr.append(len(indices))
+            ids.append(video_id)
+            categories.append(category_codes.setdefault(category, len(category_codes)))
+
+        self.ids = np.array(ids, dtype=np.int64)
+        self.categories = np.array(categories, dtype=np.int32)
+        self.positions = {video_id: position for position, video_id in enumerate(ids)}
+        matrix = sparse.csr_matrix(
+            (np.log1p(np.array(counts, dtype=np.float32)), np.array(indices, dtype=np.int32), np.array(indptr)),
+            shape=(len(ids), len(vocabulary)),
+        )
+        document_frequency = np.bincount(matrix.indices, minlength=len(vocabulary))
+        idf = np.log((1 + len(ids)) / (1 + document_frequency)) + 1
+        idf[document_frequency > max(MAX_DOCUMENT_FREQUENCY * len(ids), MIN_DOCUMENT_FREQUENCY_CUTOFF)] = 0
+        matrix = matrix @ sparse.diags(idf.astype(np.float32))
+        matrix.eliminate_zeros()
+        norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+        norms[norms == 0] = 1
+        self.matrix = (sparse.diags(1 / norms) @ matrix).tocsr()
+        self.transposed = self.matrix.T.tocsr()
+
+    @classmethod
+    def for_catalog(cls):
+        return cls(Video.objects.order_by('id').values_list('id', 'title', 'description', 'category').iterator(chunk_size=5000))
+
+    def similarities(self, positions):
+        """
+        Cosine similarities of the videos at positions to all videos, a sparse len(positions) x n matrix.
+        """
+        return (self.matrix[positions] @ self.transposed).tocsr()
+
+    def neighbours(self, positions, k, batch_size):
+        """
+        Yields (video id, [(related id, score), ...]) with the k most similar other videos, best first,
+        for the videos at positions. Rows are multiplied batch_size at a time to bound the memory.
+        """
+        for start in range(0, len(positions), batch_size):
+            batch = positions[start:start + batch_size]
+            similarities = self.similarities(batch)
+            for row, position in enumerate(batch):
+                begin, end = similarities.indptr[row], similarities.indptr[row + 1]
+                columns, scores = similarities.indices[begin:end], similarities.data[begin:end]
+                keep = (columns != position) & (scores > 0)
+                columns, scores = columns[keep], scores[keep]
+                scores = scores + CATEGORY_BONUS * (self.categories[columns] == self.categories[position])
+                if len(scores) > k:
+                    top = np.argpartition(-scores, k)[:k]
+                    columns, scores = columns[top], scores[top]
+                related_ids = self.ids[columns]
+                order = np.lexsort((-related_ids, -scores))
+                yield int(self.ids[position]), list(zip(related_ids[order].tolist(), scores[order].tolist()))
+
+
+def store_neighbours(neighbours):
+    """
+    Replaces the stored neighbours of the given videos.
+    """
+    neighbours = dict(neighbours)
+    with transaction.atomic():
+        RelatedVideo.objects.filter(video_id__in=list(neighbours)).delete()
+        RelatedVideo.objects.bulk_create([
+            RelatedVideo(video_id=video_id, related_id=related_id, rank=rank, score=score)
+            for video_id, related in neighbours.items()
+            for rank, (related_id, score) in enumerate(related)
+        ])
+    return list(neighbours)
+
+
+def store_in_batches(neighbours, batch_size):
+    batch = []
+    for entry in neighbours:
+        batch.append(entry)
+        if len(batch) == batch_size:
+            store_neighbours(batch)
+            batch = []
+    if batch:
+        store_neighbours(batch)
+
+
+def rebuild_recommendations():
+    """
+    Computes the neighbours of the whole catalog. Scheduled by refresh_recommendations
+    while no neighbours are stored yet.
+    """
+    index = TfidfIndex.for_catalog()
+    k = getattr(settings, 'RECOMMENDATION_COUNT', 10)
+    batch_size = getattr(settings, 'RECOMMENDATION_BATCH_SIZE', 512)
+    store_in_batches(index.neighbours(list(range(len(index.ids))), k, batch_size), batch_size)
+    bump(RECOMMENDATIONS_TAG)
+    print(f'Rebuilt recommendations of {len(index.ids)} videos')
+
+
+def affected_positions(index, video_ids):
+    """
+    Positions of the videos whose neighbours may have changed with the given videos: the videos
+    themselves, the ones listing them and the ones they are now more similar to than to their
+    last neighbour.
+    """
+    k = getattr(settings, 'RECOMMENDATION_COUNT', 10)
+    changed = [index.positions[video_id] for video_id in video_ids if video_id in index.positions]
+    affected = set(changed)
+    listing = RelatedVideo.objects.filter(related_id__in=video_ids).values_list('video_id', flat=True)
+    affected.update(index.positions[video_id] for video_id in listing if video_id in index.positions)
+    if not changed:
+        return sorted(affected)
+
+    best = np.asarray(index.similarities(changed).max(axis=0).todense()).ravel()
+    candidates = {int(index.ids[position]): best[position] for position in np.flatnonzero(best > 0)}
+    lists = RelatedVideo.objects.filter(video_id__in=list(candidates)).values('video_id').annotate(
+        lowest=Min('score'), length=Count('id')
+    )
+    full = {row['video_id']: row['lowest'] for row in lists if row['length'] >= k}
+    affected.update(
+        index.positions[video_id] for video_id, score in candidates.items()
+        if video_id not in full or score > full[video_id]
+    )
+    return sorted(affected)
+
+
+def refresh_recommendations():
+    """
+    Recomputes the neighbours of the videos affected by the videos marked with mark_changed.
+    Rebuilds the whole catalog while there are no neighbours yet.
+    """
+    job_started(REFRESH_SCHEDULED_KEY)
+    connection = get_redis_connection('default')
+    video_ids = [int(video_id) for video_id in connection.spop(DIRTY_KEY, 10000) or []]
+    if not video_ids:
+        return
+    if connection.scard(DIRTY_KEY):
+        schedule_refresh()
+    if not RelatedVideo.objects.exists():
+        rebuild_recommendations()
+        return
+
+    index = TfidfIndex.for_catalog()
+    positions = affected_positions(index, video_ids)
+    k = getattr(settings, 'RECOMMENDATION_COUNT', 10)
+    batch_size = getattr(settings, 'RECOMMENDATION_BATCH_SIZE', 512)
+    store_in_batches(index.neighbours(positions, k, batch_size), batch_size)
+    bump(*[video_tag(int(index.ids[position])) for position in positions])
+    print(f'Refreshed recommendations of {len(positions)} videos for {len(video_ids)} changes')
+
+
+def mark_changed(*video_ids):
+    """
+    Queues the videos for refresh_recommendations, which runs settings.RECOMMENDATION_REFRESH_DELAY
+    seconds later, so a burst of changes is handled at once.
+    """
+    if not video_ids:
+        return
+    try:
+        get_redis_connection('default').sadd(DIRTY_KEY, *video_ids)
+    except redis.RedisError as e:
+        print(f'Error queueing recommendation refresh: {e}')
+        return
+    schedule_refresh()
+
+
+def schedule_refresh():
+    schedule_once(REFRESH_SCHEDULED_KEY, getattr(settings, 'RECOMMENDATION_REFRESH_DELAY', 30), refresh_recommendations)
+
+
+def related_videos(video_id, values_serializer):
+    """
+    The stored neighbours of a video, best first, read with one query on the (video, rank) index.
+    """
+    videos = Video.objects.filter(related_to__video_id=video_id).order_by('related_to__rank')
+    return values_serializer.serialize(values_serializer.queryset(videos))
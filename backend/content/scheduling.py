@@ -0,0 +1,27 @@
+from datetime import timedelta
+import django_rq
+import redis
+from django_redis import get_redis_connection
+
+
+def schedule_once(key, delay, func):
+    """
+    Enqueues func delay seconds from now, unless a run is already scheduled, so a burst of work
+    is handled by one job. The Redis flag key marks the scheduled run; func calls job_started(key)
+    first, and the flag expires after twice the delay should the job be lost.
+    The worker has to run with --with-scheduler. Returns True if a job was enqueued.
+    """
+    try:
+        if get_redis_connection('default').set(key, 1, nx=True, ex=delay * 2):
+            django_rq.get_queue('default').enqueue_in(timedelta(seconds=delay), func, result_ttl=0)
+            return True
+    except redis.RedisError as e:
+        print(f'Error scheduling {func.__name__}: {e}')
+    return False
+
+
+def job_started(key):
+    """
+    Clears the flag of a job scheduled with schedule_once, from here on new work schedules the next run.
+    """
+    get_redis_connection('default').delete(key)
@@ -0,0 +1,27 @@
+from django.conf import settings
+from django.contrib.postgres.search import SearchQuery, SearchRank, TrigramWordSimilarity
+from django.db.models import F
+from content.models import Video
+
+
+def search_videos(text, videos=None):
+    """
+    Videos matching the search text, best first. The query is parsed like a web search
+    ("quoted phrases", -excluded words, or) and matched against Video.search_vector, a generated
+    tsvector column with a GIN index, in which titles weigh more than descriptions.
+    """
+    query = SearchQuery(text, search_type='websearch', config=settings.SEARCH_CONFIG)
+    videos = Video.objects.all() if videos is None else videos
+    return videos.filter(search_vector=query).annotate(
+        rank=SearchRank(F('search_vector'), query)
+    ).order_by('-rank', '-id')
+
+
+def autocomplete_titles(text, limit=10):
+    """
+    Titles containing a word similar to text, for search as you type. Trigram word similarity
+    matches prefixes and tolerates typos, and is served by the pg_trgm index on the title.
+    """
+    return Video.objects.filter(title__trigram_word_similar=text).annotate(
+        similarity=TrigramWordSimilarity(text, 'title')
+    ).order_by('-similarity', '-id').values('id', 'title')[:limit]
@@ -0,0 +1,202 @@
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from django.conf import settings
+from django_redis import get_redis_connection
+from redis.exceptions import RedisError
+from content.utils import file_etag
+
+REDIS_KEY = 'videoflix:hls:{name}'
+REDIS_DIRECTORY_KEY = 'videoflix:hls-dir:{directory}'
+
+PLAYLIST_RE = re.compile(r'\.(m3u8|vtt)(\.gz|\.br)?$')
+SEGMENT_RE = re.compile(r'_(\d+)(\.[0-9a-f]{16})?\.(ts|m4s)$')
+# Single file fMP4 renditions, their init segment and first fragments are at the start of the file
+FMP4_FILE_RE = re.compile(r'\.mp4$')
+
+
+def is_hot(name):
+    """
+    True for the objects every viewer requests on startup: playlists, the sprite index,
+    the first settings.HLS_SEGMENT_CACHE_SEGMENTS segments of every rendition and the head
+    of single file fMP4 renditions, see cached_length.
+    """
+    if PLAYLIST_RE.search(name) or FMP4_FILE_RE.search(name):
+        return True
+    match = SEGMENT_RE.search(name)
+    return bool(match) and int(match.group(1)) < getattr(settings, 'HLS_SEGMENT_CACHE_SEGMENTS', 3)
+
+
+def cached_length(name, size):
+    """
+    How many bytes of a hot file of size bytes are cached. Single file fMP4 renditions are
+    cached up to settings.HLS_SEGMENT_CACHE_HEAD_BYTES, the ranges of the init segment and
+    the first fragments, which players request on startup. Other files are cached whole.
+    """
+    if FMP4_FILE_RE.search(name):
+        return min(size, getattr(settings, 'HLS_SEGMENT_CACHE_HEAD_BYTES', 1024 * 1024), segment_cache.max_item_bytes)
+    return size
+
+
+class SegmentCache:
+    """
+    In-process LRU cache of small HLS files, bounded by the total bytes it holds
+    (settings.HLS_SEGMENT_CACHE_BYTES). Entries expire after settings.HLS_SEGMENT_CACHE_TTL
+    seconds, so deletions made by another process are picked up. With settings.HLS_SEGMENT_CACHE_REDIS
+    a local miss is looked up in Redis, which the transcode worker warms.
+    Keys are paths relative to the HLS directory. An entry may hold only the head of its file,
+    size is the size of the whole file.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.redis_hits = 0
+        self.misses = 0
+
+    @property
+    def max_bytes(self):
+        return getattr(settings, 'HLS_SEGMENT_CACHE_BYTES', 64 * 1024 * 1024)
+
+    @property
+    def max_item_bytes(self):
+        return min(getattr(settings, 'HLS_SEGMENT_CACHE_MAX_ITEM_BYTES', 4 * 1024 * 1024), self.max_bytes)
+
+    def get(self, name):
+        """
+        Returns (data, etag, size) or None. Counts hits, misses are counted by the caller with miss(),
+        as one request may look up several precompressed variants.
+        """
+        if not self.max_bytes:
+            return None
+        with self.lock:
+            entry = self.entries.get(name)
+            if entry and entry[2] > time.monotonic():
+                self.entries.move_to_end(name)
+                self.hits += 1
+                return entry[0], entry[1], entry[3]
+            if entry:
+                self._remove(name)
+
+        entry = redis_get(name)
+        if entry:
+            with self.lock:
+                self.redis_hits += 1
+            self.put(name, *entry)
+        return entry
+
+    def miss(self):
+        with self.lock:
+            self.misses += 1
+
+    def put(self, name, data, etag, size=None):
+        if len(data) > self.max_item_bytes:
+            return
+        expires = time.monotonic() + getattr(settings, 'HLS_SEGMENT_CACHE_TTL', 300)
+        with self.lock:
+            if name in self.entries:
+                self._remove(name)
+            self.entries[name] = (data, etag, expires, len(data) if size is None else size)
+            self.bytes += len(data)
+            while self.bytes > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+
+    def evict_directory(self, directory):
+        prefix = directory.rstrip('/') + '/'
+        with self.lock:
+            for name in [name for name in self.entries if name.startswith(prefix)]:
+                self._remove(name)
+
+    def _remove(self, name):
+        data = self.entries.pop(name)[0]
+        self.bytes -= len(data)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = self.hits = self.redis_hits = self.misses = 0
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.redis_hits + self.misses
+            return {
+                'pid': os.getpid(),
+                'entries': len(self.entries),
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'redis_hits': self.redis_hits,
+                'misses': self.misses,
+                'hit_ratio': round((self.hits + self.redis_hits) / lookups, 4) if lookups else None,
+            }
+
+
+segment_cache = SegmentCache()
+
+
+def redis_enabled():
+    return getattr(settings, 'HLS_SEGMENT_CACHE_REDIS', False) and segment_cache.max_bytes
+
+def redis_get(name):
+    if not redis_enabled():
+        return None
+    try:
+        entry = get_redis_connection('default').hmget(REDIS_KEY.format(name=name), 'data', 'etag', 'size')
+    except RedisError as e:
+        print(f'Could not read cached segment {name}: {e}')
+        return None
+    if entry[0] is None:
+        return None
+    return entry[0], entry[1].decode(), int(entry[2]) if entry[2] is not None else len(entry[0])
+
+def warm_output(base_name):
+    """
+    Loads the hot files of a finished output into Redis, so the first viewers don't wait
+    for the disk. Does nothing without settings.HLS_SEGMENT_CACHE_REDIS, the web processes
+    then fill their cache on the first requests.
+    """
+    if not redis_enabled():
+        return
+
+    hls_root = os.path.join(settings.MEDIA_ROOT, 'videos', 'hls')
+    directory = os.path.relpath(base_name, hls_root)
+    ttl = getattr(settings, 'HLS_SEGMENT_CACHE_REDIS_TTL', 86400)
+    try:
+        pipeline = get_redis_connection('default').pipeline()
+        for file_name in sorted(os.listdir(base_name)):
+            path = os.path.join(base_name, file_name)
+            stat = os.stat(path)
+            length = cached_length(file_name, stat.st_size)
+            if not is_hot(file_name) or length > segment_cache.max_item_bytes:
+                continue
+            with open(path, 'rb') as f:
+                data = f.read(length)
+            key = REDIS_KEY.format(name=f'{directory}/{file_name}')
+            pipeline.hset(key, mapping={'data': data, 'etag': file_etag(stat), 'size': stat.st_size})
+            pipeline.expire(key, ttl)
+            pipeline.sadd(REDIS_DIRECTORY_KEY.format(directory=directory), key)
+        pipeline.expire(REDIS_DIRECTORY_KEY.format(directory=directory), ttl)
+        pipeline.execute()
+        print(f'Warmed segment cache for {directory}')
+    except RedisError as e:
+        print(f'Could not warm segment cache for {directory}: {e}')
+
+def evict_output(hls_dir):
+    """
+    Drops a deleted output from the local cache and from Redis.
+    """
+    directory = os.path.relpath(hls_dir, os.path.join(settings.MEDIA_ROOT, 'videos', 'hls'))
+    segment_cache.evict_directory(directory)
+    if not redis_enabled():
+        return
+    try:
+        redis = get_redis_connection('default')
+        directory_key = REDIS_DIRECTORY_KEY.format(directory=directory)
+        keys = redis.smembers(directory_key)
+        redis.delete(directory_key, *keys)
+    except RedisError as e:
+        print(f'Could not evict segment cache for {directory}: {e}')
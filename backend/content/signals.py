@@ -1,28 +1,53 @@
 import os
-from django.db.models.signals import post_save, post_delete
-from content.models import Video
+from django.contrib.postgres.operations import TrigramExtension
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.db.models.signals import post_save, post_delete, pre_delete
+from content.models import RelatedVideo, Video
 from django.dispatch import receiver
-import django_rq
-from .tasks import convert_to_hls
+from .catalog_cache import bump_video
+from .recommendations import mark_changed
+from .tasks import enqueue_conversion
 
 print('Signals loaded')
 
-@receiver(post_save, sender=Video)
+def create_extensions(sender, using=DEFAULT_DB_ALIAS, **kwargs):
+    """
+    Creates pg_trgm, needed by the trigram index on Video.title, before migrate runs. Migrations
+    are generated on deploy, so TrigramExtension is run from pre_migrate instead of a migration file.
+    """
+    connection = connections[using]
+    if connection.vendor != 'postgresql':
+        return
+    with connection.schema_editor() as schema_editor:
+        TrigramExtension().database_forwards(sender.label, schema_editor, None, None)
+
+@receiver(post_save)
 def video_post_save(sender, instance, created, **kwargs):
     """
-    Sends variables to tasks.py to format through RQ Worker
+    Enqueues the HLS conversion of a new upload, see tasks.enqueue_conversion. Connected without
+    a sender, so saves of proxy models like the admin's ContentProxy are handled as well.
+    """
+    if not issubclass(sender, Video):
+        return
+    bump_video(instance.id)
+    mark_changed(instance.id)
+    if created and instance.video_file:
+        enqueue_conversion(instance)
+
+@receiver(pre_delete)
+def video_pre_delete(sender, instance, **kwargs):
+    """
+    The videos listing a deleted video as related lose it with the cascade and need new neighbours.
     """
-    if created:
-        queue = django_rq.get_queue('default')
-        queue.enqueue(
-            convert_to_hls, 
-            args=(instance.video_file.path, instance.id), 
-            job_timeout=760,
-            result_ttl=0
-        )
+    if not issubclass(sender, Video):
+        return
+    mark_changed(*RelatedVideo.objects.filter(related=instance).values_list('video_id', flat=True))
 
-@receiver(post_delete, sender=Video)
+@receiver(post_delete)
 def auto_delete_file_on_delete(sender, instance, **kwargs):
+        if not issubclass(sender, Video):
+            return
+        bump_video(instance.id)
         print("auto_delete_file_on_delete triggered")
         if instance.video_file:
             print(f"Video file path: {instance.video_file.path}")
@@ -1,7 +1,33 @@
+import csv
+import gzip
+import json
+import math
 import os
+import re
+import shutil
 import subprocess
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from fractions import Fraction
+import django_rq
 from django.conf import settings
-from content.models import Video
+from django.db import transaction
+from django.utils import timezone
+from rq import Retry, get_current_job
+from content.models import HlsOutput, TranscodeJob, Video
+from content.catalog_cache import bump_video
+from content.progress import ProgressReporter, set_status
+from content.segment_cache import warm_output
+from content.utils import FINGERPRINT_LENGTH, file_digest, is_fingerprinted, unfingerprinted_name
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+FFMPEG_PATH = '/usr/bin/ffmpeg'
+FFPROBE_PATH = '/usr/bin/ffprobe'
 
 QUALITIES = {
     '1080p': ('1920x1080', '5000k'),
@@ -9,16 +35,37 @@ QUALITIES = {
     '480p': ('854x480', '1400k')
 }
 
-def exportJson():
-    cmd = """
-    python3 manage.py shell <<EOF
-    from core.admin import VideoResource
-    dataset = VideoResource().export()
-    with open("exportJson.txt", "w") as f:
-        f.write(dataset.json)
-    EOF
+# The QUALITIES bitrates are meant for this frame rate, see select_qualities
+REFERENCE_FPS = 30
+
+CHECKPOINT_DIR = '.checkpoints'
+
+SPRITE_CODECS = {
+    'jpg': ['-c:v', 'mjpeg', '-q:v', '4'],
+    'webp': ['-c:v', 'libwebp', '-quality', '75'],
+}
+
+PROBE_FIELDS = ('source_width', 'source_height', 'source_fps', 'duration', 'video_codec', 'audio_codec', 'has_audio')
+
+def hls_version():
     """
-    subprocess.run(cmd, shell=True, text=True)
+    fMP4 playlists use EXT-X-MAP and EXT-X-BYTERANGE, which need a newer playlist version.
+    """
+    return 7 if getattr(settings, 'HLS_SEGMENT_FORMAT', 'ts') == 'fmp4' else 3
+
+def hls_segment_options(base_name, name):
+    """
+    Returns the HLS muxer options for the media files of a rendition name (or the %v pattern).
+    With settings.HLS_SEGMENT_FORMAT = "fmp4" every rendition is one fragmented MP4 file whose
+    fragments are addressed with EXT-X-BYTERANGE, otherwise every segment is its own .ts file.
+    """
+    if getattr(settings, 'HLS_SEGMENT_FORMAT', 'ts') == 'fmp4':
+        return [
+            '-hls_segment_type', 'fmp4',
+            '-hls_flags', 'single_file',
+            '-hls_segment_filename', f'{base_name}/{name}.mp4',
+        ]
+    return ['-hls_segment_filename', f'{base_name}/{name}_%03d.ts']
 
 def create_base_directory(source):
     base_name = os.path.join(settings.MEDIA_ROOT, 'videos', 'hls', os.path.basename(source).rsplit('.', 1)[0])
@@ -32,7 +79,7 @@ def create_master_playlist(base_name, qualities):
     master_playlist_path = os.path.join(base_name, 'playlist.m3u8')
     with open(master_playlist_path, 'w') as f:
         f.write("#EXTM3U\n")
-        f.write("#EXT-X-VERSION:3\n")
+        f.write(f"#EXT-X-VERSION:{hls_version()}\n")
 
         for quality, (resolution, bitrate) in qualities.items():
             bandwidth = int(bitrate[:-1]) * 1000  
@@ -42,12 +89,93 @@ def create_master_playlist(base_name, qualities):
     print(f'Master playlist created at {master_playlist_path}')
     return os.path.relpath(master_playlist_path, settings.MEDIA_ROOT)
 
-def generate_ffmpeg_command(source, base_name, quality, resolution, bitrate):
+def parse_frame_rate(rate):
+    """
+    Converts an ffprobe frame rate like '30000/1001' into a float (None if unknown).
+    """
+    try:
+        fps = float(Fraction(rate))
+    except (TypeError, ValueError, ZeroDivisionError):
+        return None
+    return fps or None
+
+def probe_video(source):
+    """
+    Reads resolution, frame rate, duration, codecs and audio presence of the source with ffprobe.
+    The keys match the probe fields on Video.
+    """
+    cmd = [
+        FFPROBE_PATH,
+        '-v', 'error',
+        '-print_format', 'json',
+        '-show_streams',
+        '-show_format',
+        source
+    ]
+    result = subprocess.run(cmd, shell=False, text=True, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    data = json.loads(result.stdout or '{}')
+    streams = data.get('streams', [])
+    video = next((stream for stream in streams if stream.get('codec_type') == 'video'), {})
+    audio = next((stream for stream in streams if stream.get('codec_type') == 'audio'), None)
+
+    try:
+        duration = float(data.get('format', {}).get('duration'))
+    except (TypeError, ValueError):
+        duration = None
+
+    return {
+        'source_width': video.get('width'),
+        'source_height': video.get('height'),
+        'source_fps': parse_frame_rate(video.get('avg_frame_rate')) or parse_frame_rate(video.get('r_frame_rate')),
+        'duration': duration,
+        'video_codec': video.get('codec_name', ''),
+        'audio_codec': audio.get('codec_name', '') if audio else '',
+        'has_audio': audio is not None,
+    }
+
+def fit_resolution(width, height, short_side):
+    """
+    Resolution with short_side as its shorter side and the aspect ratio of width x height,
+    both rounded to even numbers like ffmpeg's scale=-2, so it can go into the master playlist.
+    """
+    scale = short_side / min(width, height)
+
+    def even(size):
+        return max(2, round(size * scale / 2) * 2)
 
-    ffmpeg_path = '/usr/bin/ffmpeg' 
+    return f'{even(width)}x{even(height)}'
+
+def select_qualities(probe, qualities=QUALITIES):
+    """
+    Picks the qualities whose height doesn't exceed the shorter side of the source, so nothing gets
+    upscaled, at the aspect ratio of the source: a portrait 1080x1920 source gets 720x1280 as 720p.
+    Bitrates are scaled with the source frame rate relative to REFERENCE_FPS.
+    A source smaller than the lowest quality gets that quality at its own resolution.
+    """
+    height = probe.get('source_height')
+    width = probe.get('source_width')
+    if not height or not width:
+        return dict(qualities)
+
+    factor = min(max((probe.get('source_fps') or REFERENCE_FPS) / REFERENCE_FPS, 0.5), 2.0)
+
+    def scale_bitrate(bitrate):
+        return f'{round(int(bitrate[:-1]) * factor)}k'
+
+    selected = {
+        quality: (fit_resolution(width, height, int(resolution.split('x')[1])), scale_bitrate(bitrate))
+        for quality, (resolution, bitrate) in qualities.items()
+        if int(resolution.split('x')[1]) <= min(width, height)
+    }
+    if not selected:
+        quality, (resolution, bitrate) = list(qualities.items())[-1]
+        selected[quality] = (f'{width - width % 2}x{height - height % 2}', scale_bitrate(bitrate))
+    return selected
+
+def generate_ffmpeg_command(source, base_name, quality, resolution, bitrate, threads=None, sprites=None):
 
     cmd = [
-        ffmpeg_path,
+        FFMPEG_PATH,
         '-i', source,
         '-preset', 'fast',
         '-g', '48',
@@ -62,47 +190,827 @@ def generate_ffmpeg_command(source, base_name, quality, resolution, bitrate):
         '-f', 'hls',
         '-hls_time', '5',
         '-hls_playlist_type', 'vod',
-        '-hls_segment_filename', f'{base_name}/{quality}_%03d.ts',
+        *hls_segment_options(base_name, quality),
         f'{base_name}/{quality}.m3u8'
     ]
+    if threads:
+        cmd[-1:-1] = ['-threads', str(threads)]
+    if sprites:
+        # The sprite branch shares the decoded frames of this encode.
+        sprite_filter, sprite_output = generate_sprite_output(base_name, sprites, '[0:v]')
+        cmd[3:3] = ['-filter_complex', sprite_filter]
+        cmd += sprite_output
     return cmd
 
-def convert_to_hls(source, video_id):
+def generate_single_pass_ffmpeg_command(source, base_name, qualities, has_audio=True, name_suffix='', ts_offset=None, sprites=None):
     """
-    Converts source file to HLS with multiple quality levels and saves files in corresponding folder.
+    Builds one ffmpeg command that decodes the source once and fans the frames out
+    to every quality via a split filter graph. All renditions are written by a
+    single HLS muxer, so the file names match the per-rendition command.
+    name_suffix and ts_offset are used for chunks, see convert_chunk_to_hls.
+    With a sprite layout, one more branch of the split writes the trickplay sprite sheets.
     """
-    print(f'Converting {source} to HLS')
-    base_name = create_base_directory(source)
-    
+    count = len(qualities)
+    branches = count + 1 if sprites else count
+    filters = [f'[0:v]split={branches}' + ''.join(f'[v{i}]' for i in range(branches))]
+    for i, (resolution, bitrate) in enumerate(qualities.values()):
+        filters.append(f'[v{i}]scale={resolution.replace("x", ":")}[v{i}out]')
+    sprite_output = []
+    if sprites:
+        sprite_filter, sprite_output = generate_sprite_output(base_name, sprites, f'[v{count}]', name_suffix)
+        filters.append(sprite_filter)
+
+    cmd = [
+        FFMPEG_PATH,
+        '-i', source,
+        '-filter_complex', ';'.join(filters),
+    ]
+
+    stream_map = []
+    for i, (quality, (resolution, bitrate)) in enumerate(qualities.items()):
+        cmd += ['-map', f'[v{i}out]', f'-b:v:{i}', bitrate]
+        if has_audio:
+            cmd += ['-map', '0:a:0']
+            stream_map.append(f'v:{i},a:{i},name:{quality}{name_suffix}')
+        else:
+            stream_map.append(f'v:{i},name:{quality}{name_suffix}')
+
+    cmd += [
+        '-preset', 'fast',
+        '-g', '48',
+        '-sc_threshold', '0',
+        '-c:v', 'libx264',
+        '-c:a', 'aac',
+        '-strict', '-2',
+        '-f', 'hls',
+        '-hls_time', '5',
+        '-hls_playlist_type', 'vod',
+        '-var_stream_map', ' '.join(stream_map),
+        *hls_segment_options(base_name, '%v'),
+        f'{base_name}/%v.m3u8'
+    ]
+    if ts_offset:
+        cmd[-1:-1] = ['-output_ts_offset', str(ts_offset)]
+    return cmd + sprite_output
+
+def sprite_layout(probe):
+    """
+    Returns the trickplay sprite layout for a probed source, or None if sprites are disabled
+    by settings.HLS_SPRITE_INTERVAL = 0 or the source size is unknown. The thumbnail height
+    follows the source aspect ratio.
+    """
+    interval = getattr(settings, 'HLS_SPRITE_INTERVAL', 10)
+    if not interval or not probe.get('duration') or not probe.get('source_width') or not probe.get('source_height'):
+        return None
+    width = getattr(settings, 'HLS_SPRITE_WIDTH', 160)
+    height = max(2, round(width * probe['source_height'] / probe['source_width'] / 2) * 2)
+    return {
+        'interval': interval,
+        'width': width,
+        'height': height,
+        'columns': getattr(settings, 'HLS_SPRITE_COLUMNS', 5),
+        'rows': getattr(settings, 'HLS_SPRITE_ROWS', 5),
+        'format': getattr(settings, 'HLS_SPRITE_FORMAT', 'jpg'),
+    }
+
+def sprite_name(index, sprites, name_suffix=''):
+    return f'sprites{name_suffix}_{index:03d}.{sprites["format"]}'
+
+def generate_sprite_output(base_name, sprites, input_label, name_suffix=''):
+    """
+    Returns the filter that takes one frame every interval seconds and tiles the thumbnails
+    into sprite sheets, and the ffmpeg output writing the sheets next to the playlists.
+    """
+    sprite_filter = (
+        f'{input_label}fps=1/{sprites["interval"]},'
+        f'scale={sprites["width"]}:{sprites["height"]},'
+        f'tile={sprites["columns"]}x{sprites["rows"]}[sprites]'
+    )
+    output = [
+        '-map', '[sprites]',
+        *SPRITE_CODECS[sprites['format']],
+        '-f', 'image2',
+        f'{base_name}/{sprite_name(1, sprites, name_suffix).replace("001", "%03d")}'
+    ]
+    return sprite_filter, output
+
+def format_vtt_time(seconds):
+    milliseconds = round(seconds * 1000)
+    hours, milliseconds = divmod(milliseconds, 3600000)
+    minutes, milliseconds = divmod(milliseconds, 60000)
+    seconds, milliseconds = divmod(milliseconds, 1000)
+    return f'{hours:02d}:{minutes:02d}:{seconds:02d}.{milliseconds:03d}'
+
+def write_sprite_vtt(base_name, sprites, duration, name_suffix='', start=0):
+    """
+    Writes the WebVTT index of the sprite sheets. Every cue points to one thumbnail
+    with a media fragment (sheet#xywh=x,y,w,h). start shifts the cues of a chunk.
+    """
+    interval = sprites['interval']
+    per_sheet = sprites['columns'] * sprites['rows']
+    path = os.path.join(base_name, f'sprites{name_suffix}.vtt')
+    with open(path, 'w') as f:
+        f.write("WEBVTT\n")
+        for i in range(math.ceil(duration / interval)):
+            sheet, position = divmod(i, per_sheet)
+            row, column = divmod(position, sprites['columns'])
+            x, y = column * sprites['width'], row * sprites['height']
+            cue_start = start + i * interval
+            cue_end = start + min((i + 1) * interval, duration)
+            f.write(f"\n{format_vtt_time(cue_start)} --> {format_vtt_time(cue_end)}\n")
+            f.write(f"{sprite_name(sheet + 1, sprites, name_suffix)}#xywh={x},{y},{sprites['width']},{sprites['height']}\n")
+    return path
+
+def stitch_sprite_vtts(base_name, chunk_count):
+    """
+    Joins the cues of the chunk sprite indexes into sprites.vtt and returns the chunk indexes,
+    which are deleted once the conversion is saved. Does nothing if the chunks were encoded
+    without sprites.
+    """
+    parts = [os.path.join(base_name, f'sprites{chunk_suffix(i)}.vtt') for i in range(chunk_count)]
+    if not all(os.path.isfile(part) for part in parts):
+        return []
+    with open(os.path.join(base_name, 'sprites.vtt'), 'w') as f:
+        f.write("WEBVTT\n")
+        for part in parts:
+            with open(part) as part_file:
+                f.write(part_file.read().split('\n', 1)[1])
+    return parts
+
+def transcode_retry():
+    """
+    Retry policy for transcode jobs, a failed job is retried after each interval in
+    settings.HLS_RETRY_INTERVALS. Finished renditions are kept, see save_checkpoint.
+    Interval retries are run by the RQ scheduler, the worker has to run with --with-scheduler.
+    """
+    intervals = getattr(settings, 'HLS_RETRY_INTERVALS', [60, 300, 900])
+    return Retry(max=len(intervals), interval=intervals) if intervals else None
+
+def count_valid_segments(playlist_path, renamed=None):
+    """
+    Returns the number of segments of a finished playlist, or None if the playlist is
+    incomplete or references a missing or empty segment file. Byte ranges of fMP4
+    playlists have to lie within their file. renamed maps segment names to the names
+    they were fingerprinted to, see previous_fingerprints.
+    """
+    if not os.path.isfile(playlist_path):
+        return None
+
+    directory = os.path.dirname(playlist_path)
+    sizes = {}
+    renamed = renamed or {}
+
+    def file_size(name):
+        if name not in sizes:
+            path = os.path.join(directory, renamed.get(name, name))
+            sizes[name] = os.path.getsize(path) if os.path.isfile(path) else 0
+        return sizes[name]
+
+    segments = 0
+    finished = False
+    byterange = None
+    range_ends = {}
+    with open(playlist_path) as f:
+        for line in f:
+            line = line.strip()
+            if line == '#EXT-X-ENDLIST':
+                finished = True
+            elif line.startswith('#EXT-X-BYTERANGE:'):
+                byterange = line.split(':', 1)[1]
+            elif line.startswith('#EXT-X-MAP:'):
+                uri = re.search(r'URI="([^"]+)"', line)
+                if not uri or file_size(uri.group(1)) == 0:
+                    return None
+            elif line and not line.startswith('#'):
+                end = 1
+                if byterange:
+                    length, _, offset = byterange.partition('@')
+                    end = (int(offset) if offset else range_ends.get(line, 0)) + int(length)
+                    range_ends[line] = end
+                    byterange = None
+                if file_size(line) < end:
+                    return None
+                segments += 1
+    return segments if finished and segments else None
+
+def checkpoint_path(base_name, name):
+    return os.path.join(base_name, CHECKPOINT_DIR, f'{name}.json')
+
+def save_checkpoint(base_name, name):
+    """
+    Records a finished rendition (or chunk rendition) with its playlist and segment count.
+    Every rendition has its own file, so concurrent encodes never write the same checkpoint.
+    """
+    playlist = f'{name}.m3u8'
+    segments = count_valid_segments(os.path.join(base_name, playlist))
+    if segments is None:
+        raise RuntimeError(f'Rendition {name} in {base_name} is incomplete')
+
+    path = checkpoint_path(base_name, name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(f'{path}.tmp', 'w') as f:
+        json.dump({'playlist': playlist, 'segments': segments}, f)
+    os.replace(f'{path}.tmp', path)
+
+def is_checkpointed(base_name, name):
+    """
+    Returns True if the rendition was checkpointed and its files are still complete, also once
+    an earlier attempt of the conversion fingerprinted them.
+    """
+    try:
+        with open(checkpoint_path(base_name, name)) as f:
+            checkpoint = json.load(f)
+    except (OSError, ValueError):
+        return False
+    renamed = previous_fingerprints(base_name)
+    playlist = renamed.get(checkpoint['playlist'], checkpoint['playlist'])
+    return count_valid_segments(os.path.join(base_name, playlist), renamed) == checkpoint['segments']
+
+def pending_qualities(base_name, qualities, name_suffix=''):
+    """
+    Returns the qualities that still have to be encoded, checkpointed ones are skipped.
+    """
+    pending = {
+        quality: values for quality, values in qualities.items()
+        if not is_checkpointed(base_name, f'{quality}{name_suffix}')
+    }
+    if len(pending) < len(qualities):
+        print(f'Resuming {base_name}, already done: {", ".join(q for q in qualities if q not in pending)}')
+    return pending
+
+def run_ffmpeg(cmd, progress=None, on_start=None):
+    """
+    Runs an ffmpeg command and raises CalledProcessError on failure. With a ProgressReporter,
+    ffmpeg writes -progress blocks to stdout, which are parsed while it runs. stderr goes to
+    a temporary file, so a chatty ffmpeg can't block on a full pipe.
+    on_start is called with the process right after it was started. ffmpeg is killed if
+    anything raises while it runs.
+    """
+    if progress:
+        cmd = [cmd[0], '-progress', 'pipe:1', '-nostats', *cmd[1:]]
+    print(f'Running command: {" ".join(cmd)}')
+
+    with tempfile.TemporaryFile(mode='w+') as stderr:
+        process = subprocess.Popen(cmd, text=True, stdout=subprocess.PIPE, stderr=stderr)
+        try:
+            if on_start:
+                on_start(process)
+            for line in process.stdout:
+                if progress:
+                    progress.feed(line)
+            returncode = process.wait()
+        except BaseException:
+            # Like subprocess.run, don't leave ffmpeg writing into the output after a job
+            # timeout or a failed progress update, a retry would encode into the same files.
+            process.kill()
+            process.wait()
+            raise
+        stderr.seek(0)
+        errors = stderr.read()
+
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, cmd, stderr=errors)
+
+def update_status(video_id, status):
+    """
+    Records the transcode status in Redis for progress polling and on the persisted TranscodeJob.
+    A failed attempt that RQ is going to retry stays queued.
+    """
+    if status == 'failed':
+        job = get_current_job()
+        if job is not None and job.retries_left:
+            status = 'queued'
+    set_status(video_id, status)
+    TranscodeJob.update_status(video_id, status)
+    if status == 'finished':
+        # The probe results are stored with update(), which doesn't send post_save.
+        bump_video(video_id)
+
+def progress_reporter(video_id, renditions, duration):
+    return ProgressReporter(video_id, renditions, duration) if video_id else None
+
+def encode_single_pass(source, base_name, qualities, has_audio=True, video_id=None, duration=None, sprites=None):
+    """
+    Encodes all qualities in one ffmpeg run, the source is only decoded once.
+    """
+    cmd = generate_single_pass_ffmpeg_command(source, base_name, qualities, has_audio, sprites=sprites)
+    run_ffmpeg(cmd, progress_reporter(video_id, qualities, duration))
+    for quality in qualities:
+        save_checkpoint(base_name, quality)
+    print(f'Finished converting {source} to {", ".join(qualities)} HLS')
+
+def encode_per_rendition(source, base_name, qualities, has_audio=True, video_id=None, duration=None, sprites=None):
+    """
+    Encodes one quality after another, every run decodes the full source again.
+    The sprite sheets are written by the first run.
+    """
+    for i, (quality, (resolution, bitrate)) in enumerate(qualities.items()):
+        cmd = generate_ffmpeg_command(source, base_name, quality, resolution, bitrate, sprites=sprites if i == 0 else None)
+        run_ffmpeg(cmd, progress_reporter(video_id, [quality], duration))
+        save_checkpoint(base_name, quality)
+        print(f'Finished converting {source} to {quality} HLS')
+
+def encode_parallel(source, base_name, qualities, has_audio=True, video_id=None, duration=None, sprites=None):
+    """
+    Encodes the qualities concurrently. At most settings.HLS_MAX_PARALLEL_ENCODES ffmpeg
+    processes run at the same time, each limited to settings.HLS_FFMPEG_THREADS threads.
+    If one encode fails, the sibling processes are terminated and pending ones never start.
+    The sprite sheets are written by the encode of the first quality.
+    """
+    first_quality = next(iter(qualities), None)
+    max_workers = getattr(settings, 'HLS_MAX_PARALLEL_ENCODES', 3)
+    threads = getattr(settings, 'HLS_FFMPEG_THREADS', None)
+    cancelled = threading.Event()
+    lock = threading.Lock()
+    processes = []
+
+    def register(process):
+        with lock:
+            processes.append(process)
+            if cancelled.is_set():
+                process.terminate()
+
+    def encode(quality, resolution, bitrate):
+        if cancelled.is_set():
+            return
+        cmd = generate_ffmpeg_command(
+            source, base_name, quality, resolution, bitrate, threads=threads,
+            sprites=sprites if quality == first_quality else None
+        )
+        try:
+            run_ffmpeg(cmd, progress_reporter(video_id, [quality], duration), on_start=register)
+        except subprocess.CalledProcessError:
+            if cancelled.is_set():
+                return
+            raise
+        save_checkpoint(base_name, quality)
+        print(f'Finished converting {source} to {quality} HLS')
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(encode, quality, resolution, bitrate)
+            for quality, (resolution, bitrate) in qualities.items()
+        ]
+        try:
+            for future in as_completed(futures):
+                future.result()
+        except BaseException:
+            cancelled.set()
+            for future in futures:
+                future.cancel()
+            with lock:
+                for process in processes:
+                    if process.poll() is None:
+                        process.terminate()
+            raise
+
+ENCODE_MODES = {
+    'single_pass': encode_single_pass,
+    'per_rendition': encode_per_rendition,
+    'parallel': encode_parallel,
+}
+
+def split_into_chunks(source, chunk_dir, chunk_duration):
+    """
+    Splits the source at keyframes into chunks of roughly chunk_duration seconds.
+    The streams are only copied, so this costs no decode. Returns a list of
+    (chunk_path, start_time, end_time) tuples in playback order.
+    """
+    os.makedirs(chunk_dir, exist_ok=True)
+    chunk_list = os.path.join(chunk_dir, 'chunks.csv')
+    cmd = [
+        FFMPEG_PATH,
+        '-i', source,
+        '-map', '0:v:0',
+        '-map', '0:a?',
+        '-c', 'copy',
+        '-f', 'segment',
+        '-segment_time', str(chunk_duration),
+        '-reset_timestamps', '1',
+        '-segment_list', chunk_list,
+        '-segment_list_type', 'csv',
+        os.path.join(chunk_dir, 'chunk_%03d.mp4')
+    ]
+    run_ffmpeg(cmd)
+
+    with open(chunk_list, newline='') as f:
+        return [(os.path.join(chunk_dir, name), float(start), float(end)) for name, start, end in csv.reader(f)]
+
+def chunk_suffix(index):
+    return f'_c{index:03d}'
+
+def chunk_directory(base_name):
+    """
+    The source chunks of a conversion are staged in settings.HLS_CHUNK_ROOT, outside the served HLS files.
+    """
+    chunk_root = getattr(settings, 'HLS_CHUNK_ROOT', os.path.join(settings.MEDIA_ROOT, 'hls_chunks'))
+    return os.path.join(chunk_root, os.path.basename(base_name))
+
+def stitch_job_id(job_id):
+    return f'{job_id}-stitch'
+
+def enqueue_chunked_conversion(source, video_id, base_name, qualities, has_audio, sprites=None, job_id=None):
+    """
+    Splits a long upload into chunks and enqueues one RQ job per chunk. A final job,
+    which only starts once every chunk job has finished, stitches the chunk playlists.
+    The jobs get ids derived from job_id, the id of the conversion, see is_lost.
+    """
+    chunks = split_into_chunks(source, chunk_directory(base_name), settings.HLS_CHUNK_DURATION)
+    queue = django_rq.get_queue('default')
+    timeout = getattr(settings, 'HLS_CHUNK_JOB_TIMEOUT', 1800)
+
+    # Chunk results have to outlive the slowest sibling, otherwise RQ can't resolve the dependency.
+    chunk_jobs = [
+        queue.enqueue(
+            convert_chunk_to_hls,
+            args=(chunk, start, index, base_name, qualities, has_audio, video_id, end - start, sprites),
+            job_timeout=timeout,
+            result_ttl=86400,
+            retry=transcode_retry(),
+            job_id=f'{job_id}-chunk{chunk_suffix(index)}' if job_id else None
+        )
+        for index, (chunk, start, end) in enumerate(chunks)
+    ]
+    queue.enqueue(
+        stitch_chunked_hls,
+        args=(source, video_id, base_name, qualities, len(chunks)),
+        depends_on=chunk_jobs,
+        job_id=stitch_job_id(job_id) if job_id else None,
+        job_timeout=timeout,
+        result_ttl=0,
+        retry=transcode_retry()
+    )
+    print(f'Enqueued {len(chunks)} chunk jobs for {source}')
+
+def convert_chunk_to_hls(chunk, start, index, base_name, qualities, has_audio, video_id=None, duration=None, sprites=None):
+    """
+    Encodes one chunk into every quality. Timestamps are shifted by the chunk start,
+    so the stitched playlists play continuously. A retried job only encodes the
+    chunk renditions that were not checkpointed yet.
+    """
+    suffix = chunk_suffix(index)
     try:
-        for quality, (resolution, bitrate) in QUALITIES.items():
-            cmd = generate_ffmpeg_command(source, base_name, quality, resolution, bitrate)
-            print(f'Running command: {" ".join(cmd)}')
-            result = subprocess.run(cmd, shell=False, text=True, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            print(f'STDOUT: {result.stdout}')
-            print(f'STDERR: {result.stderr}')
-            print(f'Finished converting {source} to {quality} HLS')
+        pending = pending_qualities(base_name, qualities, suffix)
+        if pending:
+            cmd = generate_single_pass_ffmpeg_command(
+                chunk, base_name, pending, has_audio, name_suffix=suffix, ts_offset=start, sprites=sprites
+            )
+            run_ffmpeg(cmd, progress_reporter(video_id, [f'{quality}{suffix}' for quality in pending], duration))
+            for quality in pending:
+                save_checkpoint(base_name, f'{quality}{suffix}')
+            if sprites and duration:
+                write_sprite_vtt(base_name, sprites, duration, name_suffix=suffix, start=start)
+    except Exception as e:
+        print(f'Error converting chunk {index} of {base_name}: {str(e)}')
+        if video_id:
+            update_status(video_id, 'failed')
+        raise
+    if os.path.exists(chunk):
+        os.remove(chunk)
+    print(f'Finished converting chunk {index} of {base_name}')
+
+def stitch_playlists(playlists, output):
+    """
+    Concatenates the segment entries of several VOD playlists into one playlist.
+    fMP4 chunks bring their own initialization section (EXT-X-MAP), so a discontinuity
+    is marked where the next chunk starts.
+    """
+    header_tags = (
+        '#EXTM3U', '#EXT-X-VERSION', '#EXT-X-TARGETDURATION', '#EXT-X-MEDIA-SEQUENCE',
+        '#EXT-X-PLAYLIST-TYPE', '#EXT-X-INDEPENDENT-SEGMENTS', '#EXT-X-ENDLIST'
+    )
+    target_duration = 0
+    version = 3
+    entries = []
+    for playlist in playlists:
+        with open(playlist) as f:
+            lines = [line.strip() for line in f]
+        if entries and any(line.startswith('#EXT-X-MAP:') for line in lines):
+            entries.append('#EXT-X-DISCONTINUITY')
+        for line in lines:
+            if line.startswith('#EXT-X-TARGETDURATION:'):
+                target_duration = max(target_duration, int(line.split(':', 1)[1]))
+            elif line.startswith('#EXT-X-VERSION:'):
+                version = max(version, int(line.split(':', 1)[1]))
+            elif line and not line.startswith(header_tags):
+                entries.append(line)
+
+    with open(output, 'w') as f:
+        f.write("#EXTM3U\n")
+        f.write(f"#EXT-X-VERSION:{version}\n")
+        f.write(f"#EXT-X-TARGETDURATION:{target_duration}\n")
+        f.write("#EXT-X-MEDIA-SEQUENCE:0\n")
+        f.write("#EXT-X-PLAYLIST-TYPE:VOD\n")
+        for entry in entries:
+            f.write(f"{entry}\n")
+        f.write("#EXT-X-ENDLIST\n")
+
+def stitch_chunked_hls(source, video_id, base_name, qualities, chunk_count):
+    """
+    Joins the chunk playlists into the per-quality playlists and finishes the conversion.
+    The chunk playlists are only deleted once the video is saved, so a retry can stitch again.
+    """
+    leftovers = [chunk_directory(base_name)]
+    for quality in qualities:
+        playlists = [os.path.join(base_name, f'{quality}{chunk_suffix(i)}.m3u8') for i in range(chunk_count)]
+        stitch_playlists(playlists, os.path.join(base_name, f'{quality}.m3u8'))
+        leftovers += playlists
+
+    leftovers += stitch_sprite_vtts(base_name, chunk_count)
+    finish_conversion(source, video_id, base_name, qualities, leftovers)
+
+def fingerprint_file(base_name, name, renamed):
+    """
+    Renames a file to <name>.<content fingerprint>.<ext>, once. renamed maps old to new names.
+    Names that already are fingerprinted are kept.
+    """
+    if is_fingerprinted(name):
+        return name
+    if name not in renamed:
+        path = os.path.join(base_name, name)
+        root, extension = os.path.splitext(name)
+        new_name = f'{root}.{file_digest(path)[:FINGERPRINT_LENGTH]}{extension}'
+        os.replace(path, os.path.join(base_name, new_name))
+        renamed[name] = new_name
+    return renamed[name]
+
+def fingerprint_references(base_name, name, renamed):
+    """
+    Fingerprints the files a playlist or sprite index points to, rewrites the references and
+    then fingerprints the rewritten file itself. Returns its new name.
+    """
+    if name in renamed:
+        return renamed[name]
 
+    def fingerprint_uri(match):
+        return f'URI="{fingerprint_file(base_name, match.group(1), renamed)}"'
 
-        create_master_playlist(base_name, QUALITIES)
+    path = os.path.join(base_name, name)
+    with open(path) as f:
+        lines = f.read().splitlines()
 
+    for i, line in enumerate(lines):
+        if line.startswith('#EXT-X-MAP:'):
+            lines[i] = re.sub(r'URI="([^"]+)"', fingerprint_uri, line)
+            continue
+        target, hash_sign, fragment = line.partition('#')
+        if target and (target in renamed or os.path.isfile(os.path.join(base_name, target))):
+            lines[i] = fingerprint_file(base_name, target, renamed) + hash_sign + fragment
+
+    with open(path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    return fingerprint_file(base_name, name, renamed)
+
+def precompress(path):
+    """
+    Writes a .gz and, if the brotli package is installed, a .br sibling of a text file,
+    so playlists are served compressed without compressing them per request.
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    with open(f'{path}.gz', 'wb') as f:
+        f.write(gzip.compress(data, compresslevel=9, mtime=0))
+    if brotli is not None:
+        with open(f'{path}.br', 'wb') as f:
+            f.write(brotli.compress(data, mode=brotli.MODE_TEXT))
+
+def previous_fingerprints(base_name):
+    """
+    Maps the names of the files an earlier attempt of the conversion fingerprinted to their new
+    names, so a retry finds its renditions and doesn't fingerprint them twice.
+    """
+    renamed = {}
+    for name in os.listdir(base_name) if os.path.isdir(base_name) else []:
+        original = unfingerprinted_name(name)
+        if original != name and not os.path.exists(os.path.join(base_name, original)):
+            renamed[original] = name
+    return renamed
+
+def fingerprint_output(base_name, qualities):
+    """
+    Gives every file of a finished output a content-hashed name, so it can be cached as
+    immutable, and precompresses the playlists and the sprite index. Files fingerprinted by
+    an earlier attempt keep their names. Returns the new names of the master playlist and
+    the sprite index.
+    """
+    renamed = previous_fingerprints(base_name)
+    has_sprites = 'sprites.vtt' in renamed or os.path.isfile(os.path.join(base_name, 'sprites.vtt'))
+    indexes = [fingerprint_references(base_name, f'{quality}.m3u8', renamed) for quality in qualities]
+    master = fingerprint_references(base_name, 'playlist.m3u8', renamed)
+    indexes.append(master)
+    sprites = fingerprint_references(base_name, 'sprites.vtt', renamed) if has_sprites else None
+    if sprites:
+        indexes.append(sprites)
+    for name in indexes:
+        precompress(os.path.join(base_name, name))
+    return master, sprites
+
+def delete_paths(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        elif os.path.exists(path):
+            os.remove(path)
+
+def finish_conversion(source, video_id, base_name, qualities, leftovers=()):
+    """
+    Writes the master playlist, stores it and the sprite index on the video and removes the
+    uploaded file. With settings.HLS_FINGERPRINT the files get content-hashed names first.
+    The output is registered under the source digest so later duplicates can share it, in the
+    same transaction as the video is saved. The checkpoints and leftovers, files only needed
+    to build the output, are deleted once that committed, so a failed attempt can be retried.
+    """
+    create_master_playlist(base_name, qualities)
+    if getattr(settings, 'HLS_FINGERPRINT', True):
+        master, sprites = fingerprint_output(base_name, qualities)
+    else:
+        master = 'playlist.m3u8'
+        sprites = 'sprites.vtt' if os.path.isfile(os.path.join(base_name, 'sprites.vtt')) else None
+
+    shared = False
+    with transaction.atomic():
         video = Video.objects.get(id=video_id)
         video.hls_playlist = '/' + os.path.join(
             'media', 'videos', 'hls', 
             os.path.basename(source).rsplit('.', 1)[0], 
-            'playlist.m3u8'
+            master
         )
+        video.sprites_vtt = os.path.join(os.path.dirname(video.hls_playlist), sprites) if sprites else None
+        if video.source_digest:
+            output = HlsOutput.register(video.source_digest, video.hls_playlist)
+            if output.hls_playlist != video.hls_playlist:
+                print(f'Same content was converted concurrently, using {output.hls_playlist}')
+                shared = True
+                video.hls_playlist = output.hls_playlist
+                video.sprites_vtt = shared_sprites_vtt(output.hls_playlist, video_id)
         video.save()
 
+    delete_paths([base_name if shared else os.path.join(base_name, CHECKPOINT_DIR), *leftovers])
+    warm_output(video.hls_directory())
+
+    delete_mp4(source)
+    update_status(video_id, 'finished')
+
+def shared_sprites_vtt(hls_playlist, video_id):
+    """
+    The sprite index of an output converted by another video. Its names are fingerprinted, so it is
+    taken from the owning video or, if that one isn't saved yet, from the output directory.
+    """
+    owner = Video.objects.filter(hls_playlist=hls_playlist).exclude(id=video_id).values('sprites_vtt').first()
+    if owner:
+        return owner['sprites_vtt']
+    directory = Video(hls_playlist=hls_playlist).hls_directory()
+    names = os.listdir(directory) if os.path.isdir(directory) else []
+    sprites = next((name for name in sorted(names) if name.startswith('sprites') and name.endswith('.vtt')), None)
+    return os.path.join(os.path.dirname(hls_playlist), sprites) if sprites else None
+
+def share_existing_output(video, source):
+    """
+    Points the video to the HLS output of an earlier upload with the same content,
+    so it doesn't have to be converted again. Returns False if there is no such output.
+    """
+    if video.hls_playlist and HlsOutput.objects.filter(
+        source_digest=video.source_digest, hls_playlist=video.hls_playlist
+    ).exists():
+        # Already an owner, e.g. an earlier attempt of this job failed after saving the video.
         delete_mp4(source)
+        update_status(video.id, 'finished')
+        print(f'{source} was already converted to {video.hls_playlist}')
+        return True
+
+    output = HlsOutput.acquire(video.source_digest)
+    if output is None:
+        return False
+
+    probe = Video.objects.filter(
+        source_digest=video.source_digest, hls_playlist=output.hls_playlist
+    ).exclude(id=video.id).values(*PROBE_FIELDS, 'sprites_vtt').first()
+    for field, value in (probe or {}).items():
+        setattr(video, field, value)
+    video.hls_playlist = output.hls_playlist
+    video.save()
+
+    delete_mp4(source)
+    update_status(video.id, 'finished')
+    print(f'{source} is a duplicate, sharing {output.hls_playlist}')
+    return True
+
+def convert_to_hls(source, video_id):
+    """
+    Converts source file to HLS with multiple quality levels and saves files in corresponding folder.
+    Uploads whose content was converted before share the existing output instead.
+    The source is probed first, the result is stored on the video and decides which qualities
+    are encoded. Trickplay sprite sheets are written in the same pass, see sprite_layout.
+    Renditions checkpointed by an earlier attempt of this job are not encoded again.
+    The encode strategy is picked by settings.HLS_ENCODE_MODE. Uploads longer than
+    settings.HLS_CHUNKED_MIN_DURATION are split into chunks that are encoded as separate jobs.
+    """
+    print(f'Converting {source} to HLS')
+    encode = ENCODE_MODES[getattr(settings, 'HLS_ENCODE_MODE', 'single_pass')]
+    chunked_min_duration = getattr(settings, 'HLS_CHUNKED_MIN_DURATION', 0)
+    
+    update_status(video_id, 'running')
+    
+    try:
+        video = Video.objects.get(id=video_id)
+        if not video.source_digest:
+            video.source_digest = file_digest(source)
+            Video.objects.filter(id=video_id).update(source_digest=video.source_digest, updated_at=timezone.now())
+        if share_existing_output(video, source):
+            return
+
+        base_name = create_base_directory(source)
+        probe = probe_video(source)
+        Video.objects.filter(id=video_id).update(**probe, updated_at=timezone.now())
+        qualities = select_qualities(probe)
+        sprites = sprite_layout(probe)
+        print(f'Source {source} probed as {probe}, encoding {", ".join(qualities)}')
+
+        if chunked_min_duration and (probe['duration'] or 0) >= chunked_min_duration:
+            transcode_job = TranscodeJob.in_flight(video_id)
+            enqueue_chunked_conversion(
+                source, video_id, base_name, qualities, probe['has_audio'], sprites,
+                job_id=transcode_job.job_id if transcode_job else None
+            )
+            return
+
+        pending = pending_qualities(base_name, qualities)
+        if pending:
+            encode(
+                source, base_name, pending, has_audio=probe['has_audio'],
+                video_id=video_id, duration=probe['duration'], sprites=sprites
+            )
+            if sprites:
+                write_sprite_vtt(base_name, sprites, probe['duration'])
+
+        finish_conversion(source, video_id, base_name, qualities)
 
     except subprocess.CalledProcessError as e:
         print(f'Error during conversion: {e.stderr}')
+        update_status(video_id, 'failed')
         raise
     except Exception as e:
         print(f'Error saving HLS playlist: {str(e)}')
+        update_status(video_id, 'failed')
         raise
 
+DEAD_JOB_STATUSES = ('failed', 'stopped', 'canceled')
+
+def is_lost(job, queue):
+    """
+    Returns True if the RQ job behind an active TranscodeJob is gone or dead, e.g. because Redis
+    lost its data or the worker was killed, so the conversion has to be enqueued again.
+    A chunked conversion lives on in its stitch job once the parent job is gone, it is lost
+    if that job or one of the chunk jobs it waits for is gone or dead.
+    """
+    rq_job = queue.fetch_job(job.job_id)
+    if rq_job is not None:
+        return rq_job.get_status() in DEAD_JOB_STATUSES
+    if job.status == 'queued':
+        return True
+
+    stitch_job = queue.fetch_job(stitch_job_id(job.job_id))
+    if stitch_job is None or stitch_job.get_status() in DEAD_JOB_STATUSES:
+        return True
+    chunk_jobs = stitch_job.fetch_dependencies()
+    return len(chunk_jobs) < len(stitch_job.dependency_ids) or any(
+        chunk_job.get_status() in DEAD_JOB_STATUSES for chunk_job in chunk_jobs
+    )
+
+def enqueue_conversion(video):
+    """
+    The only place that enqueues convert_to_hls. The RQ job id is derived from the video and its
+    source digest, a conversion that is already queued, running or finished is not enqueued again.
+    Returns the TranscodeJob of the conversion.
+    """
+    job_id = TranscodeJob.job_id_for(video)
+    queue = django_rq.get_queue('default')
+
+    with transaction.atomic():
+        job, created = TranscodeJob.objects.get_or_create(
+            job_id=job_id,
+            defaults={'video': video, 'source_digest': video.source_digest or ''}
+        )
+        if not created:
+            job = TranscodeJob.objects.select_for_update().get(pk=job.pk)
+            if job.status == 'finished' or (job.is_active() and not is_lost(job, queue)):
+                print(f'Conversion {job_id} is already {job.status}, not enqueueing it again')
+                return job
+            job.status = 'queued'
+            job.save(update_fields=['status', 'updated_at'])
+
+        # The worker must not pick up the job before the video is committed.
+        transaction.on_commit(lambda: queue.enqueue(
+            convert_to_hls,
+            args=(video.video_file.path, video.id),
+            job_id=job_id,
+            job_timeout=getattr(settings, 'HLS_JOB_TIMEOUT', 760),
+            result_ttl=0,
+            retry=transcode_retry()
+        ))
+    print(f'Enqueued conversion {job_id}')
+    return job
+
 def delete_mp4(source):
     """
     This function deletes the mp4 file that is created for creating the HLS files.
@@ -1,27 +1,88 @@
 import subprocess
 from rest_framework.test import APITestCase
 from rest_framework import status
-from content.models import Video
+from content.models import HlsOutput, RelatedVideo, TranscodeJob, UploadSession, Video, VideoReaction, WatchProgress
+from sub_profiles.models import SubProfile
+from admin_app.admin import ContentProxy
+from content.api.seriallizers import ContentSerializer, VideoValuesSerializer
+from content.utils import DIGEST_BLOCK_SIZE, SourceDigest, file_digest, resume_digest
+from content.uploads import append_chunk, claim_writer, delete_stale_uploads, staging_path
+from content.progress import ProgressReporter, progress_key, read_progress, set_status
+from content.segment_cache import SegmentCache, segment_cache, warm_output
+from content.catalog_cache import CATALOG_TAG, cached_data
+from content.catalog_io import export_lines, import_records, read_records
+from content import counters
+from content.counters import schedule_flush
+from content import recommendations
+from content.recommendations import TfidfIndex, refresh_recommendations
+from content import trending
+from content.trending import trending_ids, trending_scores, update_trending
+from content import watch_progress
+from django.core.cache import cache
+from django_redis import get_redis_connection
+from redis.exceptions import ConnectionError as RedisConnectionError
 from django.urls import reverse
 from django.core.files.uploadedfile import SimpleUploadedFile
 from django.contrib.auth.models import User
 from rest_framework.authtoken.models import Token
+import gzip
+import io
+import json
+from datetime import date, timedelta
 import os
+import tempfile
 import unittest
+import uuid
 from unittest import mock
-from django.test import TestCase
+from django.db import DatabaseError, connection
+from django.db.models import F
+from django.test import TestCase, override_settings
 from django.conf import settings
+from django.utils import timezone
+from django.core.management import call_command
+from django.core.management.base import CommandError
 
 from content.tasks import (
-    exportJson, 
     create_base_directory, 
     create_master_playlist, 
     generate_ffmpeg_command, 
+    generate_single_pass_ffmpeg_command,
     convert_to_hls,
+    convert_chunk_to_hls,
+    enqueue_conversion,
+    shared_sprites_vtt,
+    save_checkpoint,
+    is_checkpointed,
+    pending_qualities,
+    transcode_retry,
+    run_ffmpeg,
+    probe_video,
+    select_qualities,
+    split_into_chunks,
+    stitch_playlists,
+    stitch_chunked_hls,
     delete_mp4,
+    finish_conversion,
+    sprite_layout,
+    count_valid_segments,
+    write_sprite_vtt,
+    stitch_sprite_vtts,
+    precompress,
+    brotli,
     QUALITIES
 )
 
+PROBE_1080P = {
+    'source_width': 1920,
+    'source_height': 1080,
+    'source_fps': 30.0,
+    'duration': 120.0,
+    'video_codec': 'h264',
+    'audio_codec': 'aac',
+    'has_audio': True,
+}
+
+
 class ContentViewTests(APITestCase):
     def setUp(self):
         # Benutzer und Token erstellen
@@ -99,17 +160,539 @@ class ContentViewTests(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
         self.assertEqual(Video.objects.count(), 1)
 
-class ExportJsonTests(TestCase):
-    
-    @mock.patch('content.tasks.subprocess.run')
-    def test_export_json(self, mock_run):
-        """Test that exportJson calls subprocess.run with correct command"""
-        exportJson()
-        mock_run.assert_called_once()
-        # Überprüfe, dass der Aufruf 'shell=True' enthält
-        self.assertTrue(mock_run.call_args[1]['shell'])
-        # Überprüfe, dass der Aufruf den python3 manage.py shell Befehl enthält
-        self.assertIn('python3 manage.py shell', mock_run.call_args[0][0])
+class CatalogPaginationTests(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username="testuser", password="testpassword")
+        self.client.force_authenticate(self.user)
+        today = date.today()
+        for i in range(7):
+            video = Video.objects.create(
+                title=f"Video {i}",
+                description="Description",
+                views=i * 5,
+                category='music' if i % 2 else 'news',
+                video_file=SimpleUploadedFile("dummy.mp4", b"file_content", content_type="video/mp4")
+            )
+            # Two videos per day, so the cursor has to break ties on the id
+            Video.objects.filter(pk=video.pk).update(created_at=today - timedelta(days=20 * (i // 2)))
+        self.url = reverse('video_list')
+
+    def titles(self, response):
+        return [video['title'] for video in response.data['results']]
+
+    def test_pages_follow_the_cursor(self):
+        """Test that following next walks the whole catalog newest first without gaps or repeats"""
+        titles = []
+        url = f'{self.url}?limit=3'
+        while url:
+            with self.assertNumQueries(1):
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            titles += self.titles(response)
+            url = response.data['next']
+
+        self.assertEqual(titles, [f"Video {i}" for i in (1, 0, 3, 2, 5, 4, 6)])
+
+    def test_filters(self):
+        """Test that category, is_new and is_popular narrow the paginated catalog"""
+        response = self.client.get(self.url, {'limit': 10, 'category': 'music', 'is_new': 'true'})
+        self.assertEqual(self.titles(response), ["Video 1", "Video 3"])
+
+        response = self.client.get(self.url, {'limit': 10, 'is_popular': '1'})
+        self.assertEqual(self.titles(response), ["Video 3", "Video 2", "Video 5", "Video 4", "Video 6"])
+
+    def test_unpaginated_list_stays_a_list(self):
+        """Test that the catalog without limit or cursor is still returned whole"""
+        response = self.client.get(self.url, {'category': 'news'})
+
+        self.assertEqual(len(response.data), 4)
+
+    def test_invalid_cursor(self):
+        """Test that a malformed cursor is answered with 404"""
+        response = self.client.get(self.url, {'cursor': 'not-a-cursor'})
+
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class SparseFieldsetTests(APITestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username="testuser", password="testpassword")
+        self.client.force_authenticate(self.user)
+        for i in range(3):
+            Video.objects.create(
+                title=f"Video {i}",
+                description="Description",
+                category='news',
+                duration=12.5,
+                thumbnail=SimpleUploadedFile("thumb.jpg", b"image", content_type="image/jpeg") if i else None,
+            )
+        self.url = reverse('video_list')
+
+    def test_fields_match_full_representation(self):
+        """Test that the sparse rows hold the same values as ContentSerializer"""
+        fields = 'id,title,thumbnail,created_at,updated_at,duration'
+        response = self.client.get(self.url, {'fields': fields})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        full = {video['id']: video for video in ContentSerializer(Video.objects.all(), many=True).data}
+        for row in response.data:
+            self.assertEqual(list(row), fields.split(','))
+            self.assertEqual(row, {name: full[row['id']][name] for name in fields.split(',')})
+
+    def test_compact(self):
+        """Test that compact=true returns the compact fields only"""
+        response = self.client.get(self.url, {'compact': 'true'})
+
+        self.assertEqual(tuple(response.data[0]), VideoValuesSerializer.COMPACT_FIELDS)
+        self.assertNotIn('description', response.data[0])
+
+    def test_paginated_fields(self):
+        """Test that sparse rows can be paginated without selecting the cursor fields"""
+        response = self.client.get(self.url, {'fields': 'title', 'limit': 2})
+        self.assertEqual(response.data['results'], [{'title': 'Video 2'}, {'title': 'Video 1'}])
+
+        response = self.client.get(response.data['next'])
+        self.assertEqual(response.data['results'], [{'title': 'Video 0'}])
+
+    def test_unknown_field(self):
+        """Test that unknown fields are rejected with 400"""
+        response = self.client.get(self.url, {'fields': 'title,password'})
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('password', str(response.data['fields']))
+
+
+class HomeViewTests(APITestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username="testuser", password="testpassword")
+        self.client.force_authenticate(self.user)
+        today = date.today()
+        for i in range(6):
+            video = Video.objects.create(
+                title=f"Video {i}",
+                description="Description",
+                views=i * 4,
+                category='music' if i % 2 else 'news',
+            )
+            Video.objects.filter(pk=video.pk).update(created_at=today - timedelta(days=15 * i))
+        self.url = reverse('home')
+
+    def titles(self, videos):
+        return [video['title'] for video in videos]
+
+    def test_rows(self):
+        """Test that the home screen holds the newest videos per category, the new and the popular ones"""
+        with self.assertNumQueries(1):
+            response = self.client.get(self.url, {'limit': 2})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            [(row['category'], row['label'], self.titles(row['videos'])) for row in response.data['categories']],
+            [('music', 'Music', ["Video 1", "Video 3"]), ('news', 'News', ["Video 0", "Video 2"])]
+        )
+        self.assertEqual(self.titles(response.data['new']), ["Video 0", "Video 1"])
+        self.assertEqual(self.titles(response.data['popular']), ["Video 5", "Video 4"])
+
+    def test_thresholds(self):
+        """Test that the new and popular rows only hold videos that are new or popular"""
+        response = self.client.get(self.url, {'limit': 10})
+
+        self.assertEqual(self.titles(response.data['new']), ["Video 0", "Video 1", "Video 2"])
+        self.assertEqual(self.titles(response.data['popular']), ["Video 5", "Video 4", "Video 3"])
+
+    def test_compact_rows(self):
+        """Test that the rows hold the compact fields unless fields are asked for"""
+        response = self.client.get(self.url)
+        self.assertEqual(tuple(response.data['new'][0]), VideoValuesSerializer.COMPACT_FIELDS)
+
+        response = self.client.get(self.url, {'fields': 'title'})
+        self.assertEqual(response.data['new'][0], {'title': "Video 0"})
+
+    def test_cached(self):
+        """Test that the home screen is cached until the catalog changes"""
+        self.client.get(self.url)
+        with self.assertNumQueries(0):
+            self.client.get(self.url)
+
+        Video.objects.create(title="Fresh", description="Description", category='news')
+        response = self.client.get(self.url)
+        self.assertEqual(response.data['new'][0]['title'], "Fresh")
+
+
+class SearchTests(APITestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username="testuser", password="testpassword")
+        self.client.force_authenticate(self.user)
+        Video.objects.create(title="Mountain Running", description="Trail runs in the alps", category='sports')
+        Video.objects.create(title="Cooking Basics", description="Running a kitchen and cooking pasta", category='education')
+        Video.objects.create(title="Space Documentary", description="Rockets and planets", category='ducumentary')
+
+    def titles(self, response):
+        return [video['title'] for video in response.data['results']]
+
+    @mock.patch('content.signals.TrigramExtension')
+    def test_migrate_creates_trigram_extension(self, mock_extension):
+        """Test that migrate creates pg_trgm before the trigram index needs it"""
+        call_command('migrate', verbosity=0)
+
+        mock_extension.return_value.database_forwards.assert_called_once()
+        self.assertEqual(mock_extension.return_value.database_forwards.call_args[0][0], 'content')
+
+    def test_search_ranks_titles_first(self):
+        """Test that stemmed matches are returned with title matches ranked first"""
+        response = self.client.get(reverse('search'), {'q': 'runs'})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.titles(response), ["Mountain Running", "Cooking Basics"])
+        self.assertEqual(tuple(response.data['results'][0]), VideoValuesSerializer.COMPACT_FIELDS)
+
+    def test_search_syntax_and_filters(self):
+        """Test that web search syntax and the catalog filters apply"""
+        response = self.client.get(reverse('search'), {'q': 'running -pasta'})
+        self.assertEqual(self.titles(response), ["Mountain Running"])
+
+        response = self.client.get(reverse('search'), {'q': 'running', 'category': 'education'})
+        self.assertEqual(self.titles(response), ["Cooking Basics"])
+
+    def test_search_pagination(self):
+        """Test that results are paginated with limit and offset"""
+        response = self.client.get(reverse('search'), {'q': 'running', 'limit': 1})
+        self.assertEqual(self.titles(response), ["Mountain Running"])
+
+        response = self.client.get(response.data['next'])
+        self.assertEqual(self.titles(response), ["Cooking Basics"])
+        self.assertIsNone(response.data['next'])
+
+    def test_search_is_cached_until_catalog_changes(self):
+        """Test that repeated searches are served from the cache and new videos are found"""
+        self.client.get(reverse('search'), {'q': 'rockets'})
+        with self.assertNumQueries(0):
+            self.client.get(reverse('search'), {'q': 'rockets'})
+
+        Video.objects.create(title="Rockets", description="Launches")
+        response = self.client.get(reverse('search'), {'q': 'rockets'})
+        self.assertEqual(self.titles(response), ["Rockets", "Space Documentary"])
+
+    def test_search_requires_text(self):
+        """Test that an empty search is rejected"""
+        response = self.client.get(reverse('search'), {'q': ' '})
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_autocomplete_matches_prefixes_and_typos(self):
+        """Test that autocomplete finds titles by word prefix and with a typo"""
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")
+            if not cursor.fetchone():
+                self.skipTest('pg_trgm is not installed')
+
+        response = self.client.get(reverse('search_autocomplete'), {'q': 'mountai'})
+        self.assertEqual([video['title'] for video in response.data], ["Mountain Running"])
+
+        response = self.client.get(reverse('search_autocomplete'), {'q': 'documantary'})
+        self.assertEqual([video['title'] for video in response.data], ["Space Documentary"])
+
+
+class RecommendationTests(APITestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username="testuser", password="testpassword")
+        self.client.force_authenticate(self.user)
+        patcher = mock.patch('content.recommendations.schedule_refresh')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(get_redis_connection('default').delete, recommendations.DIRTY_KEY)
+        self.rockets = Video.objects.create(title="Rockets", description="Rocket launches and space flight", category='tech')
+        self.space = Video.objects.create(title="Space Flight", description="Astronauts in space", category='tech')
+        self.pasta = Video.objects.create(title="Pasta", description="Cooking pasta at home", category='education')
+
+    def related_titles(self, video):
+        return [related.related.title for related in RelatedVideo.objects.filter(video=video).order_by('rank')]
+
+    def test_tfidf_neighbours(self):
+        """Test that the neighbours are the most similar other videos, best first"""
+        index = TfidfIndex([
+            (1, "Rockets", "rocket launches", 'tech'),
+            (2, "Rocket launches", "rocket engines", 'tech'),
+            (3, "Pasta", "cooking", 'education'),
+            (4, "Cooking", "rocket pasta", 'education'),
+            (5, "Gadgets", "phones", 'tech'),
+        ])
+
+        neighbours = dict(index.neighbours([0, 2], k=2, batch_size=1))
+
+        self.assertEqual([video_id for video_id, score in neighbours[1]], [2, 4])
+        self.assertGreater(neighbours[1][0][1], neighbours[1][1][1])
+        self.assertEqual([video_id for video_id, score in neighbours[3]], [4])
+
+    def test_first_refresh_rebuilds_the_catalog(self):
+        """Test that the first refresh computes the neighbours of every video"""
+        refresh_recommendations()
+
+        self.assertEqual(self.related_titles(self.rockets), ["Space Flight"])
+        self.assertEqual(self.related_titles(self.pasta), [])
+
+    def test_refresh_updates_affected_videos(self):
+        """Test that a new video shows up as neighbour of the videos it resembles"""
+        refresh_recommendations()
+        tacos = Video.objects.create(title="Tacos", description="Cooking tacos at home", category='education')
+
+        refresh_recommendations()
+
+        self.assertEqual(self.related_titles(self.pasta), ["Tacos"])
+        self.assertEqual(self.related_titles(tacos), ["Pasta"])
+        self.assertEqual(self.related_titles(self.rockets), ["Space Flight"])
+
+    def test_deleted_video_is_replaced(self):
+        """Test that the videos listing a deleted video get new neighbours"""
+        satellites = Video.objects.create(title="Satellites", description="Space launches", category='tech')
+        refresh_recommendations()
+        self.space.delete()
+
+        refresh_recommendations()
+
+        self.assertEqual(self.related_titles(self.rockets), ["Satellites"])
+
+    def test_detail_returns_related(self):
+        """Test that the detail view returns the related videos in the compact representation"""
+        refresh_recommendations()
+
+        response = self.client.get(reverse('video_detail', kwargs={'pk': self.rockets.pk}))
+
+        self.assertEqual([video['title'] for video in response.data['related']], ["Space Flight"])
+        self.assertEqual(tuple(response.data['related'][0]), VideoValuesSerializer.COMPACT_FIELDS)
+
+
+class CatalogCacheTests(APITestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username="testuser", password="testpassword")
+        self.client.force_authenticate(self.user)
+        self.video = Video.objects.create(title="Cached", description="Description", category='news')
+        self.url = reverse('video_list')
+
+    def test_second_request_skips_the_database(self):
+        """Test that a repeated catalog request is answered from the cache"""
+        self.client.get(self.url)
+        with self.assertNumQueries(0):
+            response = self.client.get(self.url)
+
+        self.assertEqual(response.data[0]['title'], "Cached")
+
+    def test_save_invalidates_list_and_detail(self):
+        """Test that saving a video drops the cached list and its detail"""
+        detail_url = reverse('video_detail', kwargs={'pk': self.video.pk})
+        self.client.get(self.url)
+        self.client.get(detail_url)
+
+        self.video.title = "Renamed"
+        self.video.save()
+
+        self.assertEqual(self.client.get(self.url).data[0]['title'], "Renamed")
+        self.assertEqual(self.client.get(detail_url).data['title'], "Renamed")
+
+    def test_delete_invalidates_list(self):
+        """Test that a deleted video disappears from the cached list"""
+        self.client.get(self.url)
+        self.video.delete()
+
+        self.assertEqual(self.client.get(self.url).data, [])
+
+    def test_proxy_save_and_delete_invalidate(self):
+        """Test that saves and deletes of the admin's proxy model invalidate the cache"""
+        detail_url = reverse('video_detail', kwargs={'pk': self.video.pk})
+        self.client.get(self.url)
+        self.client.get(detail_url)
+
+        proxy = ContentProxy.objects.get(pk=self.video.pk)
+        proxy.title = "Renamed"
+        proxy.save()
+
+        self.assertEqual(self.client.get(self.url).data[0]['title'], "Renamed")
+        self.assertEqual(self.client.get(detail_url).data['title'], "Renamed")
+
+        proxy.delete()
+
+        self.assertEqual(self.client.get(self.url).data, [])
+
+    def test_missing_video_is_not_cached(self):
+        """Test that a 404 detail doesn't stick once the video exists"""
+        response = self.client.get(reverse('video_detail', kwargs={'pk': self.video.pk + 1}))
+
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    @override_settings(CACHE_TTL=0)
+    def test_stale_entry_served_while_locked(self):
+        """Test that an expired entry is served as is while another request recomputes it"""
+        cached_data('stale', [CATALOG_TAG], lambda: 'old')
+        with mock.patch('content.catalog_cache.cache.add', return_value=False):
+            data = cached_data('stale', [CATALOG_TAG], lambda: 'new')
+
+        self.assertEqual(data, 'old')
+        self.assertEqual(cached_data('stale', [CATALOG_TAG], lambda: 'new'), 'new')
+
+    @override_settings(CATALOG_CACHE_WAIT=0.2)
+    def test_miss_computes_after_waiting_for_lock(self):
+        """Test that a miss waits for the lock holder and computes itself if it never finishes"""
+        compute = mock.Mock(return_value='data')
+        with mock.patch('content.catalog_cache.cache.add', return_value=False):
+            self.assertEqual(cached_data('missing', [], compute), 'data')
+        compute.assert_called_once()
+
+
+class ConditionalGetTests(APITestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username="testuser", password="testpassword")
+        self.client.force_authenticate(self.user)
+        self.video = Video.objects.create(title="Cached", description="Description", category='news')
+        self.list_url = reverse('video_list')
+        self.detail_url = reverse('video_detail', kwargs={'pk': self.video.pk})
+
+    def test_matching_etag_returns_304_without_queries(self):
+        """Test that an unchanged list and detail are answered with 304 without touching the database"""
+        for url in (self.list_url, self.detail_url):
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertIn('Last-Modified', response)
+
+            with self.assertNumQueries(0):
+                response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+            self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+            self.assertEqual(response.content, b'')
+
+    def test_save_changes_the_etag(self):
+        """Test that saving a video invalidates the ETags of the list and its detail"""
+        etags = [self.client.get(url)['ETag'] for url in (self.list_url, self.detail_url)]
+        self.video.title = "Renamed"
+        self.video.save()
+
+        for url, etag in zip((self.list_url, self.detail_url), etags):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertNotEqual(response['ETag'], etag)
+
+    def test_etag_depends_on_query(self):
+        """Test that filtered lists don't share an ETag with the whole catalog"""
+        etag = self.client.get(self.list_url)['ETag']
+
+        response = self.client.get(self.list_url, {'category': 'news'}, HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_if_modified_since(self):
+        """Test that If-Modified-Since with the returned Last-Modified is answered with 304"""
+        last_modified = self.client.get(self.detail_url)['Last-Modified']
+
+        response = self.client.get(self.detail_url, HTTP_IF_MODIFIED_SINCE=last_modified)
+
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_updated_at_is_set(self):
+        """Test that updated_at moves forward on save"""
+        updated_at = self.video.updated_at
+        self.video.save()
+
+        self.assertGreater(self.video.updated_at, updated_at)
+
+
+class CatalogExportImportTests(APITestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.video1 = Video.objects.create(title="First", description="Line one\nline two, with \"quotes\"", category='news', views=3)
+        self.video2 = Video.objects.create(title="Second", description="Description", duration=12.5, has_audio=True)
+        patcher = mock.patch('content.catalog_io.mark_changed')
+        self.mark_changed = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def export(self, format):
+        return ''.join(export_lines(format, chunk_size=1))
+
+    def test_ndjson_round_trip(self):
+        """Test that an NDJSON export imports again as the same videos"""
+        exported = self.export('ndjson')
+        self.assertEqual(len(exported.splitlines()), 2)
+        Video.objects.all().delete()
+
+        self.assertEqual(import_records(read_records(io.StringIO(exported)), batch_size=1), 2)
+
+        video = Video.objects.get(pk=self.video1.pk)
+        self.assertEqual((video.title, video.description, video.views, video.created_at),
+                         (self.video1.title, self.video1.description, 3, self.video1.created_at))
+        self.assertEqual(Video.objects.get(pk=self.video2.pk).duration, 12.5)
+        self.assertEqual(self.mark_changed.call_count, 2)
+
+    def test_csv_round_trip(self):
+        """Test that a CSV export imports again, empty cells becoming NULL"""
+        exported = self.export('csv')
+        Video.objects.all().delete()
+
+        import_records(read_records(io.StringIO(exported, newline=''), 'csv'))
+
+        video = Video.objects.get(pk=self.video1.pk)
+        self.assertEqual(video.description, self.video1.description)
+        self.assertIsNone(video.duration)
+        self.assertIsNone(video.has_audio)
+        self.assertTrue(Video.objects.get(pk=self.video2.pk).has_audio)
+
+    def test_import_updates_existing_videos_and_resets_ids(self):
+        """Test that imported ids update existing videos and later videos get new ids"""
+        record = {'id': self.video2.pk + 100, 'title': "Imported", 'description': "Description"}
+        updated = {'id': self.video1.pk, 'title': "Renamed", 'description': "Description"}
+
+        import_records([record, updated])
+
+        self.assertEqual(Video.objects.get(pk=self.video1.pk).title, "Renamed")
+        self.assertEqual(Video.objects.get(pk=record['id']).title, "Imported")
+        self.assertGreater(Video.objects.create(title="Next", description="Description").pk, record['id'])
+
+    def test_invalid_record(self):
+        """Test that invalid records raise ValueError with their position"""
+        with self.assertRaisesMessage(ValueError, 'Line 2'):
+            import_records(read_records(io.StringIO('{"title": "Ok", "description": "d"}\nnot json\n')))
+        with self.assertRaisesMessage(ValueError, 'Record 1: views'):
+            import_records([{'title': "Bad", 'description': "d", 'views': "many"}])
+
+    def test_export_endpoint_streams(self):
+        """Test that admins get the catalog as a streamed download"""
+        url = reverse('catalog_export')
+        self.client.force_authenticate(User.objects.create_user(username="user", password="password"))
+        self.assertEqual(self.client.get(url).status_code, status.HTTP_403_FORBIDDEN)
+
+        self.client.force_authenticate(User.objects.create_superuser(username="admin", password="adminpassword"))
+        response = self.client.get(url, {'type': 'csv'})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        self.assertIn('catalog.csv', response['Content-Disposition'])
+        self.assertEqual(b''.join(response.streaming_content).decode(), self.export('csv'))
+        self.assertEqual(self.client.get(url, {'type': 'xml'}).status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_management_commands(self):
+        """Test that export_catalog and import_catalog round trip through a file"""
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'catalog.ndjson')
+            call_command('export_catalog', output=path, stderr=io.StringIO())
+            Video.objects.all().delete()
+            out = io.StringIO()
+            call_command('import_catalog', path, stdout=out)
+
+        self.assertIn('Imported 2 videos', out.getvalue())
+        self.assertEqual(Video.objects.count(), 2)
+        with self.assertRaises(CommandError):
+            call_command('import_catalog', '/nonexistent/catalog.ndjson')
 
 
 class CreateBaseDirectoryTests(TestCase):
@@ -186,7 +769,115 @@ class GenerateFfmpegCommandTests(TestCase):
         
         self.assertEqual(result, expected_cmd)
 
+    def test_generate_ffmpeg_command_with_threads(self):
+        """Test that the thread limit is passed right before the output file"""
+        result = generate_ffmpeg_command('/path/to/video.mp4', '/media/videos/hls/video', '720p', '1280x720', '2800k', threads=2)
+
+        self.assertEqual(result[-3:], ['-threads', '2', '/media/videos/hls/video/720p.m3u8'])
+
+
+class ProbeVideoTests(TestCase):
+
+    @mock.patch('content.tasks.subprocess.run')
+    def test_probe_video(self, mock_run):
+        """Test that the ffprobe JSON is reduced to the probe fields of Video"""
+        mock_run.return_value = mock.Mock(stdout=json.dumps({
+            'streams': [
+                {'codec_type': 'video', 'codec_name': 'h264', 'width': 1280, 'height': 720, 'avg_frame_rate': '30000/1001'},
+                {'codec_type': 'audio', 'codec_name': 'aac'},
+            ],
+            'format': {'duration': '61.5'},
+        }))
+
+        probe = probe_video('/path/to/video.mp4')
+
+        self.assertEqual(probe['source_width'], 1280)
+        self.assertEqual(probe['source_height'], 720)
+        self.assertAlmostEqual(probe['source_fps'], 29.97, places=2)
+        self.assertEqual(probe['duration'], 61.5)
+        self.assertEqual(probe['video_codec'], 'h264')
+        self.assertEqual(probe['audio_codec'], 'aac')
+        self.assertTrue(probe['has_audio'])
+
+    @mock.patch('content.tasks.subprocess.run')
+    def test_probe_video_without_audio(self, mock_run):
+        """Test that a source without audio stream is recognised"""
+        mock_run.return_value = mock.Mock(stdout=json.dumps({
+            'streams': [{'codec_type': 'video', 'codec_name': 'vp9', 'width': 640, 'height': 360, 'avg_frame_rate': '0/0', 'r_frame_rate': '25/1'}],
+            'format': {},
+        }))
+
+        probe = probe_video('/path/to/video.webm')
 
+        self.assertFalse(probe['has_audio'])
+        self.assertEqual(probe['audio_codec'], '')
+        self.assertEqual(probe['source_fps'], 25.0)
+        self.assertIsNone(probe['duration'])
+
+
+class SelectQualitiesTests(TestCase):
+
+    def test_no_upscaling(self):
+        """Test that only qualities up to the source height are selected"""
+        qualities = select_qualities(dict(PROBE_1080P, source_width=1280, source_height=720))
+
+        self.assertEqual(qualities, {'720p': ('1280x720', '2800k'), '480p': ('854x480', '1400k')})
+
+    def test_bitrate_follows_frame_rate(self):
+        """Test that 60 fps sources get twice the reference bitrate"""
+        qualities = select_qualities(dict(PROBE_1080P, source_fps=60.0))
+
+        self.assertEqual(qualities['1080p'], ('1920x1080', '10000k'))
+        self.assertEqual(qualities['480p'], ('854x480', '2800k'))
+
+    def test_small_source_keeps_own_resolution(self):
+        """Test that a source below the lowest quality is not upscaled"""
+        qualities = select_qualities(dict(PROBE_1080P, source_width=641, source_height=360, source_fps=24.0))
+
+        self.assertEqual(qualities, {'480p': ('640x360', '1120k')})
+
+    def test_aspect_ratio_is_kept(self):
+        """Test that portrait and 4:3 sources are compared on their short side and not stretched"""
+        portrait = select_qualities(dict(PROBE_1080P, source_width=1080, source_height=1920))
+        four_three = select_qualities(dict(PROBE_1080P, source_width=960, source_height=720))
+
+        self.assertEqual(portrait['1080p'][0], '1080x1920')
+        self.assertEqual(portrait['720p'][0], '720x1280')
+        self.assertEqual(portrait['480p'][0], '480x854')
+        self.assertEqual(four_three, {'720p': ('960x720', '2800k'), '480p': ('640x480', '1400k')})
+
+    def test_unknown_resolution_keeps_full_ladder(self):
+        """Test that a failed resolution probe falls back to all qualities"""
+        self.assertEqual(select_qualities({'source_width': None, 'source_height': None}), QUALITIES)
+
+
+class GenerateSinglePassFfmpegCommandTests(TestCase):
+
+    def test_single_pass_command_splits_decoded_video(self):
+        """Test that one command maps every quality through a split filter graph"""
+        base_name = '/media/videos/hls/video'
+        cmd = generate_single_pass_ffmpeg_command('/path/to/video.mp4', base_name, QUALITIES)
+
+        self.assertEqual(cmd.count('-i'), 1)
+        filter_graph = cmd[cmd.index('-filter_complex') + 1]
+        self.assertTrue(filter_graph.startswith('[0:v]split=3[v0][v1][v2]'))
+        self.assertIn('[v1]scale=1280:720[v1out]', filter_graph)
+        self.assertEqual(cmd[cmd.index('-b:v:2') + 1], '1400k')
+        self.assertEqual(
+            cmd[cmd.index('-var_stream_map') + 1],
+            'v:0,a:0,name:1080p v:1,a:1,name:720p v:2,a:2,name:480p'
+        )
+        self.assertEqual(cmd[-1], f'{base_name}/%v.m3u8')
+
+    def test_single_pass_command_without_audio(self):
+        """Test that no audio stream is mapped for silent sources"""
+        cmd = generate_single_pass_ffmpeg_command('/path/to/video.mp4', '/tmp/hls', {'720p': ('1280x720', '2800k')}, has_audio=False)
+
+        self.assertNotIn('0:a:0', cmd)
+        self.assertEqual(cmd[cmd.index('-var_stream_map') + 1], 'v:0,name:720p')
+
+
+@override_settings(HLS_SPRITE_INTERVAL=0, HLS_FINGERPRINT=False)
 class ConvertToHlsTests(TestCase):
     
     def setUp(self):
@@ -197,20 +888,27 @@ class ConvertToHlsTests(TestCase):
             likes=0,
             dislikes=0,
             views=0,
-            video_file=SimpleUploadedFile("test.mp4", b"file_content", content_type="video/mp4")
+            video_file=SimpleUploadedFile("test.mp4", b"file_content", content_type="video/mp4"),
+            source_digest='a' * 64
         )
         self.source = os.path.join(settings.MEDIA_ROOT, 'test.mp4')
         self.base_name = os.path.join(settings.MEDIA_ROOT, 'videos', 'hls', 'test')
+        # ffmpeg is mocked, so there are no renditions to checkpoint
+        self.mock_save_checkpoint = mock.patch('content.tasks.save_checkpoint').start()
+        self.addCleanup(mock.patch.stopall)
     
+    @override_settings(HLS_ENCODE_MODE='per_rendition')
+    @mock.patch('content.tasks.probe_video', return_value=PROBE_1080P)
     @mock.patch('content.tasks.delete_mp4')
     @mock.patch('content.tasks.create_master_playlist')
-    @mock.patch('content.tasks.subprocess.run')
+    @mock.patch('content.tasks.subprocess.Popen')
     @mock.patch('content.tasks.create_base_directory')
-    def test_convert_to_hls_success(self, mock_create_base_dir, mock_run, mock_create_master, mock_delete_mp4):
+    def test_convert_to_hls_success(self, mock_create_base_dir, mock_popen, mock_create_master, mock_delete_mp4, mock_probe):
         """Test the full conversion process"""
         # Mocks konfigurieren
         mock_create_base_dir.return_value = self.base_name
-        mock_run.return_value = mock.Mock(stdout="", stderr="")
+        mock_popen.return_value.stdout = []
+        mock_popen.return_value.wait.return_value = 0
         mock_create_master.return_value = 'videos/hls/test/playlist.m3u8'
         
         # Funktion aufrufen
@@ -219,8 +917,8 @@ class ConvertToHlsTests(TestCase):
         # Überprüfen der Aufrufe
         mock_create_base_dir.assert_called_once_with(self.source)
         
-        # Überprüfen, dass subprocess.run für jede Qualität aufgerufen wurde
-        self.assertEqual(mock_run.call_count, len(QUALITIES))
+        # Überprüfen, dass ffmpeg für jede Qualität gestartet wurde
+        self.assertEqual(mock_popen.call_count, len(QUALITIES))
         
         # Überprüfen, dass create_master_playlist aufgerufen wurde
         mock_create_master.assert_called_once_with(self.base_name, QUALITIES)
@@ -233,6 +931,70 @@ class ConvertToHlsTests(TestCase):
         expected_path = '/media/videos/hls/test/playlist.m3u8'
         self.assertEqual(self.video.hls_playlist, expected_path)
     
+    @override_settings(HLS_ENCODE_MODE='single_pass')
+    @mock.patch('content.tasks.delete_mp4')
+    @mock.patch('content.tasks.create_master_playlist')
+    @mock.patch('content.tasks.probe_video', return_value=PROBE_1080P)
+    @mock.patch('content.tasks.subprocess.Popen')
+    @mock.patch('content.tasks.create_base_directory')
+    def test_convert_to_hls_single_pass(self, mock_create_base_dir, mock_popen, mock_probe, mock_create_master, mock_delete_mp4):
+        """Test that single pass mode runs ffmpeg only once for all qualities"""
+        mock_create_base_dir.return_value = self.base_name
+        mock_popen.return_value.stdout = []
+        mock_popen.return_value.wait.return_value = 0
+
+        convert_to_hls(self.source, self.video.id)
+
+        mock_popen.assert_called_once()
+        self.assertIn('-var_stream_map', mock_popen.call_args[0][0])
+        self.video.refresh_from_db()
+        self.assertEqual(self.video.source_height, 1080)
+        self.assertEqual(self.video.duration, 120.0)
+        self.assertTrue(self.video.has_audio)
+        mock_create_master.assert_called_once_with(self.base_name, QUALITIES)
+        mock_delete_mp4.assert_called_once_with(self.source)
+
+    @override_settings(HLS_ENCODE_MODE='parallel', HLS_MAX_PARALLEL_ENCODES=2, HLS_FFMPEG_THREADS=4)
+    @mock.patch('content.tasks.probe_video', return_value=PROBE_1080P)
+    @mock.patch('content.tasks.delete_mp4')
+    @mock.patch('content.tasks.create_master_playlist')
+    @mock.patch('content.tasks.subprocess.Popen')
+    @mock.patch('content.tasks.create_base_directory')
+    def test_convert_to_hls_parallel(self, mock_create_base_dir, mock_popen, mock_create_master, mock_delete_mp4, mock_probe):
+        """Test that parallel mode starts one thread-limited ffmpeg per quality"""
+        mock_create_base_dir.return_value = self.base_name
+        mock_popen.return_value.stdout = []
+        mock_popen.return_value.wait.return_value = 0
+
+        convert_to_hls(self.source, self.video.id)
+
+        self.assertEqual(mock_popen.call_count, len(QUALITIES))
+        for call in mock_popen.call_args_list:
+            cmd = call[0][0]
+            self.assertEqual(cmd[cmd.index('-threads') + 1], '4')
+        mock_delete_mp4.assert_called_once_with(self.source)
+
+    @override_settings(HLS_ENCODE_MODE='parallel', HLS_MAX_PARALLEL_ENCODES=3)
+    @mock.patch('content.tasks.probe_video', return_value=PROBE_1080P)
+    @mock.patch('content.tasks.delete_mp4')
+    @mock.patch('content.tasks.subprocess.Popen')
+    @mock.patch('content.tasks.create_base_directory')
+    def test_convert_to_hls_parallel_failure_cancels_siblings(self, mock_create_base_dir, mock_popen, mock_delete_mp4, mock_probe):
+        """Test that a failing encode terminates the encodes still running"""
+        mock_create_base_dir.return_value = self.base_name
+        failing = mock.Mock(stdout=[])
+        failing.wait.return_value = 1
+        running = mock.Mock(stdout=[])
+        running.poll.return_value = None
+        running.wait.return_value = 0
+        mock_popen.side_effect = [running, failing, running]
+
+        with self.assertRaises(subprocess.CalledProcessError):
+            convert_to_hls(self.source, self.video.id)
+
+        running.terminate.assert_called()
+        mock_delete_mp4.assert_not_called()
+
     @mock.patch('content.tasks.subprocess.run')
     @mock.patch('content.tasks.create_base_directory')
     def test_convert_to_hls_subprocess_error(self, mock_create_base_dir, mock_run):
@@ -246,6 +1008,1463 @@ class ConvertToHlsTests(TestCase):
             convert_to_hls(self.source, self.video.id)
 
 
+class ChunkedConversionTests(TestCase):
+
+    def setUp(self):
+        self.video = Video.objects.create(
+            title="Long Video",
+            description="Description for Long Video",
+            video_file=SimpleUploadedFile("long.mp4", b"file_content", content_type="video/mp4"),
+            source_digest='b' * 64
+        )
+        self.tmp = tempfile.TemporaryDirectory()
+        self.base_name = self.tmp.name
+        self.source = os.path.join(settings.MEDIA_ROOT, 'long.mp4')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write_playlist(self, name, segments, target_duration=5):
+        with open(os.path.join(self.base_name, name), 'w') as f:
+            f.write(f"#EXTM3U\n#EXT-X-VERSION:3\n#EXT-X-TARGETDURATION:{target_duration}\n")
+            f.write("#EXT-X-MEDIA-SEQUENCE:0\n#EXT-X-PLAYLIST-TYPE:VOD\n")
+            for segment in segments:
+                f.write(f"#EXTINF:5.000000,\n{segment}\n")
+            f.write("#EXT-X-ENDLIST\n")
+
+    @mock.patch('content.tasks.run_ffmpeg')
+    def test_split_into_chunks_reads_segment_list(self, mock_run_ffmpeg):
+        """Test that the chunk start times come from the segment list ffmpeg writes"""
+        chunk_dir = os.path.join(self.base_name, 'chunks')
+
+        def write_list(cmd, progress=None):
+            with open(cmd[cmd.index('-segment_list') + 1], 'w') as f:
+                f.write("chunk_000.mp4,0.000000,300.100000\nchunk_001.mp4,300.100000,412.000000\n")
+        mock_run_ffmpeg.side_effect = write_list
+
+        chunks = split_into_chunks(self.source, chunk_dir, 300)
+
+        self.assertEqual(chunks, [
+            (os.path.join(chunk_dir, 'chunk_000.mp4'), 0.0, 300.1),
+            (os.path.join(chunk_dir, 'chunk_001.mp4'), 300.1, 412.0),
+        ])
+        self.assertIn('copy', mock_run_ffmpeg.call_args[0][0])
+
+    def test_stitch_playlists(self):
+        """Test that chunk playlists are joined into one VOD playlist"""
+        self.write_playlist('720p_c000.m3u8', ['720p_c000_000.ts', '720p_c000_001.ts'], target_duration=5)
+        self.write_playlist('720p_c001.m3u8', ['720p_c001_000.ts'], target_duration=6)
+        output = os.path.join(self.base_name, '720p.m3u8')
+
+        stitch_playlists([os.path.join(self.base_name, f'720p_c00{i}.m3u8') for i in range(2)], output)
+
+        with open(output) as f:
+            lines = f.read().splitlines()
+        self.assertIn('#EXT-X-TARGETDURATION:6', lines)
+        self.assertEqual([line for line in lines if line.endswith('.ts')],
+                         ['720p_c000_000.ts', '720p_c000_001.ts', '720p_c001_000.ts'])
+        self.assertEqual(lines.count('#EXT-X-ENDLIST'), 1)
+
+    @override_settings(HLS_CHUNKED_MIN_DURATION=600)
+    @mock.patch('content.tasks.django_rq.get_queue')
+    @mock.patch('content.tasks.split_into_chunks')
+    @mock.patch('content.tasks.probe_video', return_value=dict(PROBE_1080P, duration=3600.0))
+    @mock.patch('content.tasks.create_base_directory')
+    def test_long_upload_is_enqueued_as_chunks(self, mock_create_base_dir, mock_probe, mock_split, mock_get_queue):
+        """Test that a long upload enqueues one job per chunk plus a dependent stitch job"""
+        mock_create_base_dir.return_value = self.base_name
+        mock_split.return_value = [('chunk_000.mp4', 0.0, 300.0), ('chunk_001.mp4', 300.0, 600.0), ('chunk_002.mp4', 600.0, 700.0)]
+        queue = mock_get_queue.return_value
+
+        convert_to_hls(self.source, self.video.id)
+
+        self.assertEqual(queue.enqueue.call_count, 4)
+        stitch_call = queue.enqueue.call_args
+        self.assertEqual(stitch_call[0][0], stitch_chunked_hls)
+        self.assertEqual(len(stitch_call[1]['depends_on']), 3)
+        self.assertEqual(stitch_call[1]['job_id'], f'{TranscodeJob.objects.get().job_id}-stitch')
+        chunk_dir = mock_split.call_args[0][1]
+        self.assertEqual(chunk_dir, os.path.join(settings.HLS_CHUNK_ROOT, os.path.basename(self.base_name)))
+        self.assertFalse(chunk_dir.startswith(os.path.join(settings.MEDIA_ROOT, 'videos', 'hls')))
+        self.video.refresh_from_db()
+        self.assertIsNone(self.video.hls_playlist)
+
+    @override_settings(HLS_FINGERPRINT=False)
+    @mock.patch('content.tasks.delete_mp4')
+    def test_stitch_chunked_hls_finishes_conversion(self, mock_delete_mp4):
+        """Test that the stitch job writes every quality playlist and the master playlist"""
+        qualities = {'720p': ('1280x720', '2800k'), '480p': ('854x480', '1400k')}
+        for quality in qualities:
+            for index in range(2):
+                self.write_playlist(f'{quality}_c00{index}.m3u8', [f'{quality}_c00{index}_000.ts'])
+
+        stitch_chunked_hls(self.source, self.video.id, self.base_name, qualities, 2)
+
+        self.assertEqual(sorted(os.listdir(self.base_name)), ['480p.m3u8', '720p.m3u8', 'playlist.m3u8'])
+        mock_delete_mp4.assert_called_once_with(self.source)
+        self.video.refresh_from_db()
+        self.assertEqual(self.video.hls_playlist, '/media/videos/hls/long/playlist.m3u8')
+
+
+class SourceDigestTests(TestCase):
+
+    def test_digest_does_not_depend_on_chunking(self):
+        """Test that the digest is the same however the data is split up"""
+        data = os.urandom(DIGEST_BLOCK_SIZE + 1000)
+        whole = SourceDigest()
+        whole.update(data)
+        pieces = SourceDigest()
+        for offset in range(0, len(data), 777777):
+            pieces.update(data[offset:offset + 777777])
+
+        self.assertEqual(whole.hexdigest(), pieces.hexdigest())
+        self.assertEqual(len(pieces.block_digests), 64)
+
+    def test_digest_resumes_from_block_digests(self):
+        """Test that hashing can continue from the stored block digests"""
+        data = os.urandom(DIGEST_BLOCK_SIZE + 10)
+        first = SourceDigest()
+        first.update(data[:DIGEST_BLOCK_SIZE])
+        resumed = SourceDigest(first.block_digests)
+        resumed.update(data[DIGEST_BLOCK_SIZE:])
+        whole = SourceDigest()
+        whole.update(data)
+
+        self.assertEqual(resumed.hexdigest(), whole.hexdigest())
+
+
+class UploadDeduplicationTests(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username="testuser", password="testpassword")
+        self.client.force_authenticate(self.user)
+        self.tmp = tempfile.TemporaryDirectory()
+        self.media = override_settings(MEDIA_ROOT=self.tmp.name)
+        self.media.enable()
+
+    def tearDown(self):
+        self.media.disable()
+        self.tmp.cleanup()
+
+    def create_video(self, name, digest='c' * 64, hls_playlist=None):
+        return Video.objects.create(
+            title=name,
+            description="Description",
+            video_file=SimpleUploadedFile(f"{name}.mp4", b"file_content", content_type="video/mp4"),
+            source_digest=digest,
+            hls_playlist=hls_playlist
+        )
+
+    def test_upload_is_hashed_while_received(self):
+        """Test that the upload handlers store the content digest on the video"""
+        data = {
+            "title": "Hashed Video",
+            "description": "Description",
+            "video_file": SimpleUploadedFile("hashed.mp4", b"file_content", content_type="video/mp4")
+        }
+        response = self.client.post(reverse('video_list'), data, format='multipart')
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        expected = SourceDigest()
+        expected.update(b"file_content")
+        self.assertEqual(Video.objects.get(title="Hashed Video").source_digest, expected.hexdigest())
+
+    @mock.patch('content.tasks.delete_mp4')
+    @mock.patch('content.tasks.probe_video')
+    def test_duplicate_upload_shares_output(self, mock_probe, mock_delete_mp4):
+        """Test that a duplicate upload is not converted again"""
+        original = self.create_video("original", hls_playlist='/media/videos/hls/original/playlist.m3u8')
+        original.duration = 42.0
+        original.save()
+        HlsOutput.objects.create(source_digest=original.source_digest, hls_playlist=original.hls_playlist, ref_count=1)
+        duplicate = self.create_video("duplicate")
+
+        convert_to_hls('/path/to/duplicate.mp4', duplicate.id)
+
+        mock_probe.assert_not_called()
+        mock_delete_mp4.assert_called_once_with('/path/to/duplicate.mp4')
+        duplicate.refresh_from_db()
+        self.assertEqual(duplicate.hls_playlist, original.hls_playlist)
+        self.assertEqual(duplicate.duration, 42.0)
+        self.assertEqual(HlsOutput.objects.get().ref_count, 2)
+
+    def test_shared_output_is_deleted_with_last_owner(self):
+        """Test that the HLS directory is only removed when its last video is deleted"""
+        playlist = '/media/videos/hls/shared/playlist.m3u8'
+        first = self.create_video("first", hls_playlist=playlist)
+        second = self.create_video("second", hls_playlist=playlist)
+        HlsOutput.objects.create(source_digest=first.source_digest, hls_playlist=playlist, ref_count=2)
+        hls_dir = os.path.join(self.tmp.name, 'videos', 'hls', 'shared')
+        os.makedirs(hls_dir)
+
+        first.delete()
+        self.assertTrue(os.path.isdir(hls_dir))
+        self.assertEqual(HlsOutput.objects.get().ref_count, 1)
+
+        second.delete()
+        self.assertFalse(os.path.isdir(hls_dir))
+        self.assertFalse(HlsOutput.objects.exists())
+
+
+    def test_release_follows_the_playlist(self):
+        """Test that a video whose digest no longer matches its output still releases it"""
+        playlist = '/media/videos/hls/shared/playlist.m3u8'
+        first = self.create_video("first", hls_playlist=playlist)
+        second = self.create_video("second", hls_playlist=playlist)
+        HlsOutput.objects.create(source_digest=first.source_digest, hls_playlist=playlist, ref_count=2)
+        hls_dir = os.path.join(self.tmp.name, 'videos', 'hls', 'shared')
+        os.makedirs(hls_dir)
+        Video.objects.filter(pk=second.pk).update(source_digest='b' * 64)
+
+        Video.objects.get(pk=second.pk).delete()
+
+        self.assertTrue(os.path.isdir(hls_dir))
+        self.assertEqual(HlsOutput.objects.get().ref_count, 1)
+
+    def test_new_file_keeps_registered_digest(self):
+        """Test that replacing the file of a converted video keeps the digest of its output"""
+        video = self.create_video("converted", hls_playlist='/media/videos/hls/converted/playlist.m3u8')
+        upload = SimpleUploadedFile("replacement.mp4", b"other_content", content_type="video/mp4")
+        upload.source_digest = 'e' * 64
+        video.video_file = upload
+
+        video.save()
+
+        video.refresh_from_db()
+        self.assertEqual(video.source_digest, 'c' * 64)
+
+class ResumableUploadTests(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username="testuser", password="testpassword")
+        self.client.force_authenticate(self.user)
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        media = override_settings(MEDIA_ROOT=self.tmp.name, UPLOAD_STAGING_ROOT=os.path.join(self.tmp.name, 'staging'))
+        media.enable()
+        self.addCleanup(media.disable)
+        self.content = os.urandom(DIGEST_BLOCK_SIZE + 1000)
+
+    def start_upload(self, length=None):
+        response = self.client.post(reverse('upload_list'), {
+            'filename': '../movie.mp4',
+            'length': len(self.content) if length is None else length,
+            'title': 'Movie',
+            'description': 'Description',
+        }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        return response['Location']
+
+    def send_chunk(self, url, offset, data):
+        return self.client.patch(url, data, content_type='application/offset+octet-stream', HTTP_UPLOAD_OFFSET=str(offset))
+
+    @mock.patch('content.signals.enqueue_conversion')
+    def test_chunks_are_resumed_and_create_video(self, mock_enqueue):
+        """Test that chunks across a digest block boundary create the video with the full file digest"""
+        url = self.start_upload()
+        split = DIGEST_BLOCK_SIZE - 500
+
+        response = self.send_chunk(url, 0, self.content[:split])
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(self.client.head(url)['Upload-Offset'], str(split))
+        self.assertFalse(Video.objects.exists())
+
+        response = self.send_chunk(url, split, self.content[split:])
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        video = Video.objects.get(id=response.data['video'])
+        self.assertEqual(video.title, 'Movie')
+        self.assertEqual(video.video_file.name, 'videos/movie.mp4')
+        self.assertEqual(video.source_digest, file_digest(video.video_file.path))
+        mock_enqueue.assert_called_once_with(video)
+        self.assertEqual(os.listdir(settings.UPLOAD_STAGING_ROOT), [])
+
+    def test_offset_mismatch_is_rejected(self):
+        """Test that a chunk at the wrong offset is rejected with the offset to resume from"""
+        url = self.start_upload()
+        self.send_chunk(url, 0, self.content[:100])
+
+        response = self.send_chunk(url, 0, self.content[:100])
+
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(response['Upload-Offset'], '100')
+
+    def test_chunk_beyond_length_is_rejected(self):
+        """Test that an upload can't grow past its declared length"""
+        url = self.start_upload(length=10)
+
+        response = self.send_chunk(url, 0, b'x' * 11)
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(UploadSession.objects.get().offset, 0)
+
+    def test_upload_of_other_user_is_hidden(self):
+        """Test that an upload can only be continued by its owner"""
+        url = self.start_upload()
+        self.client.force_authenticate(User.objects.create_user(username="other", password="testpassword"))
+
+        self.assertEqual(self.send_chunk(url, 0, b'data').status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_chunk_is_refused_while_another_is_received(self):
+        """Test that a second request can't write into an upload another request is receiving, until its lease expires"""
+        url = self.start_upload()
+        session = UploadSession.objects.get()
+        self.assertIsNotNone(claim_writer(session))
+
+        response = self.send_chunk(url, 0, self.content[:100])
+
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(UploadSession.objects.get().offset, 0)
+
+        UploadSession.objects.update(writer_expires_at=timezone.now() - timedelta(seconds=1))
+        response = self.send_chunk(url, 0, self.content[:100])
+
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        session = UploadSession.objects.get()
+        self.assertEqual(session.offset, 100)
+        self.assertIsNone(session.writer)
+
+    def test_chunk_of_lost_lease_is_dropped(self):
+        """Test that a request whose lease was taken over doesn't advance the offset"""
+        self.start_upload()
+        session = UploadSession.objects.get()
+        writer = claim_writer(session)
+        UploadSession.objects.update(writer=uuid.uuid4())
+
+        self.assertIsNone(append_chunk(session, writer, io.BytesIO(b'data'), 4))
+        self.assertEqual(UploadSession.objects.get().offset, 0)
+
+    @override_settings(UPLOAD_CHUNK_TIMEOUT=0)
+    def test_chunk_stops_when_lease_is_taken_over(self):
+        """Test that a request stops writing once another one took over its expired lease"""
+        self.start_upload()
+        session = UploadSession.objects.get()
+        writer = claim_writer(session)
+        reads = [b'a' * 10, b'b' * 10]
+
+        def read(size):
+            UploadSession.objects.update(writer=uuid.uuid4())
+            return reads.pop(0)
+
+        self.assertIsNone(append_chunk(session, writer, mock.Mock(read=read), 20))
+        self.assertEqual(UploadSession.objects.get().offset, 0)
+        self.assertEqual(reads, [b'b' * 10])
+
+    @mock.patch('content.signals.enqueue_conversion')
+    def test_failed_completion_is_retried(self, mock_enqueue):
+        """Test that a completion failing after the last chunk is undone and retried by an empty PATCH"""
+        url = self.start_upload()
+        with mock.patch('content.uploads.Video.save', side_effect=DatabaseError('connection lost')):
+            with self.assertRaises(DatabaseError):
+                self.send_chunk(url, 0, self.content)
+
+        session = UploadSession.objects.get()
+        self.assertEqual((session.offset, session.video_id, session.writer), (len(self.content), None, None))
+        self.assertEqual(os.path.getsize(staging_path(session)), len(self.content))
+        self.assertFalse(os.path.exists(os.path.join(settings.MEDIA_ROOT, 'videos', 'movie.mp4')))
+
+        response = self.send_chunk(url, len(self.content), b'')
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        video = Video.objects.get(id=response.data['video'])
+        self.assertEqual(video.video_file.name, 'videos/movie.mp4')
+        self.assertEqual(video.source_digest, file_digest(video.video_file.path))
+        self.assertFalse(os.path.exists(staging_path(session)))
+
+    @override_settings(UPLOAD_SESSION_TTL=60)
+    def test_stale_uploads_are_deleted(self):
+        """Test that unfinished uploads without a chunk for the TTL expire and their staging files are deleted"""
+        url = self.start_upload()
+        stale = UploadSession.objects.get()
+        self.start_upload()
+        UploadSession.objects.filter(pk=stale.pk).update(updated_at=timezone.now() - timedelta(seconds=61))
+
+        self.assertEqual(self.client.get(url).status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(self.send_chunk(url, 0, b'data').status_code, status.HTTP_404_NOT_FOUND)
+
+        self.assertEqual(delete_stale_uploads(), 1)
+
+        self.assertFalse(UploadSession.objects.filter(pk=stale.pk).exists())
+        self.assertFalse(os.path.exists(staging_path(stale)))
+        self.assertEqual(len(os.listdir(settings.UPLOAD_STAGING_ROOT)), 1)
+
+    def test_resume_digest_matches_full_digest(self):
+        """Test that a digest resumed from block digests and the unaligned tail matches one pass"""
+        path = os.path.join(self.tmp.name, 'staged')
+        with open(path, 'wb') as f:
+            f.write(self.content)
+        first = SourceDigest()
+        first.update(self.content[:DIGEST_BLOCK_SIZE + 10])
+
+        digest = resume_digest(path, DIGEST_BLOCK_SIZE + 10, first.block_digests)
+        digest.update(self.content[DIGEST_BLOCK_SIZE + 10:])
+
+        self.assertEqual(digest.hexdigest(), file_digest(path))
+
+
+class CheckpointTests(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.base_name = self.tmp.name
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write_rendition(self, name, segments=2, finished=True):
+        with open(os.path.join(self.base_name, f'{name}.m3u8'), 'w') as f:
+            f.write("#EXTM3U\n#EXT-X-VERSION:3\n#EXT-X-TARGETDURATION:5\n")
+            for index in range(segments):
+                segment = f'{name}_{index:03d}.ts'
+                with open(os.path.join(self.base_name, segment), 'wb') as segment_file:
+                    segment_file.write(b'segment')
+                f.write(f"#EXTINF:5.000000,\n{segment}\n")
+            if finished:
+                f.write("#EXT-X-ENDLIST\n")
+
+    def test_checkpoint_records_segment_count(self):
+        """Test that a finished rendition is checkpointed with its segment count"""
+        self.write_rendition('720p', segments=3)
+
+        save_checkpoint(self.base_name, '720p')
+
+        with open(os.path.join(self.base_name, '.checkpoints', '720p.json')) as f:
+            self.assertEqual(json.load(f), {'playlist': '720p.m3u8', 'segments': 3})
+        self.assertTrue(is_checkpointed(self.base_name, '720p'))
+
+    def test_incomplete_rendition_is_not_checkpointed(self):
+        """Test that a playlist without end tag fails the validation"""
+        self.write_rendition('720p', finished=False)
+
+        with self.assertRaises(RuntimeError):
+            save_checkpoint(self.base_name, '720p')
+
+    def test_checkpoint_invalid_after_segment_loss(self):
+        """Test that a checkpointed rendition with a missing segment is encoded again"""
+        self.write_rendition('720p')
+        self.write_rendition('480p')
+        save_checkpoint(self.base_name, '720p')
+        save_checkpoint(self.base_name, '480p')
+        os.remove(os.path.join(self.base_name, '480p_001.ts'))
+
+        pending = pending_qualities(self.base_name, {'720p': ('1280x720', '2800k'), '480p': ('854x480', '1400k')})
+
+        self.assertEqual(list(pending), ['480p'])
+
+    @override_settings(HLS_ENCODE_MODE='per_rendition', HLS_SPRITE_INTERVAL=0)
+    @mock.patch('content.tasks.delete_mp4')
+    @mock.patch('content.tasks.run_ffmpeg')
+    @mock.patch('content.tasks.probe_video', return_value=PROBE_1080P)
+    @mock.patch('content.tasks.create_base_directory')
+    def test_retry_resumes_missing_renditions(self, mock_create_base_dir, mock_probe, mock_run_ffmpeg, mock_delete_mp4):
+        """Test that a retried conversion only encodes the renditions without checkpoint"""
+        video = Video.objects.create(
+            title="Resumed",
+            description="Description",
+            video_file=SimpleUploadedFile("resumed.mp4", b"file_content", content_type="video/mp4"),
+            source_digest='d' * 64
+        )
+        mock_create_base_dir.return_value = self.base_name
+        for quality in ('1080p', '720p'):
+            self.write_rendition(quality)
+            save_checkpoint(self.base_name, quality)
+        mock_run_ffmpeg.side_effect = lambda cmd, progress=None: self.write_rendition(cmd[-1].rsplit('/', 1)[1][:-len('.m3u8')])
+
+        convert_to_hls('/path/to/resumed.mp4', video.id)
+
+        mock_run_ffmpeg.assert_called_once()
+        self.assertTrue(mock_run_ffmpeg.call_args[0][0][-1].endswith('480p.m3u8'))
+        self.assertFalse(os.path.exists(os.path.join(self.base_name, '.checkpoints')))
+
+    @mock.patch('content.tasks.run_ffmpeg')
+    def test_finished_chunk_is_skipped(self, mock_run_ffmpeg):
+        """Test that a retried chunk job doesn't encode checkpointed chunk renditions"""
+        self.write_rendition('720p_c002')
+        save_checkpoint(self.base_name, '720p_c002')
+
+        convert_chunk_to_hls('/path/to/chunk_002.mp4', 600.0, 2, self.base_name, {'720p': ('1280x720', '2800k')}, True)
+
+        mock_run_ffmpeg.assert_not_called()
+
+    @override_settings(HLS_RETRY_INTERVALS=[10, 60])
+    def test_transcode_retry(self):
+        """Test that the retry policy follows the configured intervals"""
+        retry = transcode_retry()
+
+        self.assertEqual(retry.max, 2)
+        self.assertEqual(retry.intervals, [10, 60])
+
+
+class CounterTests(APITestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username="testuser", password="testpassword")
+        self.client.force_authenticate(self.user)
+        self.video = Video.objects.create(title="Counted", description="Description", views=5)
+        connection = get_redis_connection('default')
+        self.addCleanup(connection.delete, counters.DIRTY_KEY, counters.FLUSH_SCHEDULED_KEY,
+                        counters.delta_key(self.video.pk))
+        patcher = mock.patch('content.counters.schedule_flush')
+        self.schedule_flush = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_views_are_written_behind(self):
+        """Test that views are counted in Redis and only reach the database with the flush"""
+        for _ in range(3):
+            with self.assertNumQueries(1):
+                response = self.client.post(reverse('video_views', kwargs={'pk': self.video.pk}))
+            self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+
+        self.video.refresh_from_db()
+        self.assertEqual(self.video.views, 5)
+        self.assertEqual(counters.pending_counts(self.video.pk)['views'], 3)
+        self.schedule_flush.assert_called()
+
+        self.assertEqual(counters.flush_counters(), 1)
+        self.video.refresh_from_db()
+        self.assertEqual(self.video.views, 8)
+        self.assertEqual(counters.pending_counts(self.video.pk)['views'], 0)
+
+    def test_flush_changes_list_etag(self):
+        """Test that a flush invalidates the list, so conditional GETs see the new counts"""
+        url = reverse('video_list')
+        etag = self.client.get(url)['ETag']
+        counters.add_view(self.video.pk)
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, status.HTTP_304_NOT_MODIFIED)
+
+        counters.flush_counters()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data[0]['views'], 6)
+
+    def test_reactions_count_once_per_user(self):
+        """Test that repeated likes count once and switching to dislike moves the count"""
+        url = reverse('video_reaction', kwargs={'pk': self.video.pk})
+        self.client.put(url, {'reaction': 'like'})
+        self.client.put(url, {'reaction': 'like'})
+        self.assertEqual(counters.pending_counts(self.video.pk)['likes'], 1)
+
+        self.client.put(url, {'reaction': 'dislike'})
+        self.assertEqual(self.client.get(url).data, {'reaction': 'dislike'})
+        counters.flush_counters()
+        self.video.refresh_from_db()
+        self.assertEqual((self.video.likes, self.video.dislikes), (0, 1))
+
+        self.client.delete(url)
+        counters.flush_counters()
+        self.video.refresh_from_db()
+        self.assertEqual(self.video.dislikes, 0)
+
+    def test_reactions_survive_lost_redis(self):
+        """Test that a user can't like again once the Redis data is gone"""
+        url = reverse('video_reaction', kwargs={'pk': self.video.pk})
+        self.client.put(url, {'reaction': 'like'})
+        counters.flush_counters()
+        get_redis_connection('default').delete(counters.DIRTY_KEY, counters.delta_key(self.video.pk))
+
+        self.client.put(url, {'reaction': 'like'})
+
+        self.assertEqual(counters.pending_counts(self.video.pk)['likes'], 0)
+        self.assertEqual(self.client.get(url).data, {'reaction': 'like'})
+        self.assertEqual(VideoReaction.objects.get().reaction, 'like')
+
+    def test_reactions_without_redis(self):
+        """Test that reactions are counted in the database while Redis is down"""
+        url = reverse('video_reaction', kwargs={'pk': self.video.pk})
+        with mock.patch('content.counters.get_redis_connection', side_effect=RedisConnectionError('down')):
+            self.assertEqual(self.client.put(url, {'reaction': 'like'}).status_code, status.HTTP_202_ACCEPTED)
+            self.assertEqual(self.client.put(url, {'reaction': 'dislike'}).status_code, status.HTTP_202_ACCEPTED)
+            self.assertEqual(self.client.get(url).data, {'reaction': 'dislike'})
+
+        self.video.refresh_from_db()
+        self.assertEqual((self.video.likes, self.video.dislikes), (0, 1))
+
+    def test_invalid_reaction(self):
+        """Test that unknown reactions are rejected"""
+        response = self.client.put(reverse('video_reaction', kwargs={'pk': self.video.pk}), {'reaction': 'love'})
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_flush_failure_keeps_deltas(self):
+        """Test that the deltas of a failed flush are put back into Redis"""
+        counters.add_view(self.video.pk)
+        with mock.patch('content.counters.apply_deltas', side_effect=RuntimeError('database down')):
+            with self.assertRaises(RuntimeError):
+                counters.flush_counters()
+
+        self.assertEqual(counters.pending_counts(self.video.pk)['views'], 1)
+        counters.flush_counters()
+        self.video.refresh_from_db()
+        self.assertEqual(self.video.views, 6)
+
+    def test_flush_is_scheduled_once(self):
+        """Test that a burst of increments schedules a single flush"""
+        with mock.patch('content.scheduling.django_rq.get_queue') as get_queue:
+            for _ in range(3):
+                schedule_flush()
+
+        get_queue.return_value.enqueue_in.assert_called_once()
+
+    def test_put_does_not_overwrite_counters(self):
+        """Test that the counters are read only for the detail PUT"""
+        response = self.client.put(reverse('video_detail', kwargs={'pk': self.video.pk}),
+                                   {'title': "Counted", 'description': "Description", 'views': 0})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.video.refresh_from_db()
+        self.assertEqual(self.video.views, 5)
+
+
+    def test_put_keeps_concurrent_increments(self):
+        """Test that a PUT doesn't write back counters flushed while it ran"""
+        serializer = ContentSerializer(self.video, data={'title': "Renamed", 'description': "Description"})
+        self.assertTrue(serializer.is_valid())
+        Video.objects.filter(pk=self.video.pk).update(views=F('views') + 3)
+
+        serializer.save()
+
+        self.video.refresh_from_db()
+        self.assertEqual((self.video.title, self.video.views), ("Renamed", 8))
+
+class TrendingTests(APITestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username="testuser", password="testpassword")
+        self.client.force_authenticate(self.user)
+        self.old_hit = Video.objects.create(title="Old hit", description="Description")
+        self.new_hit = Video.objects.create(title="New hit", description="Description")
+        self.quiet = Video.objects.create(title="Quiet", description="Description")
+        connection = get_redis_connection('default')
+        self.addCleanup(connection.delete, trending.SCORES_KEY, trending.UPDATE_SCHEDULED_KEY,
+                        *[trending.BUCKET_KEY.format(bucket=bucket) for bucket in range(990, 1001)])
+        self.addCleanup(connection.delete, counters.DIRTY_KEY, *[counters.delta_key(video.pk) for video in
+                                                                 (self.old_hit, self.new_hit, self.quiet)])
+        for patcher in (mock.patch('content.trending.current_bucket', return_value=1000),
+                        mock.patch('content.counters.schedule_flush'), mock.patch('content.counters.schedule_update')):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def add_views(self, video, count, bucket):
+        with mock.patch('content.trending.current_bucket', return_value=bucket):
+            for _ in range(count):
+                counters.add_view(video.pk)
+
+    def test_scores_decay_with_age(self):
+        """Test that views are weighted by half every half life"""
+        video_ids, scores = trending_scores([(998, {b'1': b'8'}), (1000, {b'1': b'2', b'2': b'3'})], now=1000, half_life=2)
+
+        self.assertEqual(video_ids.tolist(), [1, 2])
+        self.assertEqual(scores.tolist(), [6.0, 3.0])
+
+    @override_settings(TRENDING_HALF_LIFE=3600)
+    def test_recent_views_outrank_old_ones(self):
+        """Test that fewer recent views trend above more old ones"""
+        self.add_views(self.old_hit, 8, bucket=995)
+        self.add_views(self.new_hit, 3, bucket=1000)
+        self.add_views(self.quiet, 1, bucket=999)
+
+        self.assertEqual(update_trending(), 3)
+
+        response = self.client.get(reverse('trending'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([video['title'] for video in response.data], ["New hit", "Quiet", "Old hit"])
+        self.assertEqual(tuple(response.data[0]), VideoValuesSerializer.COMPACT_FIELDS)
+
+    def test_expired_buckets_are_ignored(self):
+        """Test that views older than the window don't count"""
+        self.add_views(self.old_hit, 5, bucket=990)
+        self.add_views(self.new_hit, 1, bucket=1000)
+
+        with override_settings(TRENDING_BUCKETS=5):
+            update_trending()
+
+        self.assertEqual(trending_ids(10), [self.new_hit.pk])
+
+    def test_update_replaces_cached_ranking(self):
+        """Test that the endpoint is cached until the next update"""
+        self.add_views(self.quiet, 1, bucket=1000)
+        update_trending()
+        self.assertEqual(len(self.client.get(reverse('trending')).data), 1)
+
+        self.add_views(self.new_hit, 2, bucket=1000)
+        self.assertEqual(len(self.client.get(reverse('trending')).data), 1)
+        update_trending()
+        self.assertEqual([video['title'] for video in self.client.get(reverse('trending')).data], ["New hit", "Quiet"])
+
+    @mock.patch('content.trending.schedule_update')
+    def test_update_reschedules_itself_until_views_expire(self, mock_schedule_update):
+        """Test that the ranking keeps being recomputed without new views until the last views left the window"""
+        self.add_views(self.quiet, 1, bucket=1000)
+
+        update_trending()
+        mock_schedule_update.assert_called_once_with()
+
+        mock_schedule_update.reset_mock()
+        with mock.patch('content.trending.current_bucket', return_value=1000 + settings.TRENDING_BUCKETS):
+            update_trending()
+
+        mock_schedule_update.assert_not_called()
+        self.assertEqual(trending_ids(10), [])
+
+
+class WatchProgressTests(APITestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username="testuser", password="testpassword")
+        self.client.force_authenticate(self.user)
+        self.subprofile = SubProfile.objects.create(parent_profile=self.user.profile, username="kid")
+        self.videos = [Video.objects.create(title=f"Video {i}", description="Description") for i in range(3)]
+        connection = get_redis_connection('default')
+        self.addCleanup(connection.delete, watch_progress.DIRTY_KEY, watch_progress.FLUSH_SCHEDULED_KEY,
+                        watch_progress.positions_key(self.subprofile.pk))
+        patcher = mock.patch('content.watch_progress.schedule_flush')
+        self.schedule_flush = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def heartbeat(self, video, position, duration=100, subprofile=None):
+        return self.client.post(reverse('video_progress', kwargs={'pk': video.pk}), {
+            'subprofile': subprofile or self.subprofile.pk, 'position': position, 'duration': duration,
+        })
+
+    def test_heartbeats_are_buffered(self):
+        """Test that heartbeats don't write to the database and are flushed in bulk"""
+        self.heartbeat(self.videos[0], 5)
+        with self.assertNumQueries(0):
+            for position in (10, 20, 30):
+                response = self.heartbeat(self.videos[0], position)
+                self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.heartbeat(self.videos[1], 42)
+        self.assertFalse(WatchProgress.objects.exists())
+        self.schedule_flush.assert_called()
+
+        self.assertEqual(watch_progress.flush_positions(), 2)
+        self.heartbeat(self.videos[0], 50)
+        watch_progress.flush_positions()
+
+        progress = dict(WatchProgress.objects.values_list('video_id', 'position'))
+        self.assertEqual(progress, {self.videos[0].pk: 50, self.videos[1].pk: 42})
+
+    def test_continue_watching(self):
+        """Test that the row holds started, unfinished videos newest first, buffered or stored"""
+        self.heartbeat(self.videos[0], 30)
+        self.heartbeat(self.videos[1], 99)
+        watch_progress.flush_positions()
+        self.heartbeat(self.videos[2], 12)
+
+        response = self.client.get(reverse('continue_watching'), {'subprofile': self.subprofile.pk})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([(video['title'], video['position']) for video in response.data],
+                         [("Video 2", 12), ("Video 0", 30)])
+
+    def test_other_users_subprofile(self):
+        """Test that heartbeats and rows of another user's sub profile are refused"""
+        other = User.objects.create_user(username="other", password="testpassword")
+        subprofile = SubProfile.objects.create(parent_profile=other.profile, username="other")
+
+        self.assertEqual(self.heartbeat(self.videos[0], 10, subprofile=subprofile.pk).status_code, status.HTTP_404_NOT_FOUND)
+        response = self.client.get(reverse('continue_watching'), {'subprofile': subprofile.pk})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_invalid_position(self):
+        """Test that a missing or negative position is rejected"""
+        self.assertEqual(self.heartbeat(self.videos[0], -1).status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.heartbeat(self.videos[0], 'start').status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_flush_skips_deleted_videos(self):
+        """Test that positions of videos deleted before the flush are dropped"""
+        self.heartbeat(self.videos[0], 10)
+        self.heartbeat(self.videos[1], 10)
+        self.videos[1].delete()
+
+        watch_progress.flush_positions()
+
+        self.assertEqual(list(WatchProgress.objects.values_list('video_id', flat=True)), [self.videos[0].pk])
+
+
+    def test_redis_outage_degrades(self):
+        """Test that without Redis heartbeats are dropped and the row is read from the database"""
+        WatchProgress.objects.create(subprofile=self.subprofile, video=self.videos[0], position=30, duration=100, updated_at=timezone.now())
+        outage = RedisConnectionError('redis down')
+        with mock.patch('content.watch_progress.get_redis_connection', side_effect=outage), \
+                mock.patch('content.watch_progress.cache.get', side_effect=outage):
+            self.assertEqual(self.heartbeat(self.videos[1], 10).status_code, status.HTTP_204_NO_CONTENT)
+            response = self.client.get(reverse('continue_watching'), {'subprofile': self.subprofile.pk})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([(video['title'], video['position']) for video in response.data], [("Video 0", 30)])
+        self.schedule_flush.assert_not_called()
+
+class TranscodeProgressTests(APITestCase):
+
+    def setUp(self):
+        self.video_id = 987654
+        self.addCleanup(get_redis_connection('default').delete, progress_key(self.video_id))
+
+    def progress_block(self, out_time_us, fps='48.0', speed='2.0x', progress='continue'):
+        return [f'fps={fps}\n', f'out_time_us={out_time_us}\n', f'speed={speed}\n', f'progress={progress}\n']
+
+    def test_reporter_writes_percent_and_eta(self):
+        """Test that ffmpeg progress blocks become percent, fps, speed and ETA per rendition"""
+        reporter = ProgressReporter(self.video_id, ['720p', '480p'], duration=100.0)
+        for line in self.progress_block(25000000):
+            reporter.feed(line)
+
+        progress = read_progress(self.video_id)['renditions']
+        self.assertEqual(set(progress), {'720p', '480p'})
+        self.assertEqual(progress['720p']['percent'], 25.0)
+        self.assertEqual(progress['720p']['fps'], 48.0)
+        self.assertEqual(progress['720p']['speed'], 2.0)
+        self.assertEqual(progress['720p']['eta'], 38)
+
+    @override_settings(HLS_PROGRESS_INTERVAL=60)
+    def test_reporter_is_throttled(self):
+        """Test that updates within the interval are skipped, the final one is not"""
+        reporter = ProgressReporter(self.video_id, ['720p'], duration=100.0)
+        for line in self.progress_block(10000000) + self.progress_block(50000000):
+            reporter.feed(line)
+        self.assertEqual(read_progress(self.video_id)['renditions']['720p']['percent'], 10.0)
+
+        for line in self.progress_block(100000000, progress='end'):
+            reporter.feed(line)
+        self.assertTrue(read_progress(self.video_id)['renditions']['720p']['finished'])
+
+    @mock.patch('content.tasks.subprocess.Popen')
+    def test_run_ffmpeg_feeds_progress(self, mock_popen):
+        """Test that run_ffmpeg asks ffmpeg for progress output and parses it while running"""
+        mock_popen.return_value.stdout = self.progress_block(50000000)
+        mock_popen.return_value.wait.return_value = 0
+
+        run_ffmpeg(['/usr/bin/ffmpeg', '-i', 'in.mp4', 'out.m3u8'], ProgressReporter(self.video_id, ['720p'], 100.0))
+
+        self.assertEqual(mock_popen.call_args[0][0][:4], ['/usr/bin/ffmpeg', '-progress', 'pipe:1', '-nostats'])
+        self.assertEqual(read_progress(self.video_id)['renditions']['720p']['percent'], 50.0)
+
+    @mock.patch('content.tasks.subprocess.Popen')
+    def test_run_ffmpeg_kills_process_on_error(self, mock_popen):
+        """Test that ffmpeg is killed when the job is interrupted while it runs"""
+        reporter = mock.Mock()
+        reporter.feed.side_effect = TimeoutError('job timeout')
+        mock_popen.return_value.stdout = self.progress_block(50000000)
+
+        with self.assertRaises(TimeoutError):
+            run_ffmpeg(['/usr/bin/ffmpeg', '-i', 'in.mp4', 'out.m3u8'], reporter)
+
+        mock_popen.return_value.kill.assert_called_once()
+        mock_popen.return_value.wait.assert_called_once()
+
+    def test_progress_endpoint_without_database(self):
+        """Test that the progress endpoint answers from Redis without any query"""
+        set_status(self.video_id, 'running')
+        ProgressReporter(self.video_id, ['1080p'], 10.0).report()
+
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse('video_transcode_progress', kwargs={'pk': self.video_id}))
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['status'], 'running')
+        self.assertIn('1080p', response.data['renditions'])
+
+    def test_progress_endpoint_without_redis(self):
+        """Test that the persisted job status is returned while Redis is down"""
+        video = Video.objects.create(title="Converting", description="Description")
+        TranscodeJob.objects.create(job_id='transcode-progress', video=video, status='running')
+
+        with mock.patch('content.progress.get_redis_connection', side_effect=RedisConnectionError('redis down')):
+            response = self.client.get(reverse('video_transcode_progress', kwargs={'pk': video.pk}))
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['status'], 'running')
+        self.assertEqual(response.data['renditions'], {})
+
+    def test_progress_endpoint_unknown_video(self):
+        """Test that a video without progress is reported as unknown"""
+        response = self.client.get(reverse('video_transcode_progress', kwargs={'pk': self.video_id}))
+
+        self.assertEqual(response.data, {'status': 'unknown', 'updated_at': None, 'renditions': {}})
+
+
+@override_settings(HLS_SEGMENT_FORMAT='fmp4')
+class Fmp4SegmentFormatTests(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.base_name = self.tmp.name
+
+    def write_single_file_rendition(self, name, fragments=(1000, 2000), file_size=None):
+        init_size = 800
+        with open(os.path.join(self.base_name, f'{name}.mp4'), 'wb') as f:
+            f.write(b'\0' * (file_size or init_size + sum(fragments)))
+        with open(os.path.join(self.base_name, f'{name}.m3u8'), 'w') as f:
+            f.write("#EXTM3U\n#EXT-X-VERSION:7\n#EXT-X-TARGETDURATION:5\n")
+            f.write(f'#EXT-X-MAP:URI="{name}.mp4",BYTERANGE="{init_size}@0"\n')
+            offset = init_size
+            for length in fragments:
+                f.write(f"#EXTINF:5.000000,\n#EXT-X-BYTERANGE:{length}@{offset}\n{name}.mp4\n")
+                offset += length
+            f.write("#EXT-X-ENDLIST\n")
+        return os.path.join(self.base_name, f'{name}.m3u8')
+
+    def test_single_file_commands(self):
+        """Test that the fMP4 mode writes one media file per rendition"""
+        single_pass = generate_single_pass_ffmpeg_command('in.mp4', '/out', {'720p': ('1280x720', '2800k')})
+        per_rendition = generate_ffmpeg_command('in.mp4', '/out', '720p', '1280x720', '2800k')
+
+        for cmd, media_file in ((single_pass, '/out/%v.mp4'), (per_rendition, '/out/720p.mp4')):
+            self.assertEqual(cmd[cmd.index('-hls_segment_type') + 1], 'fmp4')
+            self.assertEqual(cmd[cmd.index('-hls_flags') + 1], 'single_file')
+            self.assertEqual(cmd[cmd.index('-hls_segment_filename') + 1], media_file)
+            self.assertFalse(any(arg.endswith('.ts') for arg in cmd))
+
+    def test_byte_ranges_are_validated(self):
+        """Test that byte range segments count as valid only if they lie within the file"""
+        self.assertEqual(count_valid_segments(self.write_single_file_rendition('720p')), 2)
+        self.assertIsNone(count_valid_segments(self.write_single_file_rendition('480p', file_size=2000)))
+
+    def test_stitched_chunks_keep_their_init_sections(self):
+        """Test that fMP4 chunks are joined with their EXT-X-MAP and a discontinuity between them"""
+        playlists = [self.write_single_file_rendition(f'720p_c00{i}') for i in range(2)]
+        output = os.path.join(self.base_name, '720p.m3u8')
+
+        stitch_playlists(playlists, output)
+
+        with open(output) as f:
+            lines = f.read().splitlines()
+        self.assertIn('#EXT-X-VERSION:7', lines)
+        self.assertEqual(lines.count('#EXT-X-DISCONTINUITY'), 1)
+        self.assertEqual([line for line in lines if line.startswith('#EXT-X-MAP')],
+                         ['#EXT-X-MAP:URI="720p_c000.mp4",BYTERANGE="800@0"', '#EXT-X-MAP:URI="720p_c001.mp4",BYTERANGE="800@0"'])
+        self.assertEqual(count_valid_segments(output), 4)
+
+    def test_master_playlist_version(self):
+        """Test that the master playlist declares the version needed for fMP4"""
+        create_master_playlist(self.base_name, {'720p': ('1280x720', '2800k')})
+
+        with open(os.path.join(self.base_name, 'playlist.m3u8')) as f:
+            self.assertIn('#EXT-X-VERSION:7', f.read().splitlines())
+
+
+class SpriteTests(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.base_name = self.tmp.name
+        self.sprites = {'interval': 10, 'width': 160, 'height': 90, 'columns': 2, 'rows': 2, 'format': 'jpg'}
+
+    def read_vtt(self, name='sprites.vtt'):
+        with open(os.path.join(self.base_name, name)) as f:
+            return f.read()
+
+    def test_sprite_layout_follows_source_aspect(self):
+        """Test that the thumbnail height follows the source aspect ratio and sprites can be disabled"""
+        layout = sprite_layout({**PROBE_1080P, 'source_width': 1440, 'source_height': 1080})
+        self.assertEqual((layout['width'], layout['height']), (160, 120))
+
+        with override_settings(HLS_SPRITE_INTERVAL=0):
+            self.assertIsNone(sprite_layout(PROBE_1080P))
+        self.assertIsNone(sprite_layout({**PROBE_1080P, 'source_width': None}))
+
+    def test_sprites_share_single_pass_decode(self):
+        """Test that the sprite sheets are one more branch of the single pass split"""
+        cmd = generate_single_pass_ffmpeg_command('in.mp4', '/out', {'720p': ('1280x720', '2800k')}, sprites=self.sprites)
+
+        self.assertEqual(cmd.count('-i'), 1)
+        filter_graph = cmd[cmd.index('-filter_complex') + 1]
+        self.assertIn('[0:v]split=2[v0][v1]', filter_graph)
+        self.assertIn('[v1]fps=1/10,scale=160:90,tile=2x2[sprites]', filter_graph)
+        self.assertEqual(cmd[-1], '/out/sprites_%03d.jpg')
+        self.assertLess(cmd.index('/out/%v.m3u8'), cmd.index('[sprites]'))
+
+    def test_sprites_in_per_rendition_command(self):
+        """Test that a rendition command can write the sprite sheets from the same decode"""
+        cmd = generate_ffmpeg_command('in.mp4', '/out', '720p', '1280x720', '2800k', sprites={**self.sprites, 'format': 'webp'})
+
+        self.assertEqual(cmd[3:5], ['-filter_complex', '[0:v]fps=1/10,scale=160:90,tile=2x2[sprites]'])
+        self.assertIn('libwebp', cmd)
+        self.assertEqual(cmd[-1], '/out/sprites_%03d.webp')
+
+    def test_vtt_points_to_tiles(self):
+        """Test that every cue points to its tile, continuing on the next sheet"""
+        write_sprite_vtt(self.base_name, self.sprites, 45)
+
+        vtt = self.read_vtt()
+        self.assertTrue(vtt.startswith('WEBVTT\n'))
+        self.assertIn('00:00:00.000 --> 00:00:10.000\nsprites_001.jpg#xywh=0,0,160,90', vtt)
+        self.assertIn('00:00:30.000 --> 00:00:40.000\nsprites_001.jpg#xywh=160,90,160,90', vtt)
+        self.assertIn('00:00:40.000 --> 00:00:45.000\nsprites_002.jpg#xywh=0,0,160,90', vtt)
+
+    def test_chunk_vtts_are_stitched(self):
+        """Test that chunk sprite indexes are shifted by the chunk start and joined"""
+        write_sprite_vtt(self.base_name, self.sprites, 20, name_suffix='_c000')
+        write_sprite_vtt(self.base_name, self.sprites, 15, name_suffix='_c001', start=20)
+
+        parts = stitch_sprite_vtts(self.base_name, 2)
+
+        vtt = self.read_vtt()
+        self.assertEqual(vtt.count('WEBVTT'), 1)
+        self.assertIn('00:00:20.000 --> 00:00:30.000\nsprites_c001_001.jpg#xywh=0,0,160,90', vtt)
+        self.assertIn('00:00:30.000 --> 00:00:35.000\nsprites_c001_001.jpg#xywh=160,0,160,90', vtt)
+        self.assertEqual(parts, [os.path.join(self.base_name, f'sprites_c00{i}.vtt') for i in range(2)])
+
+    @override_settings(HLS_FINGERPRINT=False)
+    @mock.patch('content.tasks.delete_mp4')
+    @mock.patch('content.tasks.create_master_playlist')
+    @mock.patch('content.tasks.save_checkpoint')
+    @mock.patch('content.tasks.run_ffmpeg')
+    @mock.patch('content.tasks.probe_video', return_value=PROBE_1080P)
+    @mock.patch('content.tasks.create_base_directory')
+    def test_sprites_are_exposed_on_video(self, mock_create_base_dir, mock_probe, mock_run_ffmpeg, *mocks):
+        """Test that the sprite index is written during the conversion and serialized"""
+        video = Video.objects.create(
+            title="Sprites",
+            description="Description",
+            video_file=SimpleUploadedFile("sprites.mp4", b"file_content", content_type="video/mp4"),
+            source_digest='f' * 64
+        )
+        mock_create_base_dir.return_value = self.base_name
+
+        convert_to_hls('/path/to/sprites.mp4', video.id)
+
+        mock_run_ffmpeg.assert_called_once()
+        self.assertIn('[sprites]', mock_run_ffmpeg.call_args[0][0])
+        self.assertEqual(self.read_vtt().count('-->'), 12)
+        video.refresh_from_db()
+        self.assertEqual(video.sprites_vtt, '/media/videos/hls/sprites/sprites.vtt')
+        self.assertEqual(ContentSerializer(video).data['sprites_vtt'], video.sprites_vtt)
+
+
+class EnqueueConversionTests(TestCase):
+
+    def setUp(self):
+        patcher = mock.patch('content.tasks.django_rq.get_queue')
+        self.queue = patcher.start().return_value
+        self.queue.fetch_job.return_value.get_status.return_value = 'queued'
+        self.addCleanup(patcher.stop)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.video = Video.objects.create(
+                title="Test Video",
+                description="Test Description",
+                video_file=SimpleUploadedFile("test.mp4", b"file_content", content_type="video/mp4"),
+                source_digest='d' * 64
+            )
+
+    def enqueue(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            return enqueue_conversion(self.video)
+
+    def test_new_upload_is_enqueued_once(self):
+        """Test that saving a new video enqueues one job with a deterministic id"""
+        job = TranscodeJob.objects.get()
+        self.assertEqual(job.job_id, f'transcode-{self.video.id}-{"d" * 16}')
+        self.assertEqual(job.status, 'queued')
+        self.queue.enqueue.assert_called_once()
+        self.assertEqual(self.queue.enqueue.call_args[1]['job_id'], job.job_id)
+        self.assertEqual(TranscodeJob.in_flight(self.video.id), job)
+
+    def test_duplicate_enqueue_is_dropped(self):
+        """Test that enqueueing an in-flight or finished conversion again does nothing"""
+        self.enqueue()
+        TranscodeJob.update_status(self.video.id, 'running')
+        self.enqueue()
+        TranscodeJob.update_status(self.video.id, 'finished')
+        self.enqueue()
+
+        self.queue.enqueue.assert_called_once()
+        self.assertEqual(TranscodeJob.objects.count(), 1)
+
+    def test_failed_or_lost_conversion_is_enqueued_again(self):
+        """Test that a failed conversion and a queued job missing from RQ are enqueued again"""
+        TranscodeJob.update_status(self.video.id, 'failed')
+        self.enqueue()
+        self.queue.fetch_job.return_value = None
+        self.enqueue()
+
+        self.assertEqual(self.queue.enqueue.call_count, 3)
+        self.assertEqual(TranscodeJob.objects.get().status, 'queued')
+
+    def test_chunked_conversion_follows_its_chunk_jobs(self):
+        """Test that a running chunked conversion whose parent job is gone is lost once a chunk job is gone or dead"""
+        self.enqueue()
+        TranscodeJob.update_status(self.video.id, 'running')
+        chunk_job = mock.Mock(**{'get_status.return_value': 'finished'})
+        stitch_job = mock.Mock(dependency_ids=['chunk_c000', 'chunk_c001'], **{
+            'get_status.return_value': 'deferred', 'fetch_dependencies.return_value': [chunk_job, chunk_job],
+        })
+        stitch_job_id = f'{TranscodeJob.objects.get().job_id}-stitch'
+        self.queue.fetch_job.side_effect = lambda job_id: stitch_job if job_id == stitch_job_id else None
+
+        self.enqueue()
+        self.assertEqual(self.queue.enqueue.call_count, 1)
+
+        stitch_job.fetch_dependencies.return_value = [chunk_job]
+        self.enqueue()
+        self.assertEqual(self.queue.enqueue.call_count, 2)
+
+        TranscodeJob.update_status(self.video.id, 'running')
+        stitch_job.fetch_dependencies.return_value = [chunk_job, chunk_job]
+        chunk_job.get_status.return_value = 'failed'
+        self.enqueue()
+        self.assertEqual(self.queue.enqueue.call_count, 3)
+
+    def test_new_source_is_a_new_conversion(self):
+        """Test that a different source digest gets its own job"""
+        self.video.source_digest = 'e' * 64
+        self.enqueue()
+
+        self.assertEqual(TranscodeJob.objects.count(), 2)
+        self.assertEqual(self.queue.enqueue.call_count, 2)
+
+    @mock.patch('content.signals.enqueue_conversion')
+    def test_admin_upload_is_enqueued(self, mock_enqueue):
+        """Test that a video added through the admin, a proxy model, is enqueued"""
+        self.client.force_login(User.objects.create_superuser(username="admin", password="adminpassword"))
+        response = self.client.post(reverse('admin:admin_app_contentproxy_add'), {
+            'title': "Admin Upload",
+            'description': "Description",
+            'created_at': '2024-01-01',
+            'likes': 0,
+            'dislikes': 0,
+            'views': 0,
+            'category': 'music',
+            'has_audio': 'unknown',
+            'video_file': SimpleUploadedFile("admin.mp4", b"admin_content", content_type="video/mp4"),
+        })
+
+        self.assertEqual(response.status_code, 302)
+        video = Video.objects.get(title="Admin Upload")
+        mock_enqueue.assert_called_once()
+        self.assertEqual(mock_enqueue.call_args[0][0].pk, video.pk)
+
+    @mock.patch('content.tasks.get_current_job')
+    @mock.patch('content.tasks.create_base_directory', side_effect=OSError('disk full'))
+    @mock.patch('content.tasks.share_existing_output', return_value=False)
+    def test_conversion_updates_job_status(self, mock_share, mock_create_base_dir, mock_current_job):
+        """Test that a failed attempt stays queued while RQ retries it and fails afterwards"""
+        mock_current_job.return_value.retries_left = 1
+        with self.assertRaises(OSError):
+            convert_to_hls(self.video.video_file.path, self.video.id)
+        self.assertEqual(TranscodeJob.objects.get().status, 'queued')
+
+        mock_current_job.return_value.retries_left = 0
+        with self.assertRaises(OSError):
+            convert_to_hls(self.video.video_file.path, self.video.id)
+        self.assertEqual(TranscodeJob.objects.get().status, 'failed')
+
+
+@override_settings(HLS_SEGMENT_CACHE_BYTES=0)
+class ServeHlsTests(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        media = override_settings(MEDIA_ROOT=self.tmp.name)
+        media.enable()
+        self.addCleanup(media.disable)
+        os.makedirs(os.path.join(self.tmp.name, 'videos', 'hls', 'movie'))
+        with open(os.path.join(self.tmp.name, 'videos', 'hls', 'movie', '720p_000.ts'), 'wb') as f:
+            f.write(bytes(range(100)))
+        self.url = reverse('hls_media', kwargs={'path': 'movie/720p_000.ts'})
+
+    def test_full_file_is_streamed(self):
+        """Test that a segment without Range is streamed from the open file"""
+        response = self.client.get(self.url)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'video/mp2t')
+        self.assertEqual(response['Content-Length'], '100')
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        self.assertEqual(b''.join(response.streaming_content), bytes(range(100)))
+
+    def test_range_request(self):
+        """Test that a byte range is answered with 206 and only the requested bytes"""
+        for header, expected in (('bytes=10-19', range(10, 20)), ('bytes=90-', range(90, 100)), ('bytes=-5', range(95, 100))):
+            response = self.client.get(self.url, HTTP_RANGE=header)
+
+            self.assertEqual(response.status_code, 206)
+            self.assertEqual(response['Content-Range'], f'bytes {expected.start}-{expected.stop - 1}/100')
+            self.assertEqual(response['Content-Length'], str(len(expected)))
+            self.assertEqual(b''.join(response.streaming_content), bytes(expected))
+
+    def test_unsatisfiable_range(self):
+        """Test that a range past the end of the file is answered with 416"""
+        response = self.client.get(self.url, HTTP_RANGE='bytes=100-')
+
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], 'bytes */100')
+
+    def test_path_outside_hls_directory(self):
+        """Test that paths leaving the HLS directory and missing files are not found"""
+        self.assertEqual(self.client.get('/media/videos/hls/../../../etc/passwd').status_code, 404)
+        self.assertEqual(self.client.get(reverse('hls_media', kwargs={'path': 'movie/missing.ts'})).status_code, 404)
+
+    @override_settings(MEDIA_ACCEL_REDIRECT='/protected-media/')
+    def test_accel_redirect(self):
+        """Test that the file is handed off to nginx when X-Accel-Redirect is configured"""
+        response = self.client.get(self.url)
+
+        self.assertEqual(response['X-Accel-Redirect'], '/protected-media/videos/hls/movie/720p_000.ts')
+        self.assertEqual(response.content, b'')
+
+
+@override_settings(HLS_SEGMENT_CACHE_BYTES=0)
+class FingerprintTests(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        media = override_settings(MEDIA_ROOT=self.tmp.name)
+        media.enable()
+        self.addCleanup(media.disable)
+        self.base_name = os.path.join(self.tmp.name, 'videos', 'hls', 'movie')
+        os.makedirs(self.base_name)
+        self.video = Video.objects.create(
+            title="Movie",
+            description="Description",
+            video_file=SimpleUploadedFile("movie.mp4", b"file_content", content_type="video/mp4"),
+            source_digest='9' * 64
+        )
+
+    def write(self, name, content):
+        with open(os.path.join(self.base_name, name), 'w') as f:
+            f.write(content)
+
+    def read(self, name):
+        with open(os.path.join(self.base_name, name)) as f:
+            return f.read()
+
+    @mock.patch('content.tasks.delete_mp4')
+    def test_output_is_fingerprinted_and_served_immutable(self, mock_delete_mp4):
+        """Test that finished files get content-hashed names, precompressed playlists and caching headers"""
+        self.write('720p_000.ts', 'segment 0')
+        self.write('720p_001.ts', 'segment 1')
+        self.write('720p.m3u8', "#EXTM3U\n#EXTINF:5.0,\n720p_000.ts\n#EXTINF:5.0,\n720p_001.ts\n#EXT-X-ENDLIST\n")
+        self.write('sprites_001.jpg', 'sheet')
+        self.write('sprites.vtt', "WEBVTT\n\n00:00:00.000 --> 00:00:10.000\nsprites_001.jpg#xywh=0,0,160,90\n")
+
+        finish_conversion('/path/to/movie.mp4', self.video.id, self.base_name, {'720p': ('1280x720', '2800k')})
+
+        self.video.refresh_from_db()
+        master = os.path.basename(self.video.hls_playlist)
+        self.assertRegex(master, r'^playlist\.[0-9a-f]{16}\.m3u8$')
+        media_playlist = self.read(master).splitlines()[-1]
+        self.assertRegex(media_playlist, r'^720p\.[0-9a-f]{16}\.m3u8$')
+        segments = [line for line in self.read(media_playlist).splitlines() if not line.startswith('#')]
+        self.assertEqual([segment.split('.')[0] for segment in segments], ['720p_000', '720p_001'])
+        self.assertNotEqual(segments[0], segments[1])
+        self.assertRegex(self.read(os.path.basename(self.video.sprites_vtt)), r'sprites_001\.[0-9a-f]{16}\.jpg#xywh=0,0,160,90')
+        self.assertFalse(os.path.exists(os.path.join(self.base_name, '720p_000.ts')))
+
+        url = reverse('hls_media', kwargs={'path': f'movie/{media_playlist}'})
+        response = self.client.get(url, HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response['Cache-Control'], 'public, max-age=31536000, immutable')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response['Vary'])
+        self.assertEqual(gzip.decompress(b''.join(response.streaming_content)).decode(), self.read(media_playlist))
+
+        not_modified = self.client.get(url, HTTP_ACCEPT_ENCODING='gzip', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(not_modified.status_code, 304)
+        self.assertEqual(not_modified['ETag'], response['ETag'])
+        self.assertNotEqual(self.client.get(url)['ETag'], response['ETag'])
+
+    @mock.patch('content.tasks.delete_mp4')
+    def test_lost_race_uses_winner_sprites(self, mock_delete_mp4):
+        """Test that a conversion losing the registration race takes the sprite index of the winning output"""
+        winner_dir = os.path.join(self.tmp.name, 'videos', 'hls', 'winner')
+        os.makedirs(winner_dir)
+        with open(os.path.join(winner_dir, 'sprites.0123456789abcdef.vtt'), 'w') as f:
+            f.write("WEBVTT\n")
+        winner_playlist = '/media/videos/hls/winner/playlist.fedcba9876543210.m3u8'
+        HlsOutput.objects.create(source_digest=self.video.source_digest, hls_playlist=winner_playlist, ref_count=1)
+        self.write('720p_000.ts', 'segment 0')
+        self.write('720p.m3u8', "#EXTM3U\n#EXTINF:5.0,\n720p_000.ts\n#EXT-X-ENDLIST\n")
+        self.write('sprites_001.jpg', 'sheet')
+        self.write('sprites.vtt', "WEBVTT\n\n00:00:00.000 --> 00:00:10.000\nsprites_001.jpg#xywh=0,0,160,90\n")
+
+        finish_conversion('/path/to/movie.mp4', self.video.id, self.base_name, {'720p': ('1280x720', '2800k')})
+
+        self.video.refresh_from_db()
+        self.assertEqual(self.video.hls_playlist, winner_playlist)
+        self.assertEqual(self.video.sprites_vtt, '/media/videos/hls/winner/sprites.0123456789abcdef.vtt')
+        self.assertFalse(os.path.exists(self.base_name))
+
+        duplicate = Video.objects.create(title="Duplicate", description="Description", source_digest=self.video.source_digest)
+        self.assertEqual(shared_sprites_vtt(winner_playlist, duplicate.id), self.video.sprites_vtt)
+
+    @mock.patch('content.tasks.delete_mp4')
+    def test_failed_save_can_be_retried(self, mock_delete_mp4):
+        """Test that a retry after a failed save keeps the checkpoints, fingerprints nothing twice and registers one owner"""
+        self.write('720p_000.ts', 'segment 0')
+        self.write('720p.m3u8', "#EXTM3U\n#EXTINF:5.0,\n720p_000.ts\n#EXT-X-ENDLIST\n")
+        save_checkpoint(self.base_name, '720p')
+        qualities = {'720p': ('1280x720', '2800k')}
+
+        with mock.patch.object(Video, 'save', side_effect=DatabaseError('connection lost')):
+            with self.assertRaises(DatabaseError):
+                finish_conversion('/path/to/movie.mp4', self.video.id, self.base_name, qualities)
+
+        self.assertFalse(HlsOutput.objects.exists())
+        self.assertTrue(is_checkpointed(self.base_name, '720p'))
+        files = sorted(os.listdir(self.base_name))
+
+        finish_conversion('/path/to/movie.mp4', self.video.id, self.base_name, qualities)
+
+        self.video.refresh_from_db()
+        self.assertEqual(HlsOutput.objects.get().ref_count, 1)
+        self.assertEqual(HlsOutput.objects.get().hls_playlist, self.video.hls_playlist)
+        self.assertEqual(sorted(os.listdir(self.base_name)), [name for name in files if name != '.checkpoints'])
+        self.assertIn(os.path.basename(self.video.hls_playlist), files)
+
+    @mock.patch('content.tasks.delete_mp4')
+    def test_retry_after_save_does_not_add_owner(self, mock_delete_mp4):
+        """Test that a conversion retried after the video was saved doesn't count the video as a second owner"""
+        self.write('720p_000.ts', 'segment 0')
+        self.write('720p.m3u8', "#EXTM3U\n#EXTINF:5.0,\n720p_000.ts\n#EXT-X-ENDLIST\n")
+        finish_conversion('/path/to/movie.mp4', self.video.id, self.base_name, {'720p': ('1280x720', '2800k')})
+
+        convert_to_hls('/path/to/movie.mp4', self.video.id)
+
+        self.assertEqual(HlsOutput.objects.get().ref_count, 1)
+        self.assertEqual(mock_delete_mp4.call_count, 2)
+
+    @mock.patch('content.tasks.delete_mp4')
+    def test_stitch_can_be_retried(self, mock_delete_mp4):
+        """Test that the chunk playlists are kept until the video is saved, so a failed stitch job can run again"""
+        for index in range(2):
+            self.write(f'720p_c00{index}_000.ts', f'segment {index}')
+            self.write(f'720p_c00{index}.m3u8', f"#EXTM3U\n#EXTINF:5.0,\n720p_c00{index}_000.ts\n#EXT-X-ENDLIST\n")
+        qualities = {'720p': ('1280x720', '2800k')}
+
+        with mock.patch('content.tasks.HlsOutput.register', side_effect=DatabaseError('connection lost')):
+            with self.assertRaises(DatabaseError):
+                stitch_chunked_hls('/path/to/movie.mp4', self.video.id, self.base_name, qualities, 2)
+        stitch_chunked_hls('/path/to/movie.mp4', self.video.id, self.base_name, qualities, 2)
+
+        self.video.refresh_from_db()
+        media_playlist = self.read(os.path.basename(self.video.hls_playlist)).splitlines()[-1]
+        segments = [line for line in self.read(media_playlist).splitlines() if not line.startswith('#')]
+        self.assertEqual([segment.split('.')[0] for segment in segments], ['720p_c000_000', '720p_c001_000'])
+        self.assertFalse(any(name.startswith('720p_c00') and name.endswith('.m3u8') for name in os.listdir(self.base_name)))
+
+    @unittest.skipUnless(brotli, 'brotli is not installed')
+    def test_brotli_is_preferred(self):
+        """Test that the brotli sibling is sent to clients accepting it"""
+        self.write('playlist.m3u8', "#EXTM3U\n")
+        precompress(os.path.join(self.base_name, 'playlist.m3u8'))
+
+        response = self.client.get(reverse('hls_media', kwargs={'path': 'movie/playlist.m3u8'}),
+                                   HTTP_ACCEPT_ENCODING='gzip, br')
+
+        self.assertEqual(response['Content-Encoding'], 'br')
+        self.assertEqual(response['Cache-Control'], 'public, no-cache')
+        self.assertEqual(brotli.decompress(b''.join(response.streaming_content)), b"#EXTM3U\n")
+
+
+class SegmentCacheTests(APITestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        media = override_settings(MEDIA_ROOT=self.tmp.name)
+        media.enable()
+        self.addCleanup(media.disable)
+        segment_cache.clear()
+        self.addCleanup(segment_cache.clear)
+        self.base_name = os.path.join(self.tmp.name, 'videos', 'hls', 'movie')
+        os.makedirs(self.base_name)
+        for name, content in (('playlist.m3u8', b'#EXTM3U\n'), ('720p_000.ts', b'first'), ('720p_009.ts', b'later')):
+            with open(os.path.join(self.base_name, name), 'wb') as f:
+                f.write(content)
+
+    def get(self, name, **headers):
+        return self.client.get(reverse('hls_media', kwargs={'path': f'movie/{name}'}), **headers)
+
+    @override_settings(HLS_SEGMENT_CACHE_BYTES=10, HLS_SEGMENT_CACHE_MAX_ITEM_BYTES=6)
+    def test_lru_is_bounded_by_bytes(self):
+        """Test that the least recently used entries are evicted once the byte budget is exceeded"""
+        cache = SegmentCache()
+        cache.put('a', b'aaaa', '"a"')
+        cache.put('b', b'bbbb', '"b"')
+        cache.get('a')
+        cache.put('c', b'cccc', '"c"')
+        cache.put('big', b'1234567', '"big"')
+
+        self.assertEqual(list(cache.entries), ['a', 'c'])
+        self.assertEqual(cache.stats()['bytes'], 8)
+
+    def test_hot_files_are_served_from_memory(self):
+        """Test that playlists and first segments are cached after the first request, later segments are not"""
+        self.assertEqual(self.get('720p_000.ts').content, b'first')
+        os.remove(os.path.join(self.base_name, '720p_000.ts'))
+
+        response = self.get('720p_000.ts', HTTP_RANGE='bytes=1-2')
+
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.content, b'ir')
+        self.assertEqual(response['Content-Range'], 'bytes 1-2/5')
+        self.get('720p_009.ts')
+        self.assertEqual(list(segment_cache.entries), ['movie/720p_000.ts'])
+        stats = segment_cache.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+
+    @override_settings(HLS_SEGMENT_CACHE_HEAD_BYTES=8)
+    def test_fmp4_head_is_served_from_memory(self):
+        """Test that the start of a single file fMP4 rendition is cached and ranges past it are read from disk"""
+        with open(os.path.join(self.base_name, '720p.mp4'), 'wb') as f:
+            f.write(b'initfrag-later-fragments')
+        self.get('720p.mp4', HTTP_RANGE='bytes=0-3')
+        with open(os.path.join(self.base_name, '720p.mp4'), 'r+b') as f:
+            f.write(b'changed!')
+
+        head = self.get('720p.mp4', HTTP_RANGE='bytes=4-7')
+        tail = self.get('720p.mp4', HTTP_RANGE='bytes=9-13')
+
+        self.assertEqual(head.content, b'frag')
+        self.assertEqual(head['Content-Range'], 'bytes 4-7/24')
+        self.assertEqual(b''.join(tail.streaming_content), b'later')
+        self.assertEqual(len(segment_cache.entries['movie/720p.mp4'][0]), 8)
+        self.assertEqual(segment_cache.stats()['hits'], 2)
+
+    @override_settings(HLS_SEGMENT_CACHE_REDIS=True)
+    def test_warmed_output_is_shared_through_redis(self):
+        """Test that the worker warms Redis, web processes read it and deleting the video evicts it"""
+        warm_output(self.base_name)
+        for name in os.listdir(self.base_name):
+            os.remove(os.path.join(self.base_name, name))
+
+        response = self.get('playlist.m3u8')
+
+        self.assertEqual(response.content, b'#EXTM3U\n')
+        self.assertEqual(segment_cache.stats()['redis_hits'], 1)
+
+        video = Video.objects.create(
+            title="Movie",
+            description="Description",
+            video_file=SimpleUploadedFile("movie.mp4", b"file_content", content_type="video/mp4"),
+            hls_playlist='/media/videos/hls/movie/playlist.m3u8'
+        )
+        video.delete()
+
+        self.assertEqual(segment_cache.stats()['entries'], 0)
+        self.assertEqual(self.get('playlist.m3u8').status_code, 404)
+
+    def test_stats_endpoint_is_admin_only(self):
+        """Test that the cache counters are only visible to admins"""
+        url = reverse('segment_cache_stats')
+        self.assertIn(self.client.get(url).status_code, (status.HTTP_401_UNAUTHORIZED, status.HTTP_403_FORBIDDEN))
+
+        self.client.force_authenticate(User.objects.create_superuser(username="admin", password="adminpassword"))
+        response = self.client.get(url)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(set(response.json()), {'pid', 'entries', 'bytes', 'max_bytes', 'hits', 'redis_hits', 'misses', 'hit_ratio'})
+
+
 class DeleteMP4Tests(TestCase):
     
     @mock.patch('content.tasks.os.path.exists')
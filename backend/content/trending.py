@@ -0,0 +1,97 @@
+import time
+import numpy as np
+from django.conf import settings
+from django_redis import get_redis_connection
+from content.catalog_cache import bump
+from content.scheduling import job_started, schedule_once
+
+TRENDING_TAG = 'trending'
+
+BUCKET_KEY = 'videoflix:trending:views:{bucket}'
+SCORES_KEY = 'videoflix:trending'
+UPDATE_SCHEDULED_KEY = 'videoflix:trending:update-scheduled'
+
+
+def bucket_seconds():
+    return getattr(settings, 'TRENDING_BUCKET_SECONDS', 3600)
+
+
+def current_bucket():
+    return int(time.time() // bucket_seconds())
+
+
+def count_view(pipeline, video_id):
+    """
+    Adds a view of a video to the current time bucket, on a pipeline of the caller.
+    Buckets expire once they are older than settings.TRENDING_BUCKETS.
+    """
+    key = BUCKET_KEY.format(bucket=current_bucket())
+    pipeline.hincrby(key, video_id, 1)
+    pipeline.expire(key, bucket_seconds() * (getattr(settings, 'TRENDING_BUCKETS', 48) + 1))
+
+
+def trending_scores(buckets, now, half_life):
+    """
+    Sums the views of every video over the buckets, each bucket weighted by 2^(-age / half_life),
+    in one vectorized pass. buckets is a list of (bucket, {video id: views}).
+    Returns the video ids and their scores as arrays.
+    """
+    ids, views, weights = [], [], []
+    for bucket, counts in buckets:
+        if not counts:
+            continue
+        ids.append(np.fromiter((int(video_id) for video_id in counts), dtype=np.int64, count=len(counts)))
+        views.append(np.fromiter((int(count) for count in counts.values()), dtype=np.float64, count=len(counts)))
+        weights.append(np.full(len(counts), 0.5 ** ((now - bucket) / half_life)))
+    if not ids:
+        return np.array([], dtype=np.int64), np.array([])
+    video_ids, positions = np.unique(np.concatenate(ids), return_inverse=True)
+    scores = np.bincount(positions, weights=np.concatenate(views) * np.concatenate(weights))
+    return video_ids, scores
+
+
+def update_trending():
+    """
+    Recomputes the trending scores from the view buckets and replaces the sorted set SCORES_KEY
+    with them at once, so readers never see a half written ranking. Scheduled by schedule_update,
+    it schedules its next run while videos have views in the window, so the ranking keeps
+    decaying without new views and is cleared once the last views expired.
+    """
+    job_started(UPDATE_SCHEDULED_KEY)
+    connection = get_redis_connection('default')
+    now = current_bucket()
+    bucket_count = getattr(settings, 'TRENDING_BUCKETS', 48)
+    buckets = list(range(now - bucket_count + 1, now + 1))
+    pipeline = connection.pipeline(transaction=False)
+    for bucket in buckets:
+        pipeline.hgetall(BUCKET_KEY.format(bucket=bucket))
+    half_life = getattr(settings, 'TRENDING_HALF_LIFE', 6 * 3600) / bucket_seconds()
+    video_ids, scores = trending_scores(list(zip(buckets, pipeline.execute())), now, half_life)
+
+    temporary_key = f'{SCORES_KEY}:next'
+    connection.delete(temporary_key)
+    for start in range(0, len(video_ids), 10000):
+        connection.zadd(temporary_key, dict(zip(video_ids[start:start + 10000].tolist(), scores[start:start + 10000].tolist())))
+    if len(video_ids):
+        connection.rename(temporary_key, SCORES_KEY)
+    else:
+        connection.delete(SCORES_KEY)
+    bump(TRENDING_TAG)
+    print(f'Updated trending scores of {len(video_ids)} videos')
+    if len(video_ids):
+        schedule_update()
+    return len(video_ids)
+
+
+def schedule_update():
+    """
+    Enqueues update_trending settings.TRENDING_INTERVAL seconds from now, unless it already is.
+    """
+    schedule_once(UPDATE_SCHEDULED_KEY, getattr(settings, 'TRENDING_INTERVAL', 300), update_trending)
+
+
+def trending_ids(limit):
+    """
+    The ids of the limit highest scored videos, a range read of the sorted set.
+    """
+    return [int(video_id) for video_id in get_redis_connection('default').zrevrange(SCORES_KEY, 0, limit - 1)]
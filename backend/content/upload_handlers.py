@@ -0,0 +1,35 @@
+from django.core.files.uploadhandler import MemoryFileUploadHandler, TemporaryFileUploadHandler
+from .utils import SourceDigest
+
+
+class SourceDigestMixin:
+    """
+    Hashes every upload while it is received, the digest is stored as
+    source_digest on the uploaded file.
+    """
+
+    def new_file(self, *args, **kwargs):
+        # MemoryFileUploadHandler raises StopFutureHandlers from new_file, so set up the digest first.
+        self.digest = SourceDigest()
+        super().new_file(*args, **kwargs)
+
+    def receive_data_chunk(self, raw_data, start):
+        # Only the handler that stores the file hashes it, the others just pass the data on.
+        result = super().receive_data_chunk(raw_data, start)
+        if result is None:
+            self.digest.update(raw_data)
+        return result
+
+    def file_complete(self, file_size):
+        file = super().file_complete(file_size)
+        if file is not None:
+            file.source_digest = self.digest.hexdigest()
+        return file
+
+
+class HashingMemoryFileUploadHandler(SourceDigestMixin, MemoryFileUploadHandler):
+    pass
+
+
+class HashingTemporaryFileUploadHandler(SourceDigestMixin, TemporaryFileUploadHandler):
+    pass
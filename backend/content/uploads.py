@@ -0,0 +1,163 @@
+import os
+import shutil
+import time
+import uuid
+from datetime import timedelta
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.http import UnreadablePostError
+from django.utils import timezone
+from content.models import UploadSession, Video
+from content.scheduling import job_started, schedule_once
+from content.utils import resume_digest
+
+READ_SIZE = 1024 * 1024
+CLEANUP_SCHEDULED_KEY = 'videoflix:uploads:cleanup-scheduled'
+
+
+def staging_path(session):
+    return os.path.join(settings.UPLOAD_STAGING_ROOT, str(session.id))
+
+def create_staging_file(session):
+    os.makedirs(settings.UPLOAD_STAGING_ROOT, exist_ok=True)
+    open(staging_path(session), 'wb').close()
+
+def delete_staging_file(session):
+    path = staging_path(session)
+    if os.path.exists(path):
+        os.remove(path)
+        print(f'{path} deleted')
+
+def chunk_timeout():
+    return getattr(settings, 'UPLOAD_CHUNK_TIMEOUT', 60)
+
+def claim_writer(session):
+    """
+    Makes the calling request the writer of the session for UPLOAD_CHUNK_TIMEOUT seconds, so the
+    chunk can be received without holding the row lock. Call with the row locked. Returns the
+    writer token, or None while another request is still receiving a chunk.
+    """
+    now = timezone.now()
+    if session.writer and session.writer_expires_at > now:
+        return None
+    session.writer = uuid.uuid4()
+    session.writer_expires_at = now + timedelta(seconds=chunk_timeout())
+    session.save(update_fields=['writer', 'writer_expires_at', 'updated_at'])
+    return session.writer
+
+def renew_writer(session, writer):
+    """
+    Extends the lease of writer by UPLOAD_CHUNK_TIMEOUT seconds. Returns False if it was lost.
+    """
+    return bool(UploadSession.objects.filter(pk=session.pk, writer=writer).update(
+        writer_expires_at=timezone.now() + timedelta(seconds=chunk_timeout()), updated_at=timezone.now()))
+
+def release_writer(session, writer):
+    UploadSession.objects.filter(pk=session.pk, writer=writer).update(writer=None, writer_expires_at=None)
+
+def append_chunk(session, writer, stream, chunk_length):
+    """
+    Appends up to chunk_length bytes of stream to the staging file and hashes them on the way.
+    Bytes past the stored offset, left over from an interrupted request, are dropped first.
+    If the client disconnects, the bytes received until then are kept. The lease of writer is
+    renewed while the chunk arrives and the offset is only advanced while writer still holds
+    it. A finished upload stays with writer for complete_upload. Returns the digest, or None
+    if the lease was lost to another request in the meantime.
+    """
+    path = staging_path(session)
+    received = 0
+    renew_at = time.monotonic() + chunk_timeout() / 2
+    try:
+        digest = resume_digest(path, session.offset, session.block_digests)
+        with open(path, 'r+b') as f:
+            f.seek(session.offset)
+            f.truncate()
+            try:
+                while received < chunk_length:
+                    data = stream.read(min(READ_SIZE, chunk_length - received))
+                    if not data:
+                        break
+                    if time.monotonic() >= renew_at:
+                        if not renew_writer(session, writer):
+                            print(f'Upload {session.id} was taken over by another request, chunk dropped')
+                            return None
+                        renew_at = time.monotonic() + chunk_timeout() / 2
+                    f.write(data)
+                    digest.update(data)
+                    received += len(data)
+            except UnreadablePostError:
+                print(f'Upload {session.id} interrupted after {received} bytes')
+    except BaseException:
+        release_writer(session, writer)
+        raise
+
+    offset = session.offset + received
+    release = {} if offset == session.length else {'writer': None, 'writer_expires_at': None}
+    advanced = UploadSession.objects.filter(pk=session.pk, writer=writer).update(
+        offset=offset, block_digests=digest.block_digests, updated_at=timezone.now(), **release)
+    if not advanced:
+        print(f'Upload {session.id} was taken over by another request, chunk dropped')
+        return None
+    session.offset = offset
+    session.block_digests = digest.block_digests
+    if release:
+        session.writer = session.writer_expires_at = None
+    return digest
+
+def complete_upload(session, writer, digest=None):
+    """
+    Moves the finished staging file to the video uploads and creates the Video, which enqueues
+    its conversion. Called by the writer of the session, which is released afterwards. Without
+    digest it is read from the staging file, to retry a failed completion. If anything fails,
+    the file is moved back and nothing is created, so the next PATCH can try again.
+    """
+    source = staging_path(session)
+    if digest is None:
+        digest = resume_digest(source, session.offset, session.block_digests)
+    name = default_storage.get_available_name(os.path.join('videos', session.filename))
+    path = default_storage.path(name)
+    moved = False
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        shutil.move(source, path)
+        moved = True
+        with transaction.atomic():
+            video = Video(**session.metadata, video_file=name, source_digest=digest.hexdigest())
+            video.save()
+            completed = UploadSession.objects.filter(pk=session.pk, writer=writer).update(
+                video=video, writer=None, writer_expires_at=None, updated_at=timezone.now())
+            if not completed:
+                raise RuntimeError(f'Upload {session.id} was taken over by another request')
+    except BaseException:
+        if moved:
+            shutil.move(path, source)
+        release_writer(session, writer)
+        raise
+    session.video = video
+    session.writer = session.writer_expires_at = None
+    print(f'Upload {session.id} completed as {name}')
+    return video
+
+def schedule_cleanup():
+    """
+    Schedules delete_stale_uploads in UPLOAD_CLEANUP_INTERVAL seconds, unless it already is.
+    """
+    schedule_once(CLEANUP_SCHEDULED_KEY, getattr(settings, 'UPLOAD_CLEANUP_INTERVAL', 60 * 60), delete_stale_uploads)
+
+def delete_stale_uploads():
+    """
+    Deletes the unfinished uploads without a chunk for UPLOAD_SESSION_TTL seconds together with
+    their staging files. Runs again while unfinished uploads remain.
+    """
+    job_started(CLEANUP_SCHEDULED_KEY)
+    deleted = 0
+    for session in UploadSession.expired().iterator():
+        delete_staging_file(session)
+        session.delete()
+        deleted += 1
+    if deleted:
+        print(f'{deleted} stale uploads deleted')
+    if UploadSession.objects.filter(video__isnull=True).exists():
+        schedule_cleanup()
+    return deleted
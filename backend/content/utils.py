@@ -0,0 +1,93 @@
+import hashlib
+import os
+import re
+
+DIGEST_BLOCK_SIZE = 8 * 1024 * 1024
+
+# HLS output files are renamed to <name>.<fingerprint>.<ext> once the conversion finished
+FINGERPRINT_LENGTH = 16
+FINGERPRINT_RE = re.compile(r'\.[0-9a-f]{%d}\.[^./]+$' % FINGERPRINT_LENGTH)
+
+
+class SourceDigest:
+    """
+    Content digest of an uploaded video, used to detect duplicate uploads.
+    The data is hashed in blocks of DIGEST_BLOCK_SIZE bytes, the digest is the SHA-256 of the
+    concatenated block digests. Apart from the open block only the finished block digests are
+    needed, so hashing can continue later from block_digests.
+    """
+
+    def __init__(self, block_digests=''):
+        self.block_digests = block_digests
+        self._block = hashlib.sha256()
+        self._block_length = 0
+
+    def update(self, data):
+        view = memoryview(data)
+        while view:
+            part = view[:DIGEST_BLOCK_SIZE - self._block_length]
+            self._block.update(part)
+            self._block_length += len(part)
+            view = view[len(part):]
+            if self._block_length == DIGEST_BLOCK_SIZE:
+                self.block_digests += self._block.hexdigest()
+                self._block = hashlib.sha256()
+                self._block_length = 0
+
+    def hexdigest(self):
+        block_digests = self.block_digests
+        if self._block_length or not block_digests:
+            block_digests += self._block.hexdigest()
+        return hashlib.sha256(block_digests.encode()).hexdigest()
+
+
+def file_digest(path, chunk_size=1024 * 1024):
+    """
+    Computes the SourceDigest of a file on disk.
+    """
+    digest = SourceDigest()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def resume_digest(path, offset, block_digests):
+    """
+    Continues the SourceDigest of the first offset bytes of a file. The finished blocks are
+    taken from block_digests, only the unaligned tail after the last full block is read again.
+    """
+    if len(block_digests) != offset // DIGEST_BLOCK_SIZE * 64:
+        raise ValueError(f'{len(block_digests) // 64} block digests do not match offset {offset}')
+
+    digest = SourceDigest(block_digests)
+    tail_start = offset - offset % DIGEST_BLOCK_SIZE
+    with open(path, 'rb') as f:
+        f.seek(tail_start)
+        remaining = offset - tail_start
+        while remaining:
+            data = f.read(min(1024 * 1024, remaining))
+            if not data:
+                raise ValueError(f'{path} is shorter than offset {offset}')
+            digest.update(data)
+            remaining -= len(data)
+    return digest
+
+
+def is_fingerprinted(name):
+    return bool(FINGERPRINT_RE.search(name))
+
+
+def unfingerprinted_name(name):
+    """
+    The name a fingerprinted file had before, e.g. 720p_000.ts for 720p_000.<fingerprint>.ts.
+    """
+    match = FINGERPRINT_RE.search(name)
+    return name[:match.start()] + os.path.splitext(name)[1] if match else name
+
+
+def file_etag(stat):
+    """
+    Strong ETag of a file from its modification time and size.
+    """
+    return f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
@@ -1,3 +1,219 @@
-from django.shortcuts import render
+import mimetypes
+import os
+import re
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.http import FileResponse, Http404, HttpResponse, HttpResponseNotModified
+from django.utils._os import safe_join
+from django.utils.http import parse_etags
+from django.views.decorators.http import require_safe
+from content.segment_cache import cached_length, is_hot, segment_cache
+from content.utils import file_etag, is_fingerprinted
 
-# Create your views here.
+# mimetypes doesn't know .ts as MPEG transport stream
+MEDIA_TYPES = {
+    '.m3u8': 'application/vnd.apple.mpegurl',
+    '.ts': 'video/mp2t',
+    '.mp4': 'video/mp4',
+    '.vtt': 'text/vtt',
+}
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+# Precompressed siblings written by tasks.precompress, in order of preference
+PRECOMPRESSED = (('br', '.br'), ('gzip', '.gz'))
+PRECOMPRESSED_TYPES = ('.m3u8', '.vtt')
+
+# Fingerprinted files never change, everything else is revalidated with its ETag
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+REVALIDATE_CACHE_CONTROL = 'public, no-cache'
+
+
+class RangeFile:
+    """
+    Read-only view of length bytes of a file from start on. fileno() is the one of the file,
+    so wsgi.file_wrapper (gunicorn) can still sendfile() the range without copying it through Python.
+    """
+
+    def __init__(self, file, start, length):
+        self.file = file
+        self.file.seek(start)
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def close(self):
+        self.file.close()
+
+
+def parse_range(header, size):
+    """
+    Returns the (start, end) bytes of a single range Range header, None if the header is
+    missing or not supported (the whole file is sent then). Raises ValueError if the range
+    can't be satisfied.
+    """
+    match = RANGE_RE.match(header or '')
+    if not match or match.groups() == ('', ''):
+        return None
+    start, end = match.groups()
+    if not start:
+        start, end = max(size - int(end), 0), size - 1
+    else:
+        start, end = int(start), min(int(end), size - 1) if end else size - 1
+    if start >= size or start > end:
+        raise ValueError(f'Range {header} not satisfiable for {size} bytes')
+    return start, end
+
+
+def accepted_encodings(header):
+    """
+    Returns the content codings of an Accept-Encoding header that are not refused with q=0.
+    """
+    encodings = set()
+    for part in (header or '').split(','):
+        coding, _, params = part.strip().partition(';')
+        quality = params.strip().partition('q=')[2]
+        try:
+            if quality and float(quality) == 0:
+                continue
+        except ValueError:
+            continue
+        encodings.add(coding.strip().lower())
+    return encodings
+
+
+def precompressed_variant(request, path):
+    """
+    Returns the path and content coding of a precompressed sibling the client accepts,
+    or the path itself without coding.
+    """
+    if path.endswith(PRECOMPRESSED_TYPES) and 'Range' not in request.headers:
+        accepted = accepted_encodings(request.headers.get('Accept-Encoding'))
+        for coding, extension in PRECOMPRESSED:
+            if coding in accepted and os.path.isfile(path + extension):
+                return path + extension, coding
+    return path, None
+
+
+def cached_variant(request, path):
+    """
+    Looks up the file, or a precompressed sibling the client accepts, in the segment cache.
+    Returns (name, coding, data, etag, size) or None.
+    """
+    variants = []
+    if path.endswith(PRECOMPRESSED_TYPES) and 'Range' not in request.headers:
+        accepted = accepted_encodings(request.headers.get('Accept-Encoding'))
+        variants = [(path + extension, coding) for coding, extension in PRECOMPRESSED if coding in accepted]
+    for name, coding in variants + [(path, None)]:
+        entry = segment_cache.get(name)
+        if entry:
+            return name, coding, *entry
+    segment_cache.miss()
+    return None
+
+
+def not_modified(request, headers):
+    etags = parse_etags(request.headers.get('If-None-Match', ''))
+    if '*' not in etags and headers['ETag'] not in etags:
+        return None
+    response = HttpResponseNotModified()
+    for header, value in headers.items():
+        response[header] = value
+    return response
+
+
+def unsatisfiable(size):
+    response = HttpResponse(status=416)
+    response['Content-Range'] = f'bytes */{size}'
+    return response
+
+
+def media_type(path):
+    extension = os.path.splitext(path)[1].lower()
+    return MEDIA_TYPES.get(extension) or mimetypes.guess_type(path)[0] or 'application/octet-stream'
+
+
+@require_safe
+def serve_hls(request, path):
+    """
+    Serves HLS playlists, segments and sprites with HTTP Range support. With
+    settings.MEDIA_ACCEL_REDIRECT the file is handed off to nginx via X-Accel-Redirect,
+    otherwise the response streams the open file, so gunicorn can sendfile() it.
+    Fingerprinted files are marked immutable, playlists are sent precompressed when the
+    client accepts it, and a matching If-None-Match is answered with 304.
+    Playlists, the first segments and ranges within the cached head of fMP4 renditions are
+    answered from the segment cache without touching the disk.
+    """
+    hls_root = os.path.join(settings.MEDIA_ROOT, 'videos', 'hls')
+    try:
+        full_path = safe_join(hls_root, path)
+    except SuspiciousFileOperation:
+        raise Http404('Not found')
+
+    cache_control = IMMUTABLE_CACHE_CONTROL if is_fingerprinted(path) else REVALIDATE_CACHE_CONTROL
+    accel_prefix = getattr(settings, 'MEDIA_ACCEL_REDIRECT', '')
+    name = os.path.relpath(full_path, hls_root)
+    cached = None if accel_prefix or not is_hot(name) else cached_variant(request, name)
+
+    if cached:
+        cached_name, coding, data, etag, size = cached
+        file_path = os.path.join(hls_root, cached_name)
+    else:
+        data = None
+        if not os.path.isfile(full_path):
+            raise Http404('Not found')
+        if accel_prefix:
+            response = HttpResponse(content_type=media_type(full_path))
+            response['X-Accel-Redirect'] = accel_prefix.rstrip('/') + '/videos/hls/' + path
+            response['Cache-Control'] = cache_control
+            return response
+        file_path, coding = precompressed_variant(request, full_path)
+        stat = os.stat(file_path)
+        etag = file_etag(stat)
+        size = stat.st_size
+
+    headers = {'ETag': etag, 'Cache-Control': cache_control, 'Accept-Ranges': 'bytes'}
+    if full_path.endswith(PRECOMPRESSED_TYPES):
+        headers['Vary'] = 'Accept-Encoding'
+    response = not_modified(request, headers)
+    if response:
+        return response
+
+    if not cached and is_hot(name) and cached_length(name, size) <= segment_cache.max_item_bytes:
+        with open(file_path, 'rb') as f:
+            data = f.read(cached_length(name, size))
+        segment_cache.put(os.path.relpath(file_path, hls_root), data, etag, size)
+
+    try:
+        byte_range = parse_range(request.headers.get('Range'), size)
+    except ValueError:
+        return unsatisfiable(size)
+    if data is not None and (byte_range[1] if byte_range else size - 1) >= len(data):
+        # Beyond the cached head of the file
+        data = None
+
+    if data is not None:
+        start, end = byte_range or (0, size - 1)
+        response = HttpResponse(data[start:end + 1], status=206 if byte_range else 200, content_type=media_type(full_path))
+    elif byte_range is None:
+        response = FileResponse(open(file_path, 'rb'), content_type=media_type(full_path))
+    else:
+        start, end = byte_range
+        response = FileResponse(RangeFile(open(file_path, 'rb'), start, end - start + 1), status=206,
+                                content_type=media_type(full_path))
+        response['Content-Length'] = end - start + 1
+    if byte_range:
+        response['Content-Range'] = f'bytes {byte_range[0]}-{byte_range[1]}/{size}'
+    if coding:
+        response['Content-Encoding'] = coding
+    for header, value in headers.items():
+        response[header] = value
+    return response
@@ -0,0 +1,152 @@
+import json
+import time
+from datetime import datetime, timezone
+import redis
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import F
+from django_redis import get_redis_connection
+from content.catalog_cache import CACHE_ERRORS
+from content.models import Video, WatchProgress
+from content.scheduling import job_started, schedule_once
+from sub_profiles.models import SubProfile
+
+POSITIONS_KEY = 'videoflix:watch:{subprofile_id}'
+DIRTY_KEY = 'videoflix:watch:dirty'
+FLUSH_SCHEDULED_KEY = 'videoflix:watch:flush-scheduled'
+OWNER_KEY = 'watch:owner:{subprofile_id}'
+POSITIONS_TTL = 60 * 60 * 24
+
+
+def positions_key(subprofile_id):
+    return POSITIONS_KEY.format(subprofile_id=subprofile_id)
+
+
+def owns_subprofile(user, subprofile_id):
+    """
+    Whether the sub profile belongs to the user. The owner is cached, so heartbeats don't
+    query the database. Without the cache the owner is read from the database.
+    """
+    key = OWNER_KEY.format(subprofile_id=subprofile_id)
+    try:
+        owner_id = cache.get(key)
+    except CACHE_ERRORS as e:
+        print(f'Sub profile owner cache unavailable: {e}')
+        owner_id = None
+    if owner_id is None:
+        owner_id = SubProfile.objects.filter(pk=subprofile_id).values_list('parent_profile__user_id', flat=True).first()
+        if owner_id is None:
+            return False
+        try:
+            cache.set(key, owner_id, timeout=60 * 60)
+        except CACHE_ERRORS:
+            pass
+    return owner_id == user.id
+
+
+def record_heartbeat(subprofile_id, video_id, position, duration=None):
+    """
+    Stores the playback position in the Redis hash of the sub profile. flush_positions writes
+    the positions that changed to the database every settings.WATCH_PROGRESS_FLUSH_INTERVAL seconds.
+    Without Redis the heartbeat is dropped, the next one carries the position again.
+    Returns False if it was dropped.
+    """
+    entry = json.dumps({'position': position, 'duration': duration, 'updated_at': time.time()})
+    try:
+        pipeline = get_redis_connection('default').pipeline()
+        pipeline.hset(positions_key(subprofile_id), video_id, entry)
+        pipeline.expire(positions_key(subprofile_id), POSITIONS_TTL)
+        pipeline.sadd(DIRTY_KEY, f'{subprofile_id}:{video_id}')
+        pipeline.execute()
+    except redis.RedisError as e:
+        print(f'Dropped heartbeat of sub profile {subprofile_id}: {e}')
+        return False
+    schedule_flush()
+    return True
+
+
+def schedule_flush():
+    schedule_once(FLUSH_SCHEDULED_KEY, getattr(settings, 'WATCH_PROGRESS_FLUSH_INTERVAL', 5), flush_positions)
+
+
+def parse_entry(entry):
+    entry = json.loads(entry)
+    entry['updated_at'] = datetime.fromtimestamp(entry['updated_at'], tz=timezone.utc)
+    return entry
+
+
+def flush_positions():
+    """
+    Writes the positions that changed since the last flush to WatchProgress, one
+    bulk_create(update_conflicts=True) per batch of settings.WATCH_PROGRESS_FLUSH_BATCH_SIZE,
+    so a heartbeat is never a database write of its own. The positions stay in Redis as the
+    latest state.
+    """
+    job_started(FLUSH_SCHEDULED_KEY)
+    connection = get_redis_connection('default')
+    batch_size = getattr(settings, 'WATCH_PROGRESS_FLUSH_BATCH_SIZE', 1000)
+    flushed = 0
+    while True:
+        members = connection.spop(DIRTY_KEY, batch_size)
+        if not members:
+            break
+        keys = [tuple(int(part) for part in member.decode().split(':')) for member in members]
+        pipeline = connection.pipeline(transaction=False)
+        for subprofile_id, video_id in keys:
+            pipeline.hget(positions_key(subprofile_id), video_id)
+        entries = {key: parse_entry(entry) for key, entry in zip(keys, pipeline.execute()) if entry}
+
+        # Sub profiles or videos deleted in the meantime would violate the foreign keys
+        subprofile_ids = set(SubProfile.objects.filter(pk__in={key[0] for key in entries}).values_list('id', flat=True))
+        video_ids = set(Video.objects.filter(pk__in={key[1] for key in entries}).values_list('id', flat=True))
+        try:
+            WatchProgress.objects.bulk_create(
+                [
+                    WatchProgress(subprofile_id=subprofile_id, video_id=video_id, **entry)
+                    for (subprofile_id, video_id), entry in entries.items()
+                    if subprofile_id in subprofile_ids and video_id in video_ids
+                ],
+                update_conflicts=True,
+                unique_fields=['subprofile', 'video'],
+                update_fields=['position', 'duration', 'updated_at'],
+            )
+        except Exception:
+            connection.sadd(DIRTY_KEY, *members)
+            schedule_flush()
+            raise
+        flushed += len(entries)
+    print(f'Flushed {flushed} watch positions')
+    return flushed
+
+
+def is_finished(entry):
+    ratio = getattr(settings, 'WATCH_PROGRESS_FINISHED_RATIO', 0.95)
+    return bool(entry['duration']) and entry['position'] >= entry['duration'] * ratio
+
+
+def continue_watching(subprofile_id, limit):
+    """
+    The latest started but unfinished videos of a sub profile as (video id, entry) pairs,
+    newest first. Positions still buffered in Redis win over the stored ones, without Redis
+    only the stored ones are used.
+    """
+    try:
+        buffered = get_redis_connection('default').hgetall(positions_key(subprofile_id))
+    except redis.RedisError as e:
+        print(f'Buffered watch positions unavailable: {e}')
+        buffered = {}
+    ratio = getattr(settings, 'WATCH_PROGRESS_FINISHED_RATIO', 0.95)
+    # Buffered positions may finish stored ones, so that many more are read
+    stored = WatchProgress.objects.filter(subprofile_id=subprofile_id, position__gt=0).exclude(
+        duration__gt=0, position__gte=F('duration') * ratio
+    ).order_by('-updated_at').values('video_id', 'position', 'duration', 'updated_at')[:limit + len(buffered)]
+    entries = {row['video_id']: row for row in stored}
+    for video_id, entry in buffered.items():
+        entry = parse_entry(entry)
+        current = entries.get(int(video_id))
+        if not current or entry['updated_at'] >= current['updated_at']:
+            entries[int(video_id)] = dict(entry, video_id=int(video_id))
+
+    started = [entry for entry in entries.values() if entry['position'] > 0 and not is_finished(entry)]
+    started.sort(key=lambda entry: entry['updated_at'], reverse=True)
+    return [(entry['video_id'], entry) for entry in started[:limit]]
@@ -14,4 +14,9 @@ psql -v ON_ERROR_STOP=1 --username "postgres" <<-EOSQL
     GRANT ALL ON SCHEMA public TO ${DB_USER:-videoflix};
     GRANT ALL PRIVILEGES ON ALL TABLES IN SCHEMA public TO ${DB_USER:-videoflix};
     ALTER DEFAULT PRIVILEGES IN SCHEMA public GRANT ALL ON TABLES TO ${DB_USER:-videoflix};
+    -- Trigram index of the catalog search. migrate creates it as well (content.signals.create_extensions),
+    -- pg_trgm is a trusted extension; template1 passes it on to the test databases.
+    CREATE EXTENSION IF NOT EXISTS pg_trgm;
+    \c template1
+    CREATE EXTENSION IF NOT EXISTS pg_trgm;
 EOSQL
\ No newline at end of file
@@ -13,6 +13,7 @@ https://docs.djangoproject.com/en/5.1/ref/settings/
 from calendar import c
 from json import load
 import os
+import sys
 from pathlib import Path
 from decouple import config
 import ssl
@@ -35,6 +36,9 @@ EMAIL_SSL_CONTEXT = ssl.create_default_context(cafile=certifi.where())
 BASE_DIR = Path(__file__).resolve().parent.parent
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media/')
+# Internal nginx location that maps to MEDIA_ROOT, e.g. "/protected-media/". If set, HLS files
+# are handed off to nginx with X-Accel-Redirect instead of being sent by gunicorn.
+MEDIA_ACCEL_REDIRECT = os.environ.get("MEDIA_ACCEL_REDIRECT", default="")
 
 EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
 EMAIL_HOST = os.environ.get("EMAIL_HOST", default="smtp.mailtrap.io") 
@@ -69,6 +73,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
     'corsheaders',
     'rest_framework',
     'rest_framework.authtoken',
@@ -159,8 +164,109 @@ RQ_QUEUES = {
     },
 }
 
+# The tests flush the cache and write Redis keys directly, they get their own Redis databases
+# so they never touch the data of a running instance on the same server.
+TESTING = len(sys.argv) > 1 and sys.argv[1] == 'test'
+if TESTING:
+    CACHES['default']['LOCATION'] = os.environ.get(
+        "REDIS_TEST_LOCATION", default=CACHES['default']['LOCATION'].rsplit('/', 1)[0] + '/15'
+    )
+    CACHES['default']['KEY_PREFIX'] = 'videoflix-test'
+    RQ_QUEUES['default']['DB'] = os.environ.get("REDIS_TEST_DB", default=14)
+
 
 CACHE_TTL = 60 * 15
+# Catalog responses are served stale for CATALOG_CACHE_STALE_TTL seconds after CACHE_TTL while one
+# request recomputes them, see content.catalog_cache
+CATALOG_CACHE_STALE_TTL = int(os.environ.get("CATALOG_CACHE_STALE_TTL", default=60 * 5))
+CATALOG_CACHE_LOCK_TIMEOUT = int(os.environ.get("CATALOG_CACHE_LOCK_TIMEOUT", default=10))
+CATALOG_CACHE_WAIT = float(os.environ.get("CATALOG_CACHE_WAIT", default=2))
+# Videos per row of the home screen endpoint
+HOME_ROW_SIZE = int(os.environ.get("HOME_ROW_SIZE", default=10))
+# Views and reactions are collected in Redis and written to the database every
+# COUNTER_FLUSH_INTERVAL seconds, see content.counters
+COUNTER_FLUSH_INTERVAL = int(os.environ.get("COUNTER_FLUSH_INTERVAL", default=60))
+COUNTER_FLUSH_BATCH_SIZE = int(os.environ.get("COUNTER_FLUSH_BATCH_SIZE", default=500))
+# Text search configuration of the catalog search, changing it needs a new migration
+SEARCH_CONFIG = os.environ.get("SEARCH_CONFIG", default="english")
+# Search results are cached for SEARCH_CACHE_TTL seconds, see content.search
+SEARCH_CACHE_TTL = int(os.environ.get("SEARCH_CACHE_TTL", default=60))
+# Related videos per video, recomputed RECOMMENDATION_REFRESH_DELAY seconds after a change,
+# see content.recommendations
+RECOMMENDATION_COUNT = int(os.environ.get("RECOMMENDATION_COUNT", default=10))
+RECOMMENDATION_BATCH_SIZE = int(os.environ.get("RECOMMENDATION_BATCH_SIZE", default=512))
+RECOMMENDATION_REFRESH_DELAY = int(os.environ.get("RECOMMENDATION_REFRESH_DELAY", default=30))
+# Trending scores are the views of the last TRENDING_BUCKETS buckets of TRENDING_BUCKET_SECONDS,
+# halved every TRENDING_HALF_LIFE seconds, recomputed every TRENDING_INTERVAL seconds, see content.trending
+TRENDING_BUCKET_SECONDS = int(os.environ.get("TRENDING_BUCKET_SECONDS", default=3600))
+TRENDING_BUCKETS = int(os.environ.get("TRENDING_BUCKETS", default=48))
+TRENDING_HALF_LIFE = int(os.environ.get("TRENDING_HALF_LIFE", default=6 * 3600))
+TRENDING_INTERVAL = int(os.environ.get("TRENDING_INTERVAL", default=300))
+# Playback heartbeats are buffered in Redis and written to the database every
+# WATCH_PROGRESS_FLUSH_INTERVAL seconds, see content.watch_progress
+WATCH_PROGRESS_FLUSH_INTERVAL = int(os.environ.get("WATCH_PROGRESS_FLUSH_INTERVAL", default=5))
+WATCH_PROGRESS_FLUSH_BATCH_SIZE = int(os.environ.get("WATCH_PROGRESS_FLUSH_BATCH_SIZE", default=1000))
+WATCH_PROGRESS_FINISHED_RATIO = float(os.environ.get("WATCH_PROGRESS_FINISHED_RATIO", default=0.95))
+
+# Uploads are hashed while they are received, see content.upload_handlers
+FILE_UPLOAD_HANDLERS = [
+    'content.upload_handlers.HashingMemoryFileUploadHandler',
+    'content.upload_handlers.HashingTemporaryFileUploadHandler',
+]
+
+# Resumable uploads (content/api/uploads/) are staged here until their last chunk arrived.
+# Keep it on the same filesystem as MEDIA_ROOT, so finished uploads are moved without a copy.
+UPLOAD_STAGING_ROOT = os.environ.get("UPLOAD_STAGING_ROOT", default=os.path.join(MEDIA_ROOT, 'upload_staging/'))
+UPLOAD_MAX_LENGTH = int(os.environ.get("UPLOAD_MAX_LENGTH", default=20 * 1024 ** 3))
+# Unfinished uploads without a chunk for UPLOAD_SESSION_TTL seconds are deleted with their staging
+# file, checked every UPLOAD_CLEANUP_INTERVAL seconds. A request receiving a chunk holds the upload
+# for UPLOAD_CHUNK_TIMEOUT seconds and renews that while data arrives. If its worker is killed,
+# another request can take over once it expired, so keep it close to the gunicorn timeout.
+UPLOAD_SESSION_TTL = int(os.environ.get("UPLOAD_SESSION_TTL", default=60 * 60 * 24))
+UPLOAD_CLEANUP_INTERVAL = int(os.environ.get("UPLOAD_CLEANUP_INTERVAL", default=60 * 60))
+UPLOAD_CHUNK_TIMEOUT = int(os.environ.get("UPLOAD_CHUNK_TIMEOUT", default=60))
+
+# Video transcoding
+HLS_JOB_TIMEOUT = int(os.environ.get("HLS_JOB_TIMEOUT", default=760))
+# "single_pass" decodes the upload once for all qualities, "per_rendition" runs one ffmpeg per quality,
+# "parallel" runs the per-quality encodes concurrently
+HLS_ENCODE_MODE = os.environ.get("HLS_ENCODE_MODE", default="single_pass")
+# "ts" writes one file per 5 second segment, "fmp4" one fragmented MP4 per rendition addressed with byte ranges
+HLS_SEGMENT_FORMAT = os.environ.get("HLS_SEGMENT_FORMAT", default="ts")
+# Rename finished HLS files to content-hashed names, so they can be cached as immutable
+HLS_FINGERPRINT = os.environ.get("HLS_FINGERPRINT", default="True") == "True"
+HLS_MAX_PARALLEL_ENCODES = int(os.environ.get("HLS_MAX_PARALLEL_ENCODES", default=3))
+HLS_FFMPEG_THREADS = int(os.environ.get(
+    "HLS_FFMPEG_THREADS", default=max(1, (os.cpu_count() or 1) // HLS_MAX_PARALLEL_ENCODES)))
+# Uploads of at least HLS_CHUNKED_MIN_DURATION seconds are split at keyframes into chunks of
+# HLS_CHUNK_DURATION seconds, each encoded as its own RQ job (0 disables chunking)
+HLS_CHUNKED_MIN_DURATION = int(os.environ.get("HLS_CHUNKED_MIN_DURATION", default=0))
+HLS_CHUNK_DURATION = int(os.environ.get("HLS_CHUNK_DURATION", default=300))
+HLS_CHUNK_JOB_TIMEOUT = int(os.environ.get("HLS_CHUNK_JOB_TIMEOUT", default=1800))
+# The source chunks are staged here, outside the served HLS files, on storage shared with the workers
+HLS_CHUNK_ROOT = os.environ.get("HLS_CHUNK_ROOT", default=os.path.join(MEDIA_ROOT, 'hls_chunks/'))
+# Minimum seconds between two transcode progress updates in Redis
+HLS_PROGRESS_INTERVAL = float(os.environ.get("HLS_PROGRESS_INTERVAL", default=1.0))
+# Trickplay sprite sheets: one thumbnail of HLS_SPRITE_WIDTH pixels every HLS_SPRITE_INTERVAL seconds,
+# tiled HLS_SPRITE_COLUMNS x HLS_SPRITE_ROWS per "jpg" or "webp" sheet (an interval of 0 disables them)
+HLS_SPRITE_INTERVAL = int(os.environ.get("HLS_SPRITE_INTERVAL", default=10))
+HLS_SPRITE_WIDTH = int(os.environ.get("HLS_SPRITE_WIDTH", default=160))
+HLS_SPRITE_COLUMNS = int(os.environ.get("HLS_SPRITE_COLUMNS", default=5))
+HLS_SPRITE_ROWS = int(os.environ.get("HLS_SPRITE_ROWS", default=5))
+HLS_SPRITE_FORMAT = os.environ.get("HLS_SPRITE_FORMAT", default="jpg")
+# In-process LRU cache for playlists and the first HLS_SEGMENT_CACHE_SEGMENTS segments of every
+# rendition, bounded by HLS_SEGMENT_CACHE_BYTES (0 disables it). With HLS_SEGMENT_CACHE_REDIS the
+# worker warms finished outputs into Redis, which backs the local cache of every web process.
+HLS_SEGMENT_CACHE_BYTES = int(os.environ.get("HLS_SEGMENT_CACHE_BYTES", default=64 * 1024 * 1024))
+HLS_SEGMENT_CACHE_MAX_ITEM_BYTES = int(os.environ.get("HLS_SEGMENT_CACHE_MAX_ITEM_BYTES", default=4 * 1024 * 1024))
+HLS_SEGMENT_CACHE_SEGMENTS = int(os.environ.get("HLS_SEGMENT_CACHE_SEGMENTS", default=3))
+# Bytes cached from the start of single file fMP4 renditions: the init segment and the first fragments
+HLS_SEGMENT_CACHE_HEAD_BYTES = int(os.environ.get("HLS_SEGMENT_CACHE_HEAD_BYTES", default=1024 * 1024))
+HLS_SEGMENT_CACHE_TTL = int(os.environ.get("HLS_SEGMENT_CACHE_TTL", default=300))
+HLS_SEGMENT_CACHE_REDIS = os.environ.get("HLS_SEGMENT_CACHE_REDIS", default="False") == "True"
+HLS_SEGMENT_CACHE_REDIS_TTL = int(os.environ.get("HLS_SEGMENT_CACHE_REDIS_TTL", default=86400))
+# Seconds to wait before each retry of a failed transcode job (empty disables retries)
+HLS_RETRY_INTERVALS = [int(i) for i in os.environ.get("HLS_RETRY_INTERVALS", default="60,300,900").split(",") if i]
 
 
 # Password validation
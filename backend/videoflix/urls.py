@@ -24,6 +24,7 @@ from registration.api.views import VerifyEmailView
 from django.urls import include
 from profiles.api.views import PasswordResetRequestView, PasswordResetConfirmView
 from django.urls import path
+from content.views import serve_hls
 
 def trigger_error(request):
     division_by_zero = 1 / 0
@@ -42,5 +43,7 @@ urlpatterns = [
     path('api/password-reset/request/', PasswordResetRequestView.as_view(), name='password-reset-request'),
     path('api/password-reset/confirm/<uidb64>/<token>/', PasswordResetConfirmView.as_view(), name='password-reset-confirm'),  
     path('sentry-debug/', trigger_error),
+    # Served with Range support in production too, static() below only works with DEBUG
+    path(f'{settings.MEDIA_URL.strip("/")}/videos/hls/<path:path>', serve_hls, name='hls_media'),
 
 ] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)